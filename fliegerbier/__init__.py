@@ -1,14 +1,75 @@
+from threading import Thread
+
 from .botcompile import build_updater
+from .migrations import migrate
+from .config import (
+    EXECUTIONMODE,
+    UPDATEMODE,
+    WEBHOOKLISTEN,
+    WEBHOOKPORT,
+    WEBHOOKSECRET,
+    WEBHOOKURL,
+    WEBHOOKMAXCONNECTIONS,
+    WEBHOOKQUEUESIZE,
+)
+from .webhook import WebhookServer
+from . import aio
+from . import metrics
+from . import tracing
+from . import slowquery
+from .database import _db
 #import logging
 #logging.basicConfig(level=logging.DEBUG,
 #                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
 
 def main():
+    migrate()
+    if EXECUTIONMODE == 'asyncio':
+        aio.start()
     updater = build_updater()
+    # Handlers run on the dispatcher thread in both update modes
+    metrics.install(_db, 1)
+    tracing.install(_db)
+    slowquery.install(_db)
+
+    if UPDATEMODE == 'webhook':
+        run_webhook(updater)
+        return
 
     updater.start_polling()
     updater.idle()  # blocks
 
+
+def run_webhook(updater):
+    if not WEBHOOKSECRET:
+        raise ValueError('webhooksecret must be set for updates = webhook')
+
+    server = WebhookServer(
+        updater.dispatcher,
+        listen=WEBHOOKLISTEN,
+        port=WEBHOOKPORT,
+        secret=WEBHOOKSECRET,
+        max_connections=WEBHOOKMAXCONNECTIONS,
+        queue_size=WEBHOOKQUEUESIZE,
+    )
+    dispatcher = Thread(target=updater.dispatcher.start, name='dispatcher')
+    dispatcher.start()
+    if WEBHOOKURL:
+        updater.bot.set_webhook(
+            url='{}/{}'.format(WEBHOOKURL.rstrip('/'), WEBHOOKSECRET),
+            max_connections=WEBHOOKMAXCONNECTIONS,
+        )
+
+    print('Listening for updates on {}:{}'.format(WEBHOOKLISTEN, WEBHOOKPORT))
+    try:
+        server.serve_forever()  # blocks
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        updater.dispatcher.stop()
+        dispatcher.join()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
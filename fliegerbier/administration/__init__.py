@@ -1,21 +1,28 @@
 from telegram import Bot
 from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, Filters
 from datetime import datetime
-from ..config import ADMINCHAT, BOTTOKEN, DATABASE
+from ..config import ADMINCHAT, BOTTOKEN, DATABASE, BOTAPIURL
 from ..decorators import admin_only, patch_telegram_action
 from ..database import Database, Consumer
 from ..emoji import emojis
+from ..outbox import outbox
 from .commit import commit_handler
 from .edit import edit_handler
 from .delete import delete_handler
-from .rechnung import rechnung, admin_rechnung, admin_rechnung_out
+from .rechnung import rechnung, admin_rechnung, admin_rechnung_out, abgleich
+from .pegel import pegel
+from .traces import traces
+from .profile import profile
 
 
-_bot = Bot(BOTTOKEN)
+_bot = Bot(BOTTOKEN, base_url=BOTAPIURL)
 
 
 def send_admin_message(text, **kwargs):
-    _bot.send_message(text=text, chat_id=ADMINCHAT, **kwargs)
+    outbox.submit(
+        ADMINCHAT, _bot.send_message,
+        text=text, chat_id=ADMINCHAT, **kwargs
+    )
     
 
 @admin_only
@@ -33,6 +40,14 @@ def admin_help_response(respond):
         '/delete - Lösche einen Nutzer (Seine Verbrauchs'
         'historie bleibt erhalten).\n\n'
         '/rechnung - Erstelle eine Rechnung für einen Monat.\n\n'
+        '/abgleich - Prüfe die Monatssummen gegen die '
+        'Einzelbuchungen und berechne sie bei Abweichungen neu.\n\n'
+        '/pegel [Grenze] - Liste alle, deren Promille über der '
+        'Grenze liegen, und wann sie wieder nüchtern sind.\n\n'
+        '/traces [Anzahl] - Zeige die langsamsten aufgezeichneten '
+        'Updates der letzten Stunde mit ihren einzelnen Schritten.\n\n'
+        '/profile [Sekunden] - Profiliere alle Handler so lange '
+        'und bekomme den Bericht und eine .pstats-Datei.\n\n'
         '/chatid - Bekomme die Chat ID. Nützlich für Nutzer.'
     )
 
@@ -3,7 +3,8 @@ from telegram.ext import ConversationHandler, CommandHandler, MessageHandler, Fi
 from datetime import datetime
 from ..config import ADMINCHAT, BOTTOKEN, DATABASE
 from ..decorators import admin_only, patch_telegram_action
-from ..database import Database, Consumer
+from ..database import Database, Consumer, invalidate_authorization
+from ..outbox import outbox
 from re import match
 
 
@@ -131,6 +132,7 @@ def set_akaflieg_id(respond, chat_dict, text, bot):
     consumer = Consumer(chat_dict['current_client_chat_id'])
     consumer.nickname = chat_dict['current_client_nickname']
     consumer.akaflieg_id = int(text)
+    invalidate_authorization(consumer.chat_id)
 
     respond(
         '{} mit der Akaflieg ID {} und der Chat ID {} '
@@ -138,7 +140,8 @@ def set_akaflieg_id(respond, chat_dict, text, bot):
         .format(consumer.nickname, consumer.akaflieg_id, consumer.chat_id)
     )
 
-    bot.send_message(
+    outbox.submit(
+        consumer.chat_id, bot.send_message,
         chat_id=consumer.chat_id,
         text=(
             'Hi {}.\nDer Kassenwart hat dich freigegeben, '
@@ -5,7 +5,7 @@ from datetime import datetime
 from sqlite3 import IntegrityError
 from ..config import ADMINCHAT, BOTTOKEN, DATABASE
 from ..decorators import admin_only, patch_telegram_action
-from ..database import Database, Consumer
+from ..database import Database, Consumer, invalidate_authorization
 
 
 @admin_only
@@ -41,6 +41,7 @@ def delete_user(respond, text, chat_dict):
     user = get_user_from_button(user_list, text)
     c = Consumer(user.chat_id)
     c.delete()
+    invalidate_authorization(c.chat_id)
     respond(
         'Der Nutzer wurde gelöscht.\n'
         'Wenn er neu eingetragen wird (mit der selben '
@@ -5,7 +5,7 @@ from sqlite3 import IntegrityError
 from re import match
 from ..config import ADMINCHAT, BOTTOKEN, DATABASE
 from ..decorators import admin_only, patch_telegram_action
-from ..database import Database, Consumer
+from ..database import Database, Consumer, invalidate_authorization
 
 
 def get_buttons_from_user(user_list):
@@ -29,8 +29,8 @@ def get_user_from_button(user_list, button_text):
 
 
 
-def get_user_data_buttons(chat_id):
-    consumer = Consumer(chat_id)
+def get_user_data_buttons(consumer: Consumer):
+    chat_id = consumer.chat_id
     text = (
         'Spitznamen: {nickname}\n'
         'Voller Name: {full_name}\n'
@@ -84,7 +84,7 @@ def select_user(respond, text, chat_dict):
 
     consumer = get_user_from_button(user_list, text)
 
-    text, reply_markup = get_user_data_buttons(consumer.chat_id)
+    text, reply_markup = get_user_data_buttons(consumer)
     print(reply_markup)
     respond(text, reply_markup=reply_markup)
     return ConversationHandler.END
@@ -128,7 +128,7 @@ def choose_nickname(respond, text, edit, chat_dict):
         return 'choose_nickname'
 
     consumer = chat_dict['consumer_to_be_edited']
-    text, reply_markup = get_user_data_buttons(consumer.chat_id)
+    text, reply_markup = get_user_data_buttons(consumer)
     
     respond('Okay. Der Wert wurde aktualisiert.')
     edit(
@@ -163,7 +163,7 @@ def choose_full_name(respond, text, chat_dict, edit):
     consumer = chat_dict['consumer_to_be_edited']
     consumer.full_name = text
 
-    text, reply_markup = get_user_data_buttons(consumer.chat_id)
+    text, reply_markup = get_user_data_buttons(consumer)
     respond('Okay. Der Wert wurde aktualisiert.')
     edit(
         message_id=chat_dict['original_message_id'],
@@ -211,8 +211,9 @@ def choose_akaflieg_id(respond, text, chat_dict, edit):
             'vergebe eine andere Akaflieg ID.'
         )
         return 'choose_akaflieg_id'
+    invalidate_authorization(consumer.chat_id)
 
-    text, reply_markup = get_user_data_buttons(consumer.chat_id)
+    text, reply_markup = get_user_data_buttons(consumer)
     respond('Okay. Der Wert wurde aktualisiert.')
     edit(
         message_id=chat_dict['original_message_id'],
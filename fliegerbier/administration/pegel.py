@@ -0,0 +1,38 @@
+from datetime import datetime, timedelta
+from time import time
+from ..decorators import admin_only, patch_telegram_action
+from ..bloodalcohol_bulk import get_all_levels
+
+
+@admin_only
+@patch_telegram_action
+def pegel(respond, text):
+    args = text.split()[1:]
+    try:
+        limit = float(args[0].replace(',', '.')) if args else 0.0
+    except ValueError:
+        respond('Benutzung: /pegel [Grenze in ‰], z.B. /pegel 0,5')
+        return
+
+    now = time()
+    bulk = get_all_levels(now)
+    max_levels = bulk.max_levels()
+    sober_in = bulk.sober_in_hours()
+
+    over_limit = [i for i in max_levels.argsort()[::-1] if max_levels[i] > limit]
+    if not over_limit:
+        respond('Niemand liegt über {:.2f}‰.'.format(limit))
+        return
+
+    msg = 'Über {:.2f}‰ (ungünstigstes Modell):\n\n'.format(limit)
+    for i in over_limit[:50]:
+        sober_at = datetime.fromtimestamp(now) + timedelta(hours=float(sober_in[i]))
+        msg += '{} ({}): {:.2f}‰, nüchtern ab {}\n'.format(
+            bulk.full_names[i] or '[nicht gesetzt]',
+            bulk.akaflieg_ids[i],
+            max_levels[i],
+            sober_at.strftime('%d.%m. %H:%M'),
+        )
+    if len(over_limit) > 50:
+        msg += '\n... und {} weitere'.format(len(over_limit) - 50)
+    respond(msg)
@@ -0,0 +1,42 @@
+from ..decorators import admin_only, patch_telegram_action
+from .. import profiling
+
+MAX_SECONDS = 600
+MESSAGE_LIMIT = 4000  # characters, Telegram allows 4096
+
+
+@admin_only
+@patch_telegram_action
+def profile(respond, text):
+    args = text.split()[1:]
+    try:
+        seconds = int(args[0]) if args else 60
+    except ValueError:
+        respond('Benutzung: /profile [Sekunden], z.B. /profile 60')
+        return
+    seconds = min(max(1, seconds), MAX_SECONDS)
+
+    def finished(session):
+        if not session.calls:
+            respond('In den {} Sekunden lief kein Handler.'.format(seconds))
+            return
+        report = session.report()
+        if len(report) > MESSAGE_LIMIT:
+            report = report[:MESSAGE_LIMIT] + '\n... gekürzt'
+        respond(report)
+        respond(
+            '{} Handler-Aufrufe in {} Sekunden{}'.format(
+                session.calls, seconds,
+                ', {} nicht profiliert'.format(session.skipped) if session.skipped else '',
+            ),
+            file=session.dump(),
+            filename='profile.pstats',
+        )
+
+    if not profiling.start(seconds, finished):
+        respond('Es läuft schon ein Profil, noch {:.0f} Sekunden.'.format(profiling.remaining()))
+        return
+    respond(
+        'Alle Handler werden {} Sekunden lang profiliert, '
+        'danach kommt der Bericht.'.format(seconds)
+    )
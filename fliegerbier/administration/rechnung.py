@@ -9,6 +9,7 @@ from ..config import ADMINCHAT, BOTTOKEN, DATABASE
 from ..decorators import admin_only, patch_telegram_action
 from ..database import Database, Consumer
 from ..datecalculation import get_month
+from .. import tracing
 
 
 def get_reply_markup(month_n):
@@ -94,20 +95,45 @@ def admin_rechnung_out(respond, edit, callback_data):
         )
 
 
+@admin_only
+@patch_telegram_action
+def abgleich(respond):
+    db = Database()
+    differences = db.reconcile_monthly_totals(fix=True)
+
+    if not differences:
+        respond('Die Monatssummen stimmen mit den Einzelbuchungen überein.')
+        return
+
+    msg = (
+        '{} Monatssummen wichen von den Einzelbuchungen ab '
+        'und wurden neu berechnet:\n\n'
+        .format(len(differences))
+    )
+    for (akaflieg_id, year, month, item_name, price_cents), expected, actual in differences[:30]:
+        msg += 'Aka {} {:0>2}/{} {} {:.2f}€: {} statt {}\n'.format(
+            akaflieg_id, month, year, item_name, price_cents / 100, expected, actual
+        )
+    respond(msg)
+
+
+@tracing.traced('render rechnung csv')
 def _create_csv(month_n: int):
     db = Database()
 
     month = get_month(month_n)
     last_day_of_month = datetime.fromtimestamp(month.end_ts - 1)
 
-    consumption = db.get_consumption_dictionary(
-        from_timestamp=month.start_ts,
-        to_timestamp=month.end_ts,
-    )
+    consumption = db.get_monthly_totals(month.year, month.month)
+
+    full_names = {
+        c.akaflieg_id: c.full_name
+        for c in db.get_consumer_list() if c.is_authorized()
+    }
 
     keys = sorted(
         list(consumption.keys()),
-        key=lambda x: Consumer(x).full_name
+        key=lambda x: full_names.get(x, '')
     )
 
     csv = ''
@@ -122,10 +148,7 @@ def _create_csv(month_n: int):
             drinks.append('{} x{}'.format(item_name, count))
             sum_ += consumption[akaflieg_id][item_name]['sum']
 
-        c = Consumer.from_akaflieg_id(akaflieg_id)
-        full_name = '[nicht in Datenbank]'
-        if c.is_authorized():
-            full_name = c.full_name
+        full_name = full_names.get(akaflieg_id, '[nicht in Datenbank]')
 
         line = (
             '{last_day_of_month};Getränke-Abrechnung {month:0>2}/{year}, '
@@ -136,7 +159,7 @@ def _create_csv(month_n: int):
                 drinks=', '.join(drinks),
                 full_name=full_name,
                 akaflieg_id=akaflieg_id,
-                sum=str(sum_).replace('.', ',')  # 12.1 to 12,1
+                sum=str(round(sum_, 2)).replace('.', ',')  # 12.1 to 12,1
             )
         )
         csv += line
@@ -0,0 +1,34 @@
+from time import time
+from ..decorators import admin_only, patch_telegram_action
+from .. import tracing
+
+MESSAGE_LIMIT = 4000  # characters, Telegram allows 4096
+
+
+@admin_only
+@patch_telegram_action
+def traces(respond, text):
+    if not tracing.ENABLED:
+        respond('Tracing ist aus (tracesample = 0 in der config.ini).')
+        return
+
+    args = text.split()[1:]
+    try:
+        n = int(args[0]) if args else 5
+    except ValueError:
+        respond('Benutzung: /traces [Anzahl], z.B. /traces 5')
+        return
+
+    slowest = tracing.slowest(max(1, n), time() - 3600)
+    if not slowest:
+        respond('In der letzten Stunde wurden keine Updates aufgezeichnet.')
+        return
+
+    msg = 'Langsamste Updates der letzten Stunde:\n'
+    for trace in slowest:
+        part = '\nTrace {}\n{}\n'.format(trace.id, tracing.format_trace(trace))
+        if len(msg) + len(part) > MESSAGE_LIMIT:
+            msg += '\n... gekürzt'
+            break
+        msg += part
+    respond(msg)
@@ -0,0 +1,174 @@
+"""
+Execution mode 'asyncio' (mode = asyncio in config.ini).
+
+Coroutine handlers decorated with patch_telegram_action run on one
+event loop in a background thread instead of blocking the dispatcher.
+They reach the database through the async connection pool of the
+databases package and await the Bot API calls queued in the outbox.
+With writebuffer = true, purchases go through the write buffer like
+those of the threaded handlers.
+"""
+import asyncio
+from concurrent.futures import Future
+from threading import Thread
+import traceback
+import sqlalchemy
+from .config import DATABASE, WRITEBUFFER
+from .database import (
+    _db,
+    Database,
+    users,
+    consumptions,
+    consumption_monthly_totals,
+    reverted_consumptions,
+    Booking,
+    UserRow,
+    _user_row_query,
+    _consumption_values,
+    _monthly_total_key,
+    _monthly_total_upsert,
+)
+from .items import Item
+from .periodcache import period_cache
+
+
+_loop: asyncio.AbstractEventLoop = None
+_database = None  # databases.Database, connected by start()
+
+# SQLite and MySQL report the new id as lastrowid, Postgres needs RETURNING
+_returning = _db.dialect.name == 'postgresql'
+
+
+def start():
+    """Start the event loop thread and connect the pool, blocks until done."""
+    global _loop
+    if _loop is not None:
+        return
+
+    loop = asyncio.new_event_loop()
+    Thread(target=loop.run_forever, name='asyncio', daemon=True).start()
+    _loop = loop
+    asyncio.run_coroutine_threadsafe(_connect(), loop).result()
+
+
+async def _connect():
+    global _database
+    # Only needed in this mode
+    from databases import Database
+
+    _database = Database(DATABASE)
+    await _database.connect()
+
+
+def _report_error(future: Future):
+    if not future.cancelled() and future.exception() is not None:
+        e = future.exception()
+        traceback.print_exception(type(e), e, e.__traceback__)
+
+
+def submit(coro) -> Future:
+    """Run a coroutine on the loop, callable from any thread."""
+    future = asyncio.run_coroutine_threadsafe(coro, _loop)
+    future.add_done_callback(_report_error)
+    return future
+
+
+async def wait_for(future: Future):
+    """Await a concurrent.futures.Future, e.g. from the outbox."""
+    return await asyncio.wrap_future(future)
+
+
+async def get_user_row(chat_id: int) -> UserRow:
+    row = await _database.fetch_one(
+        _user_row_query().where(users.c.chat_id == int(chat_id))
+    )
+    if row is None:
+        return None
+    return UserRow(**{key: row[key] for key in UserRow._fields})
+
+
+async def _increment_monthly_total(values: dict):
+    t = consumption_monthly_totals
+    key_values, key = _monthly_total_key(
+        values['akaflieg_id'],
+        values['timestamp'],
+        values['item_name'],
+        values['item_price_at_this_time'],
+    )
+    # Same statements as _change_monthly_total
+    upsert = _monthly_total_upsert(_db.dialect.name, key_values, 1)
+    if upsert is not None:
+        await _database.execute(upsert)
+        return
+    count = await _database.fetch_val(sqlalchemy.select([t.c.count]).where(key))
+    if count is None:
+        await _database.execute(t.insert().values(count=1, **key_values))
+    else:
+        await _database.execute(t.update().where(key).values(count=t.c.count + 1))
+
+
+def _is_unique_violation(e: Exception) -> bool:
+    """Whether e is a duplicate key error, databases passes on the driver's own exceptions."""
+    import sqlite3
+    if isinstance(e, sqlite3.IntegrityError):
+        # Also raised for NOT NULL and CHECK constraints
+        return str(e).startswith('UNIQUE constraint failed')
+    try:
+        from asyncpg.exceptions import UniqueViolationError
+        if isinstance(e, UniqueViolationError):
+            return True
+    except ImportError:
+        pass
+    try:
+        from pymysql.err import IntegrityError
+        if isinstance(e, IntegrityError) and e.args and e.args[0] == 1062:
+            return True
+    except ImportError:
+        pass
+    return False
+
+
+async def enter_consumption(
+    akaflieg_id: int,
+    item: Item,
+    consumption_time: int = None,
+    idempotency_key: str = None,
+) -> Booking:
+    """Async twin of Database.enter_consumption."""
+    if WRITEBUFFER:
+        # Batched with the purchases of the threaded handlers,
+        # the executor thread waits for the group commit
+        return await asyncio.get_running_loop().run_in_executor(
+            None, lambda: Database().enter_consumption(
+                akaflieg_id, item, consumption_time, idempotency_key
+            )
+        )
+
+    values = _consumption_values(akaflieg_id, item, consumption_time, idempotency_key)
+    query = consumptions.insert().values(**values)
+    if _returning:
+        query = query.returning(consumptions.c.id)
+
+    try:
+        async with _database.transaction():
+            if idempotency_key is not None and await _database.fetch_val(
+                sqlalchemy.select([reverted_consumptions.c.idempotency_key]).where(
+                    reverted_consumptions.c.idempotency_key == idempotency_key
+                )
+            ) is not None:
+                return Booking(None, False)
+            rowid = await _database.execute(query)
+            await _increment_monthly_total(values)
+        period_cache.invalidate(akaflieg_id, values['timestamp'])
+        return Booking(rowid, True)
+    except Exception as e:
+        if idempotency_key is None or not _is_unique_violation(e):
+            raise
+        rowid = await _database.fetch_val(
+            sqlalchemy.select([consumptions.c.id]).where(
+                consumptions.c.idempotency_key == idempotency_key
+            )
+        )
+        if rowid is None:
+            raise
+        return Booking(rowid, False)
@@ -0,0 +1,331 @@
+from bisect import bisect_right
+from collections import deque
+from threading import Lock
+from typing import Dict, List
+
+
+FEMALE_HIGH_DECAY = 0.1  # promille per hour
+FEMALE_LOW_DECAY = 0.085  # promille per hour
+MALE_HIGH_DECAY = 0.2  # promille per hour
+MALE_LOW_DECAY = 0.1  # promille per hour
+FEMALE_WATER = 0.6  # percent water female
+MALE_WATER = 0.7  # percent water male
+ALC_EFFECTIVENESS = 0.9  # how much gets absorbed
+
+# Order of the four models in all level lists
+DECAYS = [FEMALE_HIGH_DECAY, FEMALE_LOW_DECAY, MALE_HIGH_DECAY, MALE_LOW_DECAY]
+
+# Only drinks of the last 24 hours count
+WINDOW = 3600 * 24
+
+
+class BloodAlcoholCurve:
+    """
+    The levels of the four models are piecewise linear: a jump at every
+    drink, then a linear decay that is clamped at zero. The curve keeps
+    the level right after each drink (the breakpoints), so any point in
+    time only needs a bisect to the last drink before it.
+    Valid from the first breakpoint on.
+    """
+    __slots__ = ('times', 'levels', 'next_zero')
+
+    def __init__(self, times: List[float], levels: List[List[float]]):
+        self.times = times
+        self.levels = levels  # per breakpoint the four levels after the drink
+
+        # Per breakpoint and model the time the level reaches zero. If a
+        # drink comes first, that is the zero of a later breakpoint.
+        self.next_zero = [None] * len(times)
+        later = [None, None, None, None]
+        for k in range(len(times) - 1, -1, -1):
+            zeros = []
+            for i in range(4):
+                zero = times[k] + levels[k][i] / DECAYS[i] * 3600
+                if k + 1 < len(times) and zero > times[k + 1]:
+                    zero = later[i]
+                zeros.append(zero)
+            self.next_zero[k] = later = zeros
+
+    def _breakpoint(self, t: float) -> int:
+        return bisect_right(self.times, t) - 1
+
+    def _level(self, k: int, t: float, model: int) -> float:
+        if k < 0:
+            return 0.0
+        hours_since_last_drink = (t - self.times[k]) / 3600
+        return max(0.0, self.levels[k][model] - DECAYS[model] * hours_since_last_drink)
+
+    def level_at(self, t: float, model: int) -> float:
+        return self._level(self._breakpoint(t), t, model)
+
+    def time_until_zero(self, t: float, model: int) -> float:
+        """Seconds from t until the level of the model is zero."""
+        k = self._breakpoint(t)
+        if k < 0:
+            return 0.0
+        return max(0.0, self.next_zero[k][model] - t)
+
+    def sample(self, t0: float, t1: float, n: int, model: int) -> List[float]:
+        """Levels at n evenly spaced points from t0 to t1."""
+        if n < 2:
+            return [self.level_at(t0, model)][:n]
+        step = (t1 - t0) / (n - 1)
+        k = self._breakpoint(t0)
+        result = []
+        for j in range(n):
+            t = t0 + j * step
+            # The points are in order, so walk on instead of bisecting
+            while k + 1 < len(self.times) and self.times[k + 1] <= t:
+                k += 1
+            result.append(self._level(k, t, model))
+        return result
+
+
+class BloodAlcoholState:
+    """
+    Levels of the four models right after the last alcoholic drink.
+    Drinks are applied in time order with exactly the arithmetic of a
+    full replay, so both give identical numbers.
+    """
+    __slots__ = (
+        'weight', 'levels', 'last_timestamp', 'episode_start', 'undo',
+        'times', 'breakpoints', '_curve', 'replayed_from',
+    )
+
+    def __init__(self, weight: int, replayed_from: int = 0):
+        self.weight = weight
+        # Start of the window of the replay the state was built from,
+        # drinks before it are missing
+        self.replayed_from = replayed_from
+        self.levels = [0.0, 0.0, 0.0, 0.0]
+        self.last_timestamp = 0
+        # Per model the drink at which the level started again from zero.
+        # Older drinks no longer influence that model.
+        self.episode_start = [0, 0, 0, 0]
+        # (rowid, previous state, alcoholic) of the latest drinks, to undo reverts
+        self.undo = deque(maxlen=16)
+        # Time and levels after each alcoholic drink, for the curve
+        self.times = []
+        self.breakpoints = []
+        self._curve = None
+
+    def _snapshot(self):
+        return list(self.levels), self.last_timestamp, list(self.episode_start)
+
+    def add(self, rowid: int, timestamp, gram_alcohol) -> bool:
+        """Apply a drink, returns False if it is older than the last one."""
+        if timestamp < self.last_timestamp:
+            return False
+        self.undo.append((rowid, self._snapshot(), bool(gram_alcohol)))
+        if not gram_alcohol:
+            return True
+
+        gram_alcohol = gram_alcohol * ALC_EFFECTIVENESS
+        instant_promille_female = gram_alcohol / self.weight / FEMALE_WATER
+        instant_promille_male = gram_alcohol / self.weight / MALE_WATER
+        instant = [
+            instant_promille_female, instant_promille_female,
+            instant_promille_male, instant_promille_male,
+        ]
+
+        hours_since_last_drink = (timestamp - self.last_timestamp) / 3600
+        for i in range(4):
+            self.levels[i] = max(0.0, self.levels[i] - DECAYS[i] * hours_since_last_drink)
+            if self.levels[i] == 0.0:
+                self.episode_start[i] = timestamp
+            self.levels[i] += instant[i]
+        self.last_timestamp = timestamp
+
+        self.times.append(timestamp)
+        self.breakpoints.append(list(self.levels))
+        # Drop breakpoints older than the window, but keep enough
+        # that undoing the latest drinks leaves a start point.
+        while len(self.times) > self.undo.maxlen + 1 and self.times[1] <= timestamp - WINDOW:
+            del self.times[0]
+            del self.breakpoints[0]
+        self._curve = None
+        return True
+
+    def remove_latest(self, rowid: int) -> bool:
+        """Undo the latest drink, returns False if rowid is not the latest."""
+        if not self.undo or self.undo[-1][0] != rowid:
+            return False
+        _, (self.levels, self.last_timestamp, self.episode_start), alcoholic = self.undo.pop()
+        if alcoholic:
+            self.times.pop()
+            self.breakpoints.pop()
+            self._curve = None
+        return True
+
+    def levels_at(self, now: float) -> List[float]:
+        hours_since_last_drink = (now - self.last_timestamp) / 3600
+        return [
+            max(0.0, self.levels[i] - DECAYS[i] * hours_since_last_drink)
+            for i in range(4)
+        ]
+
+    def curve(self) -> BloodAlcoholCurve:
+        if self._curve is None:
+            self._curve = BloodAlcoholCurve(list(self.times), list(self.breakpoints))
+        return self._curve
+
+    def matches_window(self, levels: List[float], window_start: int) -> bool:
+        """
+        Whether a replay of only the drinks since window_start gives the
+        same levels. A model whose episode began before the window still
+        carries drinks the replay would drop.
+        """
+        return all(
+            levels[i] == 0.0 or self.episode_start[i] >= window_start
+            for i in range(4)
+        )
+
+
+class BloodAlcoholCache:
+    """
+    BloodAlcoholState per akaflieg_id, updated on every purchase and
+    revert. Falls back to a replay of the last 24 hours whenever the
+    state can not be trusted.
+    """
+    def __init__(self):
+        self._states: Dict[int, BloodAlcoholState] = {}
+        # Counts changes per akaflieg_id, a replay racing
+        # with a change must not store its result.
+        self._generation: Dict[int, int] = {}
+        self._lock = Lock()
+
+    def _changed(self, akaflieg_id):
+        self._generation[akaflieg_id] = self._generation.get(akaflieg_id, 0) + 1
+
+    def record(self, akaflieg_id: int, rowid: int, timestamp, gram_alcohol):
+        with self._lock:
+            self._changed(akaflieg_id)
+            state = self._states.get(akaflieg_id)
+            if state is None:
+                # Built by replay on the next read
+                return
+            if any(entry[0] == rowid for entry in state.undo):
+                # Idempotent retry of a booked drink
+                return
+            if not state.add(rowid, timestamp, gram_alcohol):
+                del self._states[akaflieg_id]
+
+    def forget(self, akaflieg_id: int, rowid: int):
+        with self._lock:
+            self._changed(akaflieg_id)
+            state = self._states.get(akaflieg_id)
+            if state is not None and not state.remove_latest(rowid):
+                del self._states[akaflieg_id]
+
+    def invalidate(self, akaflieg_id: int = None):
+        with self._lock:
+            if akaflieg_id is None:
+                self._states.clear()
+                self._generation.clear()
+            else:
+                self._states.pop(akaflieg_id, None)
+                self._changed(akaflieg_id)
+
+    def levels(self, consumer, now: float) -> List[float]:
+        """
+        Current levels of the four models (see DECAYS) for a Consumer.
+        Only reads the database if there is no usable state.
+        """
+        state = self._state(consumer, now)
+        with self._lock:
+            return state.levels_at(now)
+
+    def curve(self, consumer, now: float) -> BloodAlcoholCurve:
+        """Curve of the drinks up to now, valid back to now - WINDOW."""
+        state = self._state(consumer, now)
+        with self._lock:
+            return state.curve()
+
+    def _state(self, consumer, now: float) -> BloodAlcoholState:
+        akaflieg_id = consumer.akaflieg_id
+        weight = consumer.weight
+        window_start = int(now - WINDOW)
+
+        with self._lock:
+            state = self._states.get(akaflieg_id)
+            if state is not None and (
+                now < state.last_timestamp or window_start < state.replayed_from
+            ):
+                # Asked for an earlier time than the state was built
+                # for. Its drinks are not those of that window.
+                state = None
+            if state is not None and state.weight != weight:
+                if state.last_timestamp < window_start:
+                    # No drink in the window, nothing to recompute
+                    state = BloodAlcoholState(weight, window_start)
+                    self._states[akaflieg_id] = state
+                else:
+                    state = None
+
+            if state is not None:
+                if state.matches_window(state.levels_at(now), window_start):
+                    return state
+            generation = self._generation.get(akaflieg_id, 0)
+
+        # Full replay
+        state = BloodAlcoholState(weight, window_start)
+        history = consumer.get_consumption_history(from_timestamp=window_start)
+        for consumption in history:
+            state.add(consumption.rowid, consumption.timestamp, consumption.gram_alcohol)
+
+        with self._lock:
+            if self._generation.get(akaflieg_id, 0) == generation:
+                self._states[akaflieg_id] = state
+        return state
+
+
+blood_alcohol = BloodAlcoholCache()
+
+
+def _replay_level(drinks, weight: int, t: float, model: int) -> float:
+    # The loop of the promille message before the curve existed
+    state = BloodAlcoholState(weight)
+    for rowid, (timestamp, gram_alcohol) in enumerate(drinks):
+        if timestamp > t:
+            break
+        state.add(rowid, timestamp, gram_alcohol)
+    return state.levels_at(t)[model]
+
+
+def _benchmark(n_drinks: int = 40, n_points: int = 500):
+    from random import randint, seed
+    from timeit import timeit
+
+    seed(1)
+    start = 1600000000
+    drinks = sorted(
+        (start + randint(0, WINDOW), randint(10, 30)) for _ in range(n_drinks)
+    )
+    points = [start + WINDOW * 1.25 * j / (n_points - 1) for j in range(n_points)]
+
+    state = BloodAlcoholState(75)
+    for rowid, (timestamp, gram_alcohol) in enumerate(drinks):
+        state.add(rowid, timestamp, gram_alcohol)
+    curve = state.curve()
+
+    for model in range(4):
+        assert curve.sample(points[0], points[-1], n_points, model) == [
+            _replay_level(drinks, 75, t, model) for t in points
+        ]
+
+    replay = timeit(lambda: [_replay_level(drinks, 75, t, 1) for t in points], number=5) / 5
+    build = timeit(lambda: BloodAlcoholCurve(list(state.times), list(state.breakpoints)), number=50) / 50
+    level_at = timeit(lambda: [curve.level_at(t, 1) for t in points], number=50) / 50
+    sample = timeit(lambda: curve.sample(points[0], points[-1], n_points, 1), number=50) / 50
+
+    # Each line covers all points, except the one-off curve build
+    print('{} drinks, {} points'.format(n_drinks, n_points))
+    print('replay:            {:8.3f}ms'.format(replay * 1000))
+    print('curve build:       {:8.3f}ms'.format(build * 1000))
+    print('curve level_at:    {:8.3f}ms'.format(level_at * 1000))
+    print('curve sample:      {:8.3f}ms'.format(sample * 1000))
+
+
+if __name__ == '__main__':
+    # python -m fliegerbier.bloodalcohol
+    _benchmark()
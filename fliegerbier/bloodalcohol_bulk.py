@@ -0,0 +1,84 @@
+"""
+Blood alcohol levels of all users at once, for the admin overview.
+Same model and arithmetic as BloodAlcoholState, evaluated with NumPy
+over all users at once instead of one Consumer at a time. The drinks
+stay in one flat array with an offset per user, so a single heavy
+drinker does not pad everybody else.
+"""
+from typing import List, NamedTuple
+import numpy as np
+from .database import Database
+from .bloodalcohol import (
+    ALC_EFFECTIVENESS,
+    DECAYS,
+    FEMALE_WATER,
+    MALE_WATER,
+    WINDOW,
+)
+
+
+_decays = np.array(DECAYS)
+# Per model the body water, in DECAYS order
+_water = np.array([FEMALE_WATER, FEMALE_WATER, MALE_WATER, MALE_WATER])
+
+
+class BulkLevels(NamedTuple):
+    akaflieg_ids: np.ndarray  # [users]
+    full_names: List[str]
+    levels: np.ndarray  # [users x 4], models in DECAYS order
+
+    def max_levels(self) -> np.ndarray:
+        """Highest level over the four models per user."""
+        return self.levels.max(axis=1)
+
+    def sober_in_hours(self) -> np.ndarray:
+        """Hours until every model is back at zero per user."""
+        return (self.levels / _decays).max(axis=1)
+
+
+def levels_from_rows(rows, now: float) -> BulkLevels:
+    """
+    rows as returned by Database.get_alcohol_consumptions,
+    ordered by akaflieg_id and time.
+    """
+    if not rows:
+        return BulkLevels(np.zeros(0, dtype=np.int64), [], np.zeros((0, 4)))
+
+    akaflieg_id, _, weight, timestamp, gram_alcohol = (
+        np.array(column) for column in zip(*rows)
+    )
+    weight = weight.astype(np.float64)
+    timestamp = timestamp.astype(np.float64)
+    gram_alcohol = gram_alcohol.astype(np.float64)
+
+    # Rows of one user are consecutive, starting at first_row
+    ids, first_row, counts = np.unique(akaflieg_id, return_index=True, return_counts=True)
+    instant = (gram_alcohol * ALC_EFFECTIVENESS / weight)[:, None] / _water
+
+    # Users with the most drinks first, step d then only touches the
+    # prefix of users that have a d-th drink.
+    order = np.argsort(-counts, kind='stable')
+    offsets = first_row[order]
+    negative_counts = -counts[order]
+
+    levels = np.zeros((len(ids), 4))
+    last_timestamp = np.zeros(len(ids))
+    for d in range(counts.max()):
+        n = np.searchsorted(negative_counts, -d, side='left')
+        row = offsets[:n] + d
+        hours = (timestamp[row] - last_timestamp[:n]) / 3600
+        levels[:n] = np.maximum(0.0, levels[:n] - _decays * hours[:, None]) + instant[row]
+        last_timestamp[:n] = timestamp[row]
+
+    hours = (now - last_timestamp) / 3600
+    sorted_levels = np.maximum(0.0, levels - _decays * hours[:, None])
+    levels = np.empty_like(sorted_levels)
+    levels[order] = sorted_levels
+
+    full_names = [rows[i][1] for i in first_row]
+    return BulkLevels(ids, full_names, levels)
+
+
+def get_all_levels(now: float) -> BulkLevels:
+    rows = Database().get_alcohol_consumptions(int(now - WINDOW))
+    return levels_from_rows(rows, now)
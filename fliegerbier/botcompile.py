@@ -1,8 +1,9 @@
 from json import loads
 import telegram
-from .items import item_list
+from threading import Lock
+from .items import get_catalog, Catalog
 from .decorators import patch_telegram_action, requires_authorization
-from .config import BOTTOKEN, ADMINCHAT
+from .config import BOTTOKEN, ADMINCHAT, BOTAPIURL
 from .emoji import emojis
 from .enter_item_consumption import enter_item_consumption, undo_consumption
 from .administration import (
@@ -12,7 +13,10 @@ from .administration import (
     list_users,
     edit_handler,
     delete_handler,
-    rechnung, admin_rechnung, admin_rechnung_out
+    rechnung, admin_rechnung, admin_rechnung_out, abgleich,
+    pegel,
+    traces,
+    profile,
 )
 from .statistics import get_user_statistics, update_user_statistics, get_user_csv
 from .promille import get_promille, get_promille_callback
@@ -39,20 +43,66 @@ def _reblock(block, width=2):
         new_block.append(block[i:min(i+width, len(block))])
     return new_block
 
-def get_main_reply_markup():
-    costly_items = [item.button_text for item in item_list if item.price > 0]
+def _build_main_reply_markup(catalog: Catalog):
+    costly_items = [item.button_text for item in catalog.items if item.price > 0]
     return ReplyKeyboardMarkup(
         _reblock(costly_items) + [
         [_status_text, _promille_text, _free_drinks_with_alc_text]
     ])
 
-def get_free_alc_drinks_markup():
-    free_items = [item.button_text for item in item_list if item.price == 0]
+def _build_free_alc_drinks_markup(catalog: Catalog):
+    free_items = [item.button_text for item in catalog.items if item.price == 0]
     return ReplyKeyboardMarkup(
         [[_back_to_buyable_drinks]] + _reblock(free_items)
     )
 
 
+class _Routes:
+    """Handlers and keyboards for one catalog version."""
+    def __init__(self, catalog: Catalog):
+        self.version = catalog.version
+        self.main_markup = _build_main_reply_markup(catalog)
+        self.free_alc_drinks_markup = _build_free_alc_drinks_markup(catalog)
+
+        # text: handler(update, context, respond)
+        self.table = {
+            _free_drinks_with_alc_text: lambda update, context, respond: respond(
+                'Okay', reply_markup=self.free_alc_drinks_markup
+            ),
+            _back_to_buyable_drinks: lambda update, context, respond: respond(
+                'Okay', reply_markup=self.main_markup
+            ),
+            _status_text: lambda update, context, respond: get_user_statistics(update, context),
+            _promille_text: lambda update, context, respond: get_promille(update, context),
+        }
+        for button_text, item in catalog.by_button_text.items():
+            f = enter_item_consumption(item)
+            self.table[button_text] = lambda update, context, respond, f=f: f(update, context)
+
+
+_routes: _Routes = None
+_routes_lock = Lock()
+
+
+def _get_routes() -> _Routes:
+    global _routes
+    catalog = get_catalog()
+    routes = _routes
+    if routes is None or routes.version != catalog.version:
+        with _routes_lock:
+            if _routes is None or _routes.version != catalog.version:
+                _routes = _Routes(catalog)
+            routes = _routes
+    return routes
+
+
+def get_main_reply_markup():
+    return _get_routes().main_markup
+
+def get_free_alc_drinks_markup():
+    return _get_routes().free_alc_drinks_markup
+
+
 @patch_telegram_action
 def start_message(respond):
     text = ('Hi!\n'
@@ -114,32 +164,19 @@ def handle_text(update, context, text, respond, chat_id):
         )
         return
 
-    all_items = [item.button_text for item in item_list]
-
-    if text in all_items:
-        f = enter_item_consumption(text)
-    elif text == _free_drinks_with_alc_text:
-        respond('Okay', reply_markup=get_free_alc_drinks_markup())
-        return
-    elif text == _back_to_buyable_drinks:
-        respond('Okay', reply_markup=get_main_reply_markup())
-        return
-    elif text == _status_text:
-        get_user_statistics(update, context)
+    routes = _get_routes()
+    handler = routes.table.get(text)
+    if handler is None:
+        respond('Bitte nutze die Buttons!', reply_markup=routes.main_markup)
         return
-    elif text == _promille_text:
-        get_promille(update, context)
-        return
-    else:
-        respond('Bitte nutze die Buttons!', reply_markup=get_main_reply_markup())
-        return
-    
-    f(update, context)
+
+    handler(update, context, respond)
 
 
 def build_updater():
     updater = Updater(
         token=BOTTOKEN,
+        base_url=BOTAPIURL,
         use_context=True,
         workers=16,
         persistence=None
@@ -151,6 +188,10 @@ def build_updater():
     updater.dispatcher.add_handler(CommandHandler('help', admin_help_response))
     updater.dispatcher.add_handler(CommandHandler('list', list_users))
     updater.dispatcher.add_handler(CommandHandler('rechnung', rechnung))
+    updater.dispatcher.add_handler(CommandHandler('abgleich', abgleich))
+    updater.dispatcher.add_handler(CommandHandler('pegel', pegel))
+    updater.dispatcher.add_handler(CommandHandler('traces', traces))
+    updater.dispatcher.add_handler(CommandHandler('profile', profile))
     updater.dispatcher.add_handler(edit_handler)
     updater.dispatcher.add_handler(delete_handler)
 
@@ -7,4 +7,54 @@ BOTTOKEN = c.get('config', 'bottoken')
 DATABASE = c.get('config', 'database')
 ADMINCHAT = int(c.get('config', 'adminchat'))
 REVERTTIME = c.getint('config', 'reverttime', fallback=30)
+# Seconds between two updates of the revert countdown
+REVERTTICK = c.getint('config', 'reverttick', fallback=5)
 ITEMCSV = c.get('config', 'itemcsv')
+AUTHCACHETTL = c.getint('config', 'authcachettl', fallback=300)
+# Group commit of purchases, flushed after writebuffersize rows
+# or writebufferlatency milliseconds
+WRITEBUFFER = c.getboolean('config', 'writebuffer', fallback=False)
+WRITEBUFFERSIZE = c.getint('config', 'writebuffersize', fallback=50)
+WRITEBUFFERLATENCY = c.getint('config', 'writebufferlatency', fallback=5)
+# Bot API, e.g. a local stub server for testing
+BOTAPIURL = c.get('config', 'botapiurl', fallback=None)
+# Outgoing Bot API calls per second, in total, per private chat and per group
+GLOBALRATE = c.getfloat('config', 'globalrate', fallback=30.0)
+CHATRATE = c.getfloat('config', 'chatrate', fallback=1.0)
+GROUPRATE = c.getfloat('config', 'grouprate', fallback=20 / 60)
+OUTBOXWORKERS = c.getint('config', 'outboxworkers', fallback=4)
+# threaded or asyncio, see aio.py
+EXECUTIONMODE = c.get('config', 'mode', fallback='threaded')
+# polling or webhook, see webhook.py
+UPDATEMODE = c.get('config', 'updates', fallback='polling')
+WEBHOOKLISTEN = c.get('config', 'webhooklisten', fallback='127.0.0.1')
+WEBHOOKPORT = c.getint('config', 'webhookport', fallback=8080)
+WEBHOOKSECRET = c.get('config', 'webhooksecret', fallback='')
+# Public HTTPS address the webhook is registered with, without the secret
+WEBHOOKURL = c.get('config', 'webhookurl', fallback=None)
+WEBHOOKMAXCONNECTIONS = c.getint('config', 'webhookmaxconnections', fallback=40)
+# Updates waiting for the dispatcher before the webhook answers 503
+WEBHOOKQUEUESIZE = c.getint('config', 'webhookqueuesize', fallback=100)
+# Send the CSV export of a user's history gzip compressed
+CSVGZIP = c.getboolean('config', 'csvgzip', fallback=False)
+# ANSI colors in the chat logs and on the console
+LOGCOLORS = c.getboolean('config', 'logcolors', fallback=True)
+# Log files of that many chats are kept open
+LOGOPENFILES = c.getint('config', 'logopenfiles', fallback=32)
+# Rotation of the chat logs by size (0 for no limit) and at midnight,
+# rotated segments are deleted after logretentiondays (0 keeps them)
+LOGMAXBYTES = c.getint('config', 'logmaxbytes', fallback=1024 * 1024)
+LOGROTATEDAILY = c.getboolean('config', 'logrotatedaily', fallback=True)
+LOGRETENTIONDAYS = c.getint('config', 'logretentiondays', fallback=365)
+# Prometheus endpoint, see metrics.py. 0 turns metrics off.
+METRICSLISTEN = c.get('config', 'metricslisten', fallback='127.0.0.1')
+METRICSPORT = c.getint('config', 'metricsport', fallback=0)
+# Share of updates that are traced, see tracing.py. 0 turns tracing off.
+TRACESAMPLE = c.getfloat('config', 'tracesample', fallback=0.0)
+# Finished traces are appended to tracefile (JSON lines), the last
+# tracebuffer ones are kept in memory for /traces
+TRACEFILE = c.get('config', 'tracefile', fallback=None)
+TRACEBUFFER = c.getint('config', 'tracebuffer', fallback=1000)
+# SQL statements slower than that many seconds go to log/slow_queries.log
+# with their query plan, see slowquery.py. 0 turns the log off.
+SLOWQUERYSECS = c.getfloat('config', 'slowquerysecs', fallback=0.0)
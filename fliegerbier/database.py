@@ -1,12 +1,25 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from time import time
 from datetime import datetime
-from typing import List, Dict, Tuple
-from collections import namedtuple
+from typing import List, Dict, Tuple, Iterator
+from collections import namedtuple, OrderedDict
 from asyncio import run, get_event_loop
+from threading import Lock, Thread
+from queue import Queue, Empty
+from concurrent.futures import Future
+from time import monotonic
 import sqlalchemy
-from .config import DATABASE
+from .config import (
+    DATABASE,
+    AUTHCACHETTL,
+    WRITEBUFFER,
+    WRITEBUFFERSIZE,
+    WRITEBUFFERLATENCY,
+)
 from .items import Item
+from .bloodalcohol import blood_alcohol
+from .periodcache import period_cache
+from . import metrics
 
 
 User = namedtuple('User', ['nickname', 'akaflieg_id', 'chat_id'])
@@ -31,7 +44,11 @@ consumptions = sqlalchemy.Table(
     sqlalchemy.Column('timestamp', sqlalchemy.Integer),
     sqlalchemy.Column('item_name', sqlalchemy.String),
     sqlalchemy.Column('item_price_at_this_time', sqlalchemy.Float),
-    sqlalchemy.Column('gram_alcohol', sqlalchemy.Integer),
+    # Double precision, the catalog has fractions like 16.5 and the
+    # blood alcohol cache must see the same value as a replay
+    sqlalchemy.Column('gram_alcohol', sqlalchemy.Float(precision=53)),
+    # Set by the caller to make retried inserts harmless
+    sqlalchemy.Column('idempotency_key', sqlalchemy.String(64)),
 )
 
 users = sqlalchemy.Table(
@@ -45,56 +62,482 @@ users = sqlalchemy.Table(
     sqlalchemy.Column('weight', sqlalchemy.Integer)
 )
 
-metadata.create_all(_db)
+# Idempotency keys of reverted consumptions, a redelivered update
+# must not book the drink again.
+reverted_consumptions = sqlalchemy.Table(
+    'reverted_consumptions',
+    metadata,
+    sqlalchemy.Column('idempotency_key', sqlalchemy.String(64), primary_key=True),
+    sqlalchemy.Column('reverted_at', sqlalchemy.Integer),
+)
+
+# Rollup of consumptions per user, month, item and price.
+# Maintained in the same transaction as every change of consumptions,
+# the month is the local calendar month like in datecalculation.
+consumption_monthly_totals = sqlalchemy.Table(
+    'consumption_monthly_totals',
+    metadata,
+    sqlalchemy.Column('akaflieg_id', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('year', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('month', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('item_name', sqlalchemy.String(100), primary_key=True),
+    # Cents, a float key never matches on backends with single precision
+    sqlalchemy.Column('price_cents', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('count', sqlalchemy.Integer),
+)
+
+# Access paths of the consumptions table, created by the migrations
+# in migrations.py for databases that existed before them.
+# Per user time ranges (history, statistics, promille) and akaflieg_id changes
+ix_consumptions_akaflieg_id_timestamp = sqlalchemy.Index(
+    'ix_consumptions_akaflieg_id_timestamp',
+    consumptions.c.akaflieg_id,
+    consumptions.c.timestamp,
+)
+# Global time ranges (monthly invoice)
+ix_consumptions_timestamp_akaflieg_id = sqlalchemy.Index(
+    'ix_consumptions_timestamp_akaflieg_id',
+    consumptions.c.timestamp,
+    consumptions.c.akaflieg_id,
+)
+# NULL keys are not unique on every supported backend
+ux_consumptions_idempotency_key = sqlalchemy.Index(
+    'ux_consumptions_idempotency_key',
+    consumptions.c.idempotency_key,
+    unique=True,
+)
+
+# Compact in-memory copy of one row of the users table
+UserRow = namedtuple('UserRow', users.columns.keys())
+
+# Result of entering a consumption. new is False if the idempotency key
+# was booked before, rowid is then the existing row, or None if that
+# consumption has been reverted.
+Booking = namedtuple('Booking', ['rowid', 'new'])
+
+# Telegram stops redelivering an update after a day
+TOMBSTONE_AGE = 7 * 24 * 3600
+
+# Marks a Consumer whose row has not been loaded yet
+_NOT_LOADED = object()
+
+
+def _user_row_query():
+    return sqlalchemy.select(list(users.columns))
 
 
 class ConsumptionEntry:
-    def __init__(self, timestamp: int, item_name: str, price_at_time: float, gram_alcohol: int = 0):
+    def __init__(self, timestamp: int, item_name: str, price_at_time: float, gram_alcohol: float = 0, rowid: int = None):
         self.timestamp = timestamp
         self.item_name = item_name
         self.price_at_time= price_at_time
         self.gram_alcohol = gram_alcohol
+        self.rowid = rowid
 
     @property
     def datetime(self) -> datetime:
         return datetime.fromtimestamp(self.timestamp)
 
 
+def _month_of(timestamp) -> Tuple[int, int]:
+    d = datetime.fromtimestamp(timestamp)
+    return d.year, d.month
+
+
+def _cents(price: float) -> int:
+    return int(round(price * 100))
+
+
+def _monthly_total_key(akaflieg_id, timestamp, item_name, price):
+    """Returns the key columns of a rollup row and a where clause for it."""
+    year, month = _month_of(timestamp)
+    t = consumption_monthly_totals
+    values = dict(
+        akaflieg_id=akaflieg_id,
+        year=year,
+        month=month,
+        item_name=item_name,
+        price_cents=_cents(price),
+    )
+    key = sqlalchemy.and_(*[
+        t.c[name] == value for name, value in values.items()
+    ])
+    return values, key
+
+
+def _monthly_total_upsert(dialect_name: str, values: dict, delta: int):
+    """
+    Insert of a rollup row that adds delta to an existing one instead,
+    None for backends without such a statement (SQLite before 3.24, and
+    SQLAlchemy 1.3 has none for SQLite). SQLite locks the whole database
+    for a write transaction, there an update and, if it found no row,
+    an insert can not race with another writer.
+    """
+    t = consumption_monthly_totals
+    if dialect_name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(t).values(count=delta, **values).on_conflict_do_update(
+            index_elements=[c.name for c in t.primary_key.columns],
+            set_=dict(count=t.c.count + delta),
+        )
+    if dialect_name == 'mysql':
+        from sqlalchemy.dialects.mysql import insert
+        return insert(t).values(count=delta, **values).on_duplicate_key_update(
+            count=t.c.count + delta,
+        )
+    return None
+
+
+def _change_monthly_total(con, akaflieg_id, timestamp, item_name, price, delta: int):
+    t = consumption_monthly_totals
+    values, key = _monthly_total_key(akaflieg_id, timestamp, item_name, price)
+
+    if delta > 0:
+        upsert = _monthly_total_upsert(con.dialect.name, values, delta)
+        if upsert is not None:
+            con.execute(upsert)
+            return
+    res = con.execute(t.update().where(key).values(count=t.c.count + delta))
+    if res.rowcount == 0 and delta > 0:
+        con.execute(t.insert().values(count=delta, **values))
+    elif delta < 0:
+        con.execute(t.delete().where(sqlalchemy.and_(key, t.c.count <= 0)))
+
+
+def _aggregate_monthly_totals(con, akaflieg_ids: List[int] = None) -> Dict[tuple, int]:
+    """Recount the rollup from the raw consumptions, streamed in chunks."""
+    query = sqlalchemy.select([
+        consumptions.c.akaflieg_id,
+        consumptions.c.timestamp,
+        consumptions.c.item_name,
+        consumptions.c.item_price_at_this_time,
+    ])
+    if akaflieg_ids is not None:
+        query = query.where(consumptions.c.akaflieg_id.in_(akaflieg_ids))
+
+    totals = {
+        # (akaflieg_id, year, month, item_name, price): count
+    }
+    rr = con.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = rr.fetchmany(1000)
+        if not rows:
+            return totals
+        for akaflieg_id, timestamp, item_name, price in rows:
+            key = (akaflieg_id,) + _month_of(timestamp) + (item_name, _cents(price))
+            totals[key] = totals.get(key, 0) + 1
+
+
+def _rebuild_monthly_totals(con, akaflieg_ids: List[int] = None):
+    """Rebuild consumption_monthly_totals from consumptions."""
+    t = consumption_monthly_totals
+    totals = _aggregate_monthly_totals(con, akaflieg_ids)
+
+    delete = t.delete()
+    if akaflieg_ids is not None:
+        delete = delete.where(t.c.akaflieg_id.in_(akaflieg_ids))
+    con.execute(delete)
+
+    if totals:
+        con.execute(t.insert(), [
+            dict(
+                akaflieg_id=akaflieg_id,
+                year=year,
+                month=month,
+                item_name=item_name,
+                price_cents=price_cents,
+                count=count,
+            )
+            for (akaflieg_id, year, month, item_name, price_cents), count in totals.items()
+        ])
+
+
+def _consumption_values(akaflieg_id, item: Item, consumption_time=None, idempotency_key=None) -> dict:
+    if consumption_time is None:
+        # The column is an Integer, keep the value as it is stored
+        consumption_time = int(time())
+
+    return dict(
+        akaflieg_id=akaflieg_id,
+        timestamp=consumption_time,
+        item_name=item.name,
+        item_price_at_this_time=item.price,
+        gram_alcohol=item.alcohol,
+        idempotency_key=idempotency_key,
+    )
+
+
+def _is_reverted(con, idempotency_key: str) -> bool:
+    query = sqlalchemy.select([reverted_consumptions.c.idempotency_key]).where(
+        reverted_consumptions.c.idempotency_key == idempotency_key
+    )
+    return con.execute(query).first() is not None
+
+
+def _insert_consumption(con, values: dict) -> Booking:
+    if values.get('idempotency_key') is not None and _is_reverted(con, values['idempotency_key']):
+        return Booking(None, False)
+    # Postgres gets the id with RETURNING, SQLite and MySQL
+    # from the cursor's lastrowid. Either way no second query.
+    res = con.execute(consumptions.insert().values(**values))
+    _change_monthly_total(
+        con,
+        values['akaflieg_id'],
+        values['timestamp'],
+        values['item_name'],
+        values['item_price_at_this_time'],
+        1,
+    )
+    return Booking(res.inserted_primary_key[0], True)
+
+
+def _consumption_id_by_key(con, idempotency_key: str) -> int:
+    query = sqlalchemy.select([consumptions.c.id]).where(
+        consumptions.c.idempotency_key == idempotency_key
+    )
+    return con.execute(query).scalar()
+
+
+def _enter_consumption(con, values: dict) -> Booking:
+    # Own transaction, a duplicate idempotency key returns the existing id
+    try:
+        with con.begin():
+            return _insert_consumption(con, values)
+    except sqlalchemy.exc.IntegrityError:
+        if values.get('idempotency_key') is None:
+            raise
+        rowid = _consumption_id_by_key(con, values['idempotency_key'])
+        if rowid is None:
+            raise
+        return Booking(rowid, False)
+
+
+class WriteBuffer:
+    """
+    Group commit for consumption inserts.
+    Callers from all handler threads block in submit() while a single
+    flusher thread writes their rows in one transaction, started after
+    max_rows rows or max_latency seconds, whichever comes first.
+    """
+    def __init__(self, max_rows: int, max_latency: float):
+        self.max_rows = max_rows
+        self.max_latency = max_latency
+        self._queue = Queue()
+        self._thread = None
+        self._thread_lock = Lock()
+
+        # Metrics
+        self.batches = 0
+        self.rows = 0
+        self.max_batch = 0
+        self.batch_sizes = {
+            # size: number of batches
+        }
+
+    def submit(self, values: dict) -> Booking:
+        """Returns the booking once the row is committed."""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((values, future))
+        return future.result()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self._queue.qsize(),
+            'batches': self.batches,
+            'rows': self.rows,
+            'mean_batch': self.rows / self.batches if self.batches else 0.0,
+            'max_batch': self.max_batch,
+            'batch_sizes': dict(self.batch_sizes),
+        }
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = Thread(
+                    target=self._run, name='consumption-writer', daemon=True
+                )
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = monotonic() + self.max_latency
+            while len(batch) < self.max_rows:
+                timeout = deadline - monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except Empty:
+                    break
+            self._flush(batch)
+
+    def _flush(self, batch):
+        self.batches += 1
+        self.rows += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+
+        try:
+            with _db.connect() as con:
+                try:
+                    with con.begin():
+                        bookings = [
+                            _insert_consumption(con, values)
+                            for values, _ in batch
+                        ]
+                except sqlalchemy.exc.IntegrityError:
+                    # One duplicate idempotency key aborts the whole
+                    # transaction, fall back to one transaction per row.
+                    for values, future in batch:
+                        try:
+                            future.set_result(_enter_consumption(con, values))
+                        except Exception as e:
+                            future.set_exception(e)
+                    return
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), booking in zip(batch, bookings):
+            future.set_result(booking)
+
+
+write_buffer = WriteBuffer(
+    max_rows=WRITEBUFFERSIZE,
+    max_latency=WRITEBUFFERLATENCY / 1000,
+)
+
+
 class Database:
     def __init__(self):
         pass
 
-    def enter_consumption(self, akaflieg_id: int, item: Item, consumption_time: int = None) -> int:
-        if consumption_time is None:
-            consumption_time = time()
-
-        query = consumptions.insert().values(
-            akaflieg_id=akaflieg_id,
-            timestamp=consumption_time,
-            item_name=item.name,
-            item_price_at_this_time=item.price,
-            gram_alcohol=item.alcohol,
+    def enter_consumption(
+        self,
+        akaflieg_id: int,
+        item: Item,
+        consumption_time: int = None,
+        idempotency_key: str = None,
+    ) -> Booking:
+        """
+        Insert a consumption and return its id.
+        Entering the same idempotency_key twice returns the id of the
+        first entry instead of booking the item again, or None if that
+        entry has been reverted.
+        """
+        values = _consumption_values(
+            akaflieg_id, item, consumption_time, idempotency_key
         )
 
-        id_query = consumptions.select(consumptions.c.id).where(
-            consumptions.c.akaflieg_id == akaflieg_id
-        ).order_by(
-            consumptions.c.timestamp.desc()
-        ).limit(1)
+        if WRITEBUFFER:
+            booking = write_buffer.submit(values)
+        else:
+            with _db.connect() as con:
+                booking = _enter_consumption(con, values)
 
-        with _db.connect() as con:
-            with con.begin():
-                con.execute(query)
-                res = con.execute(id_query)
-                for line in res:
-                    return line['id']
+        if booking.new:
+            # Committed, cached statistics of the period are outdated
+            period_cache.invalidate(akaflieg_id, values['timestamp'])
+        return booking
 
     def remove_consumption(self, rowid: int):
+        row_query = sqlalchemy.select([
+            consumptions.c.akaflieg_id,
+            consumptions.c.timestamp,
+            consumptions.c.item_name,
+            consumptions.c.item_price_at_this_time,
+            consumptions.c.idempotency_key,
+        ]).where(
+            consumptions.c.id == rowid
+        )
         query = consumptions.delete().where(
             consumptions.c.id == rowid
         )
+        now = int(time())
         with _db.connect() as con:
-            con.execute(query)
+            with con.begin():
+                row = con.execute(row_query).first()
+                if row is None:
+                    return
+                con.execute(query)
+                _change_monthly_total(
+                    con,
+                    row['akaflieg_id'],
+                    row['timestamp'],
+                    row['item_name'],
+                    row['item_price_at_this_time'],
+                    -1,
+                )
+                if row['idempotency_key'] is not None:
+                    con.execute(reverted_consumptions.delete().where(
+                        reverted_consumptions.c.reverted_at < now - TOMBSTONE_AGE
+                    ))
+                    con.execute(reverted_consumptions.insert().values(
+                        idempotency_key=row['idempotency_key'],
+                        reverted_at=now,
+                    ))
+        period_cache.invalidate(row['akaflieg_id'], row['timestamp'])
+
+    def get_monthly_totals(self, year: int, month: int) -> Dict[int, Dict[str, Dict[str, float]]]:
+        """Same shape as get_consumption_dictionary, read from the rollup."""
+        t = consumption_monthly_totals
+        query = sqlalchemy.select([
+            t.c.akaflieg_id,
+            t.c.item_name,
+            t.c.price_cents,
+            t.c.count,
+        ]).where(
+            sqlalchemy.and_(
+                t.c.year == year,
+                t.c.month == month,
+                t.c.count > 0,
+            )
+        )
+        with _db.connect() as con:
+            with con.begin():
+                rr = con.execute(query)
+
+                res = {}
+                for akaflieg_id, item_name, price_cents, count in rr:
+                    entry = res.setdefault(akaflieg_id, {}).setdefault(
+                        item_name, {'count': 0, 'sum': 0.0}
+                    )
+                    entry['count'] += count
+                    entry['sum'] = round(entry['sum'] + count * price_cents / 100, 2)
+                return res
+
+    def reconcile_monthly_totals(self, fix: bool = False) -> List[Tuple[tuple, int, int]]:
+        """
+        Compare the rollup with the raw consumptions.
+        Returns (key, expected count, rollup count) for every difference,
+        keys are (akaflieg_id, year, month, item_name, price_cents),
+        and rebuilds the rollup if fix is set.
+        """
+        t = consumption_monthly_totals
+        with _db.connect() as con:
+            with con.begin():
+                expected = _aggregate_monthly_totals(con)
+                actual = {
+                    tuple(r[:5]): r[5] for r in con.execute(sqlalchemy.select([
+                        t.c.akaflieg_id, t.c.year, t.c.month,
+                        t.c.item_name, t.c.price_cents, t.c.count,
+                    ]))
+                }
+
+                differences = [
+                    (key, expected.get(key, 0), actual.get(key, 0))
+                    for key in sorted(set(expected) | set(actual), key=str)
+                    if expected.get(key, 0) != actual.get(key, 0)
+                ]
+                if differences and fix:
+                    _rebuild_monthly_totals(con)
+                return differences
 
     def create_user(self, chat_id):
         query = users.insert().values(
@@ -104,12 +547,12 @@ class Database:
             con.execute(query)
     
     def get_unauthorized_chat_ids(self) -> List[int]:
-        query = users.select(user.c.chat_id).where(
+        query = sqlalchemy.select([users.c.chat_id]).where(
             users.c.akaflieg_id == None
         )
         with _db.connect() as con:
             with con.begin():
-                res = con.execute(query)
+                rr = con.execute(query)
 
                 res = [
                     r[0] for r in rr
@@ -117,63 +560,125 @@ class Database:
                 return res
 
     def get_consumer_list(self) -> List['Consumer']:
-        query = sqlalchemy.select([users.c.chat_id])
+        query = _user_row_query()
 
         with _db.connect() as con:
             with con.begin():
                 rr = con.execute(query)
 
                 res = [
-                    Consumer(r['chat_id']) for r in rr
+                    Consumer(r['chat_id'], UserRow(*r)) for r in rr
                 ]
                 res = sorted(res, key=lambda x: x.nickname)
                 return res
     
-    def get_consumption_dictionary(
-        self,
-        from_timestamp: int = 0,
-        to_timestamp: int = None
-    ) -> Dict[int, Dict[str, Dict[str, int]]]:
-
+    def _consumption_totals_query(self, from_timestamp: int, to_timestamp: int):
         if to_timestamp is None:
             to_timestamp = int(time() + 10000)
 
-        query = sqlalchemy.select([
+        return sqlalchemy.select([
             consumptions.c.akaflieg_id,
             consumptions.c.item_name,
-            consumptions.c.item_price_at_this_time,
+            sqlalchemy.func.count().label('count'),
+            sqlalchemy.func.sum(consumptions.c.item_price_at_this_time).label('sum'),
         ]).where(
             sqlalchemy.and_(
                 consumptions.c.timestamp >= from_timestamp,
                 consumptions.c.timestamp < to_timestamp
             )
+        ).group_by(
+            consumptions.c.akaflieg_id,
+            consumptions.c.item_name,
         )
+
+    def iter_consumption_totals(
+        self,
+        from_timestamp: int = 0,
+        to_timestamp: int = None,
+        chunk_size: int = 500,
+    ) -> Iterator[Tuple[int, str, int, float]]:
+        """Yields (akaflieg_id, item_name, count, sum) per user and item."""
+        query = self._consumption_totals_query(from_timestamp, to_timestamp)
+
         with _db.connect() as con:
             with con.begin():
-                rr = con.execute(query)
+                rr = con.execution_options(stream_results=True).execute(query)
+                while True:
+                    rows = rr.fetchmany(chunk_size)
+                    if not rows:
+                        return
+                    for row in rows:
+                        yield (
+                            row['akaflieg_id'],
+                            row['item_name'],
+                            row['count'],
+                            row['sum'] or 0.0,
+                        )
 
-                res = {}
-                # res= {2203: {'Bier 0,33L': {'count': 5, 'sum': 5.0}, 'Stilles Wasser': {'count': 2, 'sum': 0.8}}}
-                for row in rr:
-                    akaflieg_id, item_identifier, item_price_at_this_time = row['akaflieg_id'], row['item_name'], row['item_price_at_this_time']
-                    res[akaflieg_id] = res.get(akaflieg_id, {})
-                    res[akaflieg_id][item_identifier] = res[akaflieg_id].get(
-                        item_identifier, {'count': 0, 'sum': 0}
-                    )
-                    res[akaflieg_id][item_identifier]['count'] += 1
-                    res[akaflieg_id][item_identifier]['sum'] += item_price_at_this_time
-                return res
+    def get_consumption_dictionary(
+        self,
+        from_timestamp: int = 0,
+        to_timestamp: int = None
+    ) -> Dict[int, Dict[str, Dict[str, int]]]:
+        res = {}
+        # res= {2203: {'Bier 0,33L': {'count': 5, 'sum': 5.0}, 'Stilles Wasser': {'count': 2, 'sum': 0.8}}}
+        totals = self.iter_consumption_totals(from_timestamp, to_timestamp)
+        for akaflieg_id, item_name, count, sum_ in totals:
+            res.setdefault(akaflieg_id, {})[item_name] = {
+                'count': count,
+                'sum': sum_,
+            }
+        return res
+
+    def get_alcohol_consumptions(
+        self,
+        from_timestamp: int,
+    ) -> List[Tuple[int, str, int, int, float]]:
+        """
+        All alcoholic consumptions since from_timestamp of registered users
+        as (akaflieg_id, full_name, weight, timestamp, gram_alcohol),
+        ordered by user and time.
+        """
+        query = sqlalchemy.select([
+            consumptions.c.akaflieg_id,
+            users.c.full_name,
+            users.c.weight,
+            consumptions.c.timestamp,
+            consumptions.c.gram_alcohol,
+        ]).select_from(
+            consumptions.join(
+                users, users.c.akaflieg_id == consumptions.c.akaflieg_id
+            )
+        ).where(
+            sqlalchemy.and_(
+                consumptions.c.timestamp >= from_timestamp,
+                consumptions.c.gram_alcohol > 0,
+            )
+        ).order_by(
+            consumptions.c.akaflieg_id,
+            consumptions.c.timestamp,
+            consumptions.c.id,
+        )
+
+        with _db.connect() as con:
+            with con.begin():
+                return [
+                    # Same default weight as Consumer.weight
+                    (r[0], r[1], r[2] or 70, r[3], r[4])
+                    for r in con.execute(query)
+                ]
 
 
 class Consumer:
-    def __init__(self, chat_id):
+    def __init__(self, chat_id, row: UserRow = _NOT_LOADED):
         self.chat_id = int(chat_id)
         self.db = Database()
+        # None means the user does not exist in the database
+        self._row = row
 
     @classmethod
     def from_akaflieg_id(cls, akaflieg_id):
-        instance = cls(-1)
-        query = sqlalchemy.select([users.c.chat_id]).where(
+        query = _user_row_query().where(
             users.c.akaflieg_id == akaflieg_id
         )
         with _db.connect() as con:
@@ -181,23 +686,40 @@ class Consumer:
                 res = con.execute(query)
 
                 for line in res:
-                    instance.chat_id = int(line['chat_id'])
-                return instance
+                    row = UserRow(*line)
+                    return cls(row.chat_id, row)
+                return cls(-1, None)
 
-    
-    def _get(self, key):
+    def refresh(self) -> UserRow:
+        """Reload the whole users row with a single query."""
+        query = _user_row_query().where(
+            users.c.chat_id == self.chat_id
+        )
         with _db.connect() as con:
             with con.begin():
-                res = con.execute(
-                    sqlalchemy.select([getattr(users.c, key)]).where(
-                        users.c.chat_id == self.chat_id
-                    )
-                )
+                res = con.execute(query)
+
+                self._row = None
                 for line in res:
-                    return line[key]
-                return None
+                    self._row = UserRow(*line)
+                return self._row
+
+    def invalidate(self):
+        """Drop the snapshot, the next attribute access reloads it."""
+        self._row = _NOT_LOADED
+
+    @property
+    def snapshot(self) -> UserRow:
+        if self._row is _NOT_LOADED:
+            self.refresh()
+        return self._row
+
+    def _get(self, key):
+        row = self.snapshot
+        if row is None:
+            return None
+        return getattr(row, key)
 
-    
     def _set(self, key, value):
         with _db.connect() as con:
             con.execute(
@@ -205,6 +727,11 @@ class Consumer:
                     users.c.chat_id == self.chat_id
                 ).values(**{key: value})
             )
+        self._write_through(**{key: value})
+
+    def _write_through(self, **values):
+        if self._row is not _NOT_LOADED and self._row is not None:
+            self._row = self._row._replace(**values)
 
     @property
     def nickname(self) -> str:
@@ -234,34 +761,42 @@ class Consumer:
     def nickname(self, value):
         self._set('nickname', value)
 
-    
-    def _async_id_change(self, value, old_akaflieg_id):
-        with _database_pool.transaction():
-            _database_pool.execute(
-                'UPDATE item_consumption SET akaflieg_id = :new WHERE akaflieg_id = :old',
-                {'new': int(value), 'old': int(old_akaflieg_id)}
-            )
 
     @akaflieg_id.setter
     def akaflieg_id(self, value):
-        old_akaflieg_id = self._get('akaflieg_id')
-
-        query_set_new_id = users.update().values(
-            akaflieg_id=int(value)
-        ).where(
+        # Read the old id inside the transaction, a stale snapshot
+        # must never decide which consumptions get moved.
+        query_old_id = sqlalchemy.select([users.c.akaflieg_id]).where(
             users.c.chat_id == self.chat_id
         )
-        query_change_ids_in_consumptions = consumptions.update().values(
+        query_set_new_id = users.update().values(
             akaflieg_id=int(value)
         ).where(
-            consumptions.c.akaflieg_id == old_akaflieg_id
+            users.c.chat_id == self.chat_id
         )
 
         with _db.connect() as con:
             with con.begin():
+                old_akaflieg_id = con.execute(query_old_id).scalar()
                 con.execute(query_set_new_id)
-                con.execute(query_change_ids_in_consumptions)
+                con.execute(
+                    consumptions.update().values(
+                        akaflieg_id=int(value)
+                    ).where(
+                        consumptions.c.akaflieg_id == old_akaflieg_id
+                    )
+                )
+                # The history of a re-added user merges with the old one
+                _rebuild_monthly_totals(con, [
+                    i for i in (int(value), old_akaflieg_id) if i is not None
+                ])
                 # commits here
+        self._write_through(akaflieg_id=int(value))
+        blood_alcohol.invalidate(old_akaflieg_id)
+        blood_alcohol.invalidate(int(value))
+        if old_akaflieg_id is not None:
+            period_cache.invalidate(old_akaflieg_id)
+        period_cache.invalidate(int(value))
     
     @full_name.setter
     def full_name(self, value):
@@ -275,27 +810,26 @@ class Consumer:
             s += '{} '.format(getattr(user, 'first_name'))
         if getattr(user, 'last_name', None):
             s += '{}'.format(getattr(user, 'last_name'))
+        if self._get('telegram_names') == s.strip():
+            return
         self._set('telegram_names', s.strip())
 
-    def consume(self, item: Item) -> int:
-        return self.db.enter_consumption(self.akaflieg_id, item)
+    def consume(self, item: Item, idempotency_key: str = None) -> Booking:
+        consumption_time = int(time())
+        booking = self.db.enter_consumption(
+            self.akaflieg_id, item, consumption_time, idempotency_key
+        )
+        if booking.new:
+            blood_alcohol.record(self.akaflieg_id, booking.rowid, consumption_time, item.alcohol)
+        return booking
 
     def unconsume(self, rowid: int):
-        return self.db.remove_consumption(rowid)
+        self.db.remove_consumption(rowid)
+        blood_alcohol.forget(self.akaflieg_id, rowid)
     
     
     def user_exists(self) -> bool:
-        query = sqlalchemy.select([users.c.chat_id]).where(
-            users.c.chat_id == int(self.chat_id)
-        )
-        with _db.connect() as con:
-            with con.begin():
-                res = con.execute(query)
-                for line in res:
-                    return True
-                return False
-
-        
+        return self.snapshot is not None
 
     def is_authorized(self) -> bool:
         value = self._get('akaflieg_id')
@@ -303,74 +837,164 @@ class Consumer:
 
     def create(self):
         self.db.create_user(self.chat_id)
+        self.invalidate()
 
     
     def delete(self):
         query = users.delete().where(
-            chat_id=self.chat_id
+            users.c.chat_id == self.chat_id
         )
         with _db.connect() as con:
             con.execute(query)
+        self._row = None
 
     def get_consumption_history(self, from_timestamp: int = 0, to_timestamp: int = None) -> List[ConsumptionEntry]:
+        return list(self.iter_consumption_history(from_timestamp, to_timestamp))
+
+    def iter_consumption_history(
+        self,
+        from_timestamp: int = 0,
+        to_timestamp: int = None,
+        chunk_size: int = 500,
+    ) -> Iterator[ConsumptionEntry]:
+        """Like get_consumption_history, but reads the rows in chunks."""
         if to_timestamp is None:
             to_timestamp = int(time() + 10000)
-        
-        query = query = sqlalchemy.select([
+
+        query = sqlalchemy.select([
             consumptions.c.timestamp,
             consumptions.c.item_name,
             consumptions.c.item_price_at_this_time,
             consumptions.c.gram_alcohol,
+            consumptions.c.id,
         ]).where(
             sqlalchemy.and_(
                 consumptions.c.akaflieg_id == self.akaflieg_id,
                 consumptions.c.timestamp >= from_timestamp,
                 consumptions.c.timestamp < to_timestamp,
             )
-        )
+        ).order_by(consumptions.c.timestamp, consumptions.c.id)
 
         with _db.connect() as con:
             with con.begin():
-                res = con.execute(query)
+                rr = con.execution_options(stream_results=True).execute(query)
+                while True:
+                    rows = rr.fetchmany(chunk_size)
+                    if not rows:
+                        return
+                    for r in rows:
+                        yield ConsumptionEntry(r[0], r[1], r[2], r[3], r[4])
+
+
+# Authorization state per chat id, so that known users
+# do not cost a database query per message.
+_AUTHORIZED = 'authorized'
+_PENDING = 'pending'  # in the database but without Akaflieg ID
+
+# chat_id: (state, expires_at), in order of expiry as all entries have
+# the same TTL. Only changed while holding _authorization_lock.
+_authorization_cache: 'OrderedDict[int, Tuple[str, float]]' = OrderedDict()
+_authorization_lock = metrics.TimedLock('authorization') if metrics.ENABLED else Lock()
+
+
+def _cached_authorization(chat_id: int):
+    entry = _authorization_cache.get(chat_id)
+    if entry is None:
+        return None
+    state, expires_at = entry
+    if expires_at < time():
+        return None
+    return state
+
+
+def invalidate_authorization(chat_id=None):
+    """Forget the cached authorization state of one chat or of all chats."""
+    # Waits for a lookup that would store the old state afterwards
+    with _authorization_lock:
+        if chat_id is None:
+            _authorization_cache.clear()
+        else:
+            _authorization_cache.pop(int(chat_id), None)
+
+
+def _evict_expired_authorizations(now: float):
+    """Drop expired entries, chats that never write again would stay forever."""
+    while _authorization_cache:
+        chat_id, (_, expires_at) = next(iter(_authorization_cache.items()))
+        if expires_at >= now:
+            return
+        del _authorization_cache[chat_id]
+
+
+def _lookup_authorization(chat_id, user):
+    """Query (and if needed create) the user, must hold _authorization_lock."""
+    client = Consumer(chat_id)
+
+    newly_registered = False
+    if not client.user_exists():
+        client.create()
+        newly_registered = True
 
-                result = []
-                for r in res:
-                    result.append(
-                        ConsumptionEntry(r[0], r[1], r[2], r[3])
-                    )
-                return result
+    state = _AUTHORIZED if client.is_authorized() else _PENDING
+    if state == _PENDING:
+        client.set_telegram_names(user)
 
+    now = time()
+    _evict_expired_authorizations(now)
+    # Move to the end, the order stays the order of expiry
+    _authorization_cache.pop(chat_id, None)
+    _authorization_cache[chat_id] = (state, now + AUTHCACHETTL)
+    return state, newly_registered
 
-# must be decorated manually
-def is_authorized(respond, chat_id, username, first_name, last_name, user):
-    client = Consumer(int(chat_id))
+
+def _notify_admin_of_new_user(chat_id, username, first_name, last_name):
+    from .administration import send_admin_message
 
     def none_str(t):
         if t is None:
             return '[nicht gesetzt]'
         return str(t)
 
-    if not client.user_exists():
-        from .administration import send_admin_message
-        reply_markup = InlineKeyboardMarkup([
-            [InlineKeyboardButton('Diesen Nutzer commiten', callback_data='commit_{}'.format(chat_id))]
-        ])
-        send_admin_message(
-            'Ein neuer Nutzer hat sich gemeldet.\n'
-            'Nutzername: {}, Vorname: {}, Nachname: {}.\n'
-            'Die Chat ID lautet {}.\n'
-            'Bestätige den Nutzer durch hinzufügen einer Akaflieg ID '
-            'mit dem Befehl /commit.'
-            .format(
-                none_str(username),
-                none_str(first_name),
-                none_str(last_name),
-                chat_id,
-            ),
-            reply_markup=reply_markup
-        )
-        client.create()
-        client.set_telegram_names(user)
+    reply_markup = InlineKeyboardMarkup([
+        [InlineKeyboardButton('Diesen Nutzer commiten', callback_data='commit_{}'.format(chat_id))]
+    ])
+    send_admin_message(
+        'Ein neuer Nutzer hat sich gemeldet.\n'
+        'Nutzername: {}, Vorname: {}, Nachname: {}.\n'
+        'Die Chat ID lautet {}.\n'
+        'Bestätige den Nutzer durch hinzufügen einer Akaflieg ID '
+        'mit dem Befehl /commit.'
+        .format(
+            none_str(username),
+            none_str(first_name),
+            none_str(last_name),
+            chat_id,
+        ),
+        reply_markup=reply_markup
+    )
+
+
+# must be decorated manually
+def is_authorized(respond, chat_id, username, first_name, last_name, user):
+    chat_id = int(chat_id)
+    state = _cached_authorization(chat_id)
+    newly_registered = False
+
+    if state is None:
+        with _authorization_lock:
+            # Another message of this chat might have filled the cache meanwhile
+            state = _cached_authorization(chat_id)
+            if state is None:
+                state, newly_registered = _lookup_authorization(chat_id, user)
+
+    if newly_registered:
+        # Outside the lock, the authorization of other chats does not wait for it
+        _notify_admin_of_new_user(chat_id, username, first_name, last_name)
+
+    if state == _AUTHORIZED:
+        return True
+
+    if newly_registered:
         respond(
             'Deine Nachricht wurde ignoriert!\n'
             'Du bist noch nicht in der Datenbank.\n'
@@ -379,17 +1003,12 @@ def is_authorized(respond, chat_id, username, first_name, last_name, user):
         )
         return False
 
-    if not client.is_authorized():
-        respond(
-            'Deine Nachricht wurde ignoriert, weil du '
-            'noch nicht in der Datenbank bist.\n\n'
-            'Der Kassenwart weiß bescheid, du kannst ihn '
-            'aber auch nochmal kontaktieren.\n'
-            'Hierbei könnte deine Chat ID  helfen: {}.'
-            .format(chat_id)
-        )
-        client.set_telegram_names(user)
-        return False
-
-    return True
-
+    respond(
+        'Deine Nachricht wurde ignoriert, weil du '
+        'noch nicht in der Datenbank bist.\n\n'
+        'Der Kassenwart weiß bescheid, du kannst ihn '
+        'aber auch nochmal kontaktieren.\n'
+        'Hierbei könnte deine Chat ID  helfen: {}.'
+        .format(chat_id)
+    )
+    return False
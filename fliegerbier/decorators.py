@@ -1,12 +1,26 @@
 import telegram
 import telegram.ext
 from io import BytesIO
+from asyncio import iscoroutinefunction
+from concurrent.futures import Future
+from contextlib import nullcontext
+from functools import cached_property
+from inspect import signature
+from threading import local
+from time import perf_counter
+from . import aio
+from . import metrics
+from . import tracing
+from . import slowquery
+from . import profiling
 from .config import ADMINCHAT
 from .database import is_authorized
+from .outbox import outbox
 from .log import (
     log_incoming_message,
     log_incoming_callback,
     log_incoming_voice,
+    log_incoming_other,
     log_response,
 )
 
@@ -17,63 +31,106 @@ def _custom_markdown_escape(txt, escapes):
     return txt
 
 
-def _respond(context, chat_id, from_user, delete_me):
+def _sender(context, chat_id, from_user, delete_me):
+    """
+    Returns send(txt, **f_kwargs) -> (future, finish). The outbox
+    future resolves to the sent message, finish(message) must be
+    called with it afterwards and returns it.
+    """
     def do_deletion():
         while delete_me:
             msg_id = delete_me.pop()
-            try:
-                context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except telegram.TelegramError:
-                pass
+            outbox.submit(
+                chat_id, context.bot.delete_message, retry=True,
+                chat_id=chat_id, message_id=msg_id
+            )
 
-    
-    def f(txt, **f_kwargs):
+    def send(txt, **f_kwargs):
         do_delete = True
         if f_kwargs.get('do_delete') is not None:
             do_delete = f_kwargs.pop('do_delete')
+
+        def finish(m, log=False):
+            if log:
+                log_response(m, from_user)
+            if do_delete:
+                do_deletion()
+            return m
+
         if f_kwargs.get('photo'):
             photo = f_kwargs.get('photo')
-            m = context.bot.send_photo(
+            m = outbox.submit(
+                chat_id, context.bot.send_photo,
                 chat_id=chat_id,
                 photo=photo,
                 caption=txt[:1024]
             )
-            if do_delete:
-                do_deletion()
-            return m
+            return m, finish
         if f_kwargs.get('file'):
             document = f_kwargs.get('file')
-            m = context.bot.send_document(
+            m = outbox.submit(
+                chat_id, context.bot.send_document,
                 chat_id=chat_id,
                 document=document,
+                filename=f_kwargs.get('filename'),
                 caption=txt[:1024]
             )
-            if do_delete:
-                do_deletion()
-            return m
+            return m, finish
         # TODO Audio
         # TODO Video
 
         if f_kwargs.get('escape_markdown', ''):
             txt = _custom_markdown_escape(txt, f_kwargs.pop('escape_markdown'))
 
-        res = context.bot.send_message(
+        res = outbox.submit(
+            chat_id, context.bot.send_message,
             chat_id=chat_id,
             text=txt,
             **f_kwargs)
-        log_response(res, from_user)
-        if do_delete:
-            do_deletion()
-        return res
+        return res, lambda m: finish(m, log=True)
+    return send
+
+
+def _respond(context, chat_id, from_user, delete_me):
+    """
+    Queues the message and returns at once, waiting for the chat's rate
+    limit would stall the dispatcher for every other chat. The returned
+    Future resolves to the sent message.
+    """
+    send = _sender(context, chat_id, from_user, delete_me)
+
+    def f(txt, **f_kwargs):
+        future, finish = send(txt, **f_kwargs)
+        sent = Future()
+
+        def done(future):
+            try:
+                sent.set_result(finish(future.result()))
+            except Exception as e:
+                # Already reported by the outbox
+                sent.set_exception(e)
+        future.add_done_callback(done)
+        return sent
+    return f
+
+
+def _respond_async(context, chat_id, from_user, delete_me):
+    send = _sender(context, chat_id, from_user, delete_me)
+
+    async def f(txt, **f_kwargs):
+        future, finish = send(txt, **f_kwargs)
+        return finish(await aio.wait_for(future))
     return f
 
 
+# Edits and deletions do not wait for the Bot API,
+# failures are reported by the outbox.
 def _delete(context, chat_id):
     def f(message_id):
-        try:
-            context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except telegram.TelegramError:
-            pass
+        outbox.submit(
+            chat_id, context.bot.delete_message, retry=True,
+            chat_id=chat_id, message_id=message_id
+        )
     return f
 
 
@@ -81,102 +138,296 @@ def _edit(context, chat_id):
     def f(message_id, new_text, **kwargs):
         if kwargs.get('escape_markdown', ''):
             new_text = _custom_markdown_escape(new_text, kwargs.pop('escape_markdown'))
-        try:
-            context.bot.edit_message_text(new_text, chat_id=chat_id, message_id=message_id, **kwargs)
-        except telegram.TelegramError:
-            pass
+        # Only the latest queued text of a message is sent
+        outbox.submit(
+            chat_id, context.bot.edit_message_text,
+            merge_key=('edit', chat_id, message_id), retry=True,
+            text=new_text, chat_id=chat_id, message_id=message_id, **kwargs
+        )
     return f
 
 
 def _commit_callback(context, callback_id):
+    # Not sent to a chat, only paced by the global rate
     def f(**kwargs):
-        context.bot.answer_callback_query(callback_id, **kwargs)
+        outbox.submit(
+            None, context.bot.answer_callback_query,
+            callback_query_id=callback_id, **kwargs
+        )
     return f
 
 
-def patch_telegram_action(old_function):
+class _UpdateContext:
+    """
+    The arguments patch_telegram_action can inject, built on first
+    use. One instance per update is shared by all nested wrappers.
+    """
+    def __init__(self, update, context):
+        self.update = update
+        self.context = context
+        self.logged = False
+        # Names of the patch_telegram_action wrappers running, innermost last
+        self.handlers = []
 
-    def new_function(update, context):
-        user = update._effective_user
-        name = update._effective_user.first_name
-        username = update._effective_user.username
+    @cached_property
+    def bot(self):
+        return self.context.bot
+
+    @cached_property
+    def user(self):
+        return self.update._effective_user
+
+    @cached_property
+    def name(self):
+        return self.user.first_name
+
+    @cached_property
+    def username(self):
+        return self.user.username
+
+    @cached_property
+    def first_name(self):
+        return getattr(self.user, 'first_name', None)
+
+    @cached_property
+    def last_name(self):
+        return getattr(self.user, 'last_name', None)
+
+    @cached_property
+    def chat_dict(self):
+        return self.context.chat_data
+
+    @cached_property
+    def delete_me(self):
+        if not self.chat_dict.get('_delete_me'):
+            self.chat_dict['_delete_me'] = []
+        return self.chat_dict['_delete_me']
+
+    @cached_property
+    def voice_stt(self):
+        return None
+
+    @cached_property
+    def message_id(self):
+        if self.update.message:
+            return self.update.message.message_id
+        return None
+
+    @cached_property
+    def text(self):
+        if self.update.message:
+            return self.update.message.text
+        return None
+
+    @cached_property
+    def chat_id(self):
+        if self.update.callback_query:
+            return self.update._effective_chat.id
+        if self.update.message:
+            return self.update.message.chat.id
+        return None
 
-        voice_stt = None
+    @cached_property
+    def original_message_id(self):
+        if self.update.callback_query:
+            return self.update.callback_query.message.message_id
+        return None
 
+    @cached_property
+    def callback_data(self):
+        if self.update.callback_query:
+            return self.update.callback_query.data
+        return None
+
+    @cached_property
+    def commit_callback(self):
+        if self.update.callback_query:
+            return _commit_callback(self.context, self.update.callback_query.id)
+        return None
+
+    @cached_property
+    def respond(self):
+        return _respond(self.context, self.chat_id, self.user, self.delete_me)
+
+    @cached_property
+    def respond_async(self):
+        return _respond_async(self.context, self.chat_id, self.user, self.delete_me)
+
+    @cached_property
+    def delete(self):
+        return _delete(self.context, self.chat_id)
+
+    @cached_property
+    def edit(self):
+        return _edit(self.context, self.chat_id)
+
+    def log_incoming(self):
+        if self.logged:
+            return
+        self.logged = True
+
+        update = self.update
         if update.message is not None:
-            log_incoming_message(user, update.message)
+            log_incoming_message(self.user, update.message)
         elif update.callback_query:
-            log_incoming_callback(user, update.callback_query)
+            log_incoming_callback(self.user, update.callback_query)
         else:
-            print('TODO')
-            print(update)
-
-        if not context.chat_data.get('_delete_me'):
-            context.chat_data['_delete_me'] = []
-
-        kwargs = {
-            'update': update,
-            'context': context,
-            'bot': context.bot,
-            'username': username,
-            'user': user,
-            'name': name,
-            'first_name': getattr(user, 'first_name', None),
-            'last_name': getattr(user, 'last_name', None),
-            'chat_dict': context.chat_data,
-            'delete_me': context.chat_data['_delete_me'],
-            'voice_stt': voice_stt,
-        }
-
-        if update.message:
-            kwargs['message_id'] = update.message.message_id
-            kwargs['text'] = update.message.text
-            kwargs['chat_id'] = update.message.chat.id
-            kwargs['text'] = update.message.text
-
-        if update.callback_query:
-            kwargs['original_message_id'] = update.callback_query.message.message_id
-            kwargs['commit_callback'] = _commit_callback(context, update.callback_query.id)
-            kwargs['callback_data'] = update.callback_query.data
-            kwargs['chat_id'] = update._effective_chat.id
-
-        kwargs['respond'] = _respond(
-            context,
-            kwargs['chat_id'],
-            user,
-            kwargs['delete_me'])
-        kwargs['delete'] = _delete(context, kwargs['chat_id'])
-        kwargs['edit'] = _edit(context, kwargs['chat_id'])
-
-        filtered_kwargs = {}
-        old_function_params = old_function.__code__.co_varnames[:old_function.__code__.co_argcount]
-
-        for key, value in kwargs.items():
-            if key in old_function_params:
-                filtered_kwargs[key] = value
-        res = old_function(**filtered_kwargs)
-        return res
+            log_incoming_other(update.effective_user, update)
+
+
+_current = local()
+
 
+def _get_update_context(update, context) -> _UpdateContext:
+    ctx = getattr(_current, 'ctx', None)
+    if ctx is None or ctx.update is not update:
+        ctx = _UpdateContext(update, context)
+        _current.ctx = ctx
+    return ctx
+
+
+def current_handler() -> str:
+    """
+    Innermost handler running in this thread, None outside of handlers.
+    Only tracked if metrics, tracing or the slow query log are enabled.
+    """
+    ctx = getattr(_current, 'ctx', None)
+    if ctx is None or not ctx.handlers:
+        return None
+    return ctx.handlers[-1]
+
+
+_injectable = {
+    name for name, value in vars(_UpdateContext).items()
+    if isinstance(value, cached_property)
+} | {'update', 'context'}
+
+
+def patch_telegram_action(old_function):
+    # Coroutine handlers need mode = asyncio and cannot
+    # return conversation states.
+    is_coroutine = iscoroutinefunction(old_function)
+
+    # (parameter, attribute of _UpdateContext), decided once
+    injected = []
+    for param in signature(old_function).parameters.values():
+        if param.name in _injectable:
+            attribute = param.name
+            if param.name == 'respond' and is_coroutine:
+                attribute = 'respond_async'
+            injected.append((param.name, attribute))
+        elif param.default is param.empty:
+            raise TypeError('{} takes {}, which patch_telegram_action can not provide'.format(
+                old_function.__name__, param.name
+            ))
+
+    def new_function(update, context):
+        ctx = _get_update_context(update, context)
+        ctx.log_incoming()
+
+        kwargs = {name: getattr(ctx, attribute) for name, attribute in injected}
+
+        if is_coroutine:
+            # Runs on the event loop, the dispatcher moves on to the next update
+            coro = old_function(**kwargs)
+            if metrics.ENABLED:
+                coro = _timed_coroutine(name, coro)
+            aio.submit(coro)
+            return None
+
+        if profiling.active:
+            return profiling.run(_call, name, ctx, old_function, kwargs)
+        if _INSTRUMENTED:
+            return _instrumented_call(name, ctx, old_function, kwargs)
+        return old_function(**kwargs)
+
+    name = old_function.__qualname__
+    new_function.__name__ = old_function.__name__
+    new_function.__qualname__ = name
     return new_function
 
 
+_INSTRUMENTED = metrics.ENABLED or tracing.ENABLED or slowquery.ENABLED
+
+
+def _call(name, ctx: _UpdateContext, f, kwargs):
+    if _INSTRUMENTED:
+        return _instrumented_call(name, ctx, f, kwargs)
+    return f(**kwargs)
+
+
+def _instrumented_call(name, ctx: _UpdateContext, f, kwargs):
+    """
+    Metrics and tracing around a handler. The outermost wrapper of an
+    update starts the trace, nested ones add spans to it.
+    """
+    outermost = not ctx.handlers
+    trace = None
+    if outermost:
+        if metrics.ENABLED:
+            metrics.handler_started()
+        if tracing.ENABLED:
+            trace = tracing.begin(name)
+        nested = nullcontext()
+    else:
+        nested = tracing.span(name)
+    ctx.handlers.append(name)
+    start = perf_counter()
+    try:
+        with nested:
+            return f(**kwargs)
+    except Exception:
+        if metrics.ENABLED:
+            metrics.handler_errors.inc(name)
+        raise
+    finally:
+        seconds = perf_counter() - start
+        ctx.handlers.pop()
+        if metrics.ENABLED:
+            metrics.handler_latency.observe(seconds, name)
+            if outermost:
+                metrics.handler_finished(seconds)
+        if trace is not None:
+            tracing.end(trace)
+
+
+async def _timed_coroutine(name, coro):
+    start = perf_counter()
+    try:
+        return await coro
+    except Exception:
+        metrics.handler_errors.inc(name)
+        raise
+    finally:
+        metrics.handler_latency.observe(perf_counter() - start, name)
+
+
+_is_authorized = patch_telegram_action(is_authorized)
+
+
+def _qualname(f) -> str:
+    return getattr(f, '__qualname__', repr(f))
+
+
 def requires_authorization(old_function):
+    # Patched itself, so the check and the handler run inside one
+    # update context and show up as one trace
     def f(update, context):
         if update.message.chat.id == ADMINCHAT:
             # Admin
             return old_function(update, context)
-        if patch_telegram_action(is_authorized)(update, context):
+        if _is_authorized(update, context):
             # Known User
             return old_function(update, context)
         else:
             # Authorization requested
             return telegram.ext.ConversationHandler.END
 
-    return f
+    f.__qualname__ = 'requires_authorization:' + _qualname(old_function)
+    return patch_telegram_action(f)
 
 
 def admin_only(old_function):
-    @patch_telegram_action
     def f(update, context, respond, chat_id):
         if chat_id == ADMINCHAT:
             res = old_function(update, context)
@@ -184,4 +435,6 @@ def admin_only(old_function):
         else:
             respond('Diese Funktion ist nur für Administratoren.')
             return telegram.ext.ConversationHandler.END
-    return f
+
+    f.__qualname__ = 'admin_only:' + _qualname(old_function)
+    return patch_telegram_action(f)
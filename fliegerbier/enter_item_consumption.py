@@ -1,90 +1,132 @@
 from .decorators import patch_telegram_action, requires_authorization
-from .items import Item, item_list
+from .items import Item
 from .database import Consumer
-from .config import REVERTTIME
+from .config import REVERTTIME, REVERTTICK, EXECUTIONMODE
+from . import aio
 from .emoji import emojis
-from time import time, sleep
+from .bloodalcohol import blood_alcohol
+from .scheduler import Scheduler
+from time import time
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from threading import Thread
+
+
+# One thread owns the countdowns of all open purchases
+revert_scheduler = Scheduler('revert-countdown')
+
+
+def _revert_markup(key: str, time_left: float) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(
+            'Rückgängig machen ({})'.format(
+                int(round(time_left))
+            ),
+            callback_data=key
+        )]
+    ])
+
+
+def _next_tick(consume_time: float, time_left: float) -> float:
+    # Next multiple of REVERTTICK seconds left, or the end of the window
+    next_left = (int(round(time_left)) - 1) // REVERTTICK * REVERTTICK
+    return consume_time + REVERTTIME - max(next_left, 0)
 
 
 def _revert_counter(
-    consume_time: int,
+    consume_time: float,
     text: str,
     message_id: int,
-    chat_dict: dict,
     key: str,
     edit
 ):
-    for _ in range(0, 1800):  # 1800 MAXIMUM
+    def tick():
         time_left = consume_time + REVERTTIME - time()
-        if time_left < 0:
+        if time_left <= 0:
             edit(message_id=message_id, new_text=text)
-            return
+            return None
+
+        edit(
+            message_id=message_id,
+            new_text=text,
+            reply_markup=_revert_markup(key, time_left)
+        )
+        return _next_tick(consume_time, time_left)
+    return tick
+
+
+def _open_revert_window(key, rowid, text, message_id, consume_time, chat_dict, edit):
+    chat_dict[key] = {
+        'message_id': message_id,
+        'text': text,
+        'consume_time': consume_time,
+        'rowid': rowid,
+    }
+    revert_scheduler.schedule(
+        key,
+        _next_tick(consume_time, REVERTTIME),
+        _revert_counter(
+            consume_time=consume_time,
+            text=text,
+            message_id=message_id,
+            key=key,
+            edit=edit,
+        )
+    )
 
-        sleep(time_left % 1)
 
-        if chat_dict.get(key, None) is None:
-            # expired or reverted
-            return
+def enter_item_consumption(item: Item):
+    # The item of the catalog the routes are built from, a reload
+    # in between must not change what the button books
+    def idempotency_key(chat_id, message_id):
+        # Telegram may deliver the same message twice
+        return 'tg_{}_{}'.format(chat_id, message_id)
 
-        try:
-            edit(message_id=message_id, new_text=text, reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(
-                    'Rückgängig machen ({})'.format(
-                        int(time_left)
-                    ),
-                    callback_data=key
-                )]
-            ]))
-        except KeyboardInterrupt:
-            # Message has been deleted
-            return
+    text = '{} Kauf von {} für {}€ eingetragen.'.format(
+        item.emoji, item.name, item.price
+    )
 
+    if EXECUTIONMODE == 'asyncio':
+        @patch_telegram_action
+        async def f(chat_id, message_id, respond, chat_dict, edit):
+            c = Consumer(chat_id, await aio.get_user_row(chat_id))
+            consumption_time = int(time())
+            booking = await aio.enter_consumption(
+                c.akaflieg_id, item, consumption_time,
+                idempotency_key=idempotency_key(chat_id, message_id)
+            )
+            if not booking.new:
+                # Booked and answered before, maybe reverted since
+                return
+            blood_alcohol.record(c.akaflieg_id, booking.rowid, consumption_time, item.alcohol)
 
+            key = 'revert_{}'.format(booking.rowid)
+            consume_time = time()
+            r = await respond(text, reply_markup=_revert_markup(key, REVERTTIME))
+            _open_revert_window(key, booking.rowid, text, r['message_id'], consume_time, chat_dict, edit)
 
-def enter_item_consumption(drink: str):
-    item: Item = None
-    for it in item_list:
-        if drink == it.button_text:
-            item = it
-    
-    if not item:
-        raise ValueError("Lookup of item failed: " + drink)
+        return f
 
     @patch_telegram_action
-    def f(chat_id, respond, chat_dict, edit):
+    def f(chat_id, message_id, respond, chat_dict, edit):
         c = Consumer(chat_id)
-        assert item
-        rowid = c.consume(item)
-
-        text = '{} Kauf von {} für {}€ eingetragen.'.format(
-            item.emoji, item.name, item.price
+        booking = c.consume(
+            item, idempotency_key=idempotency_key(chat_id, message_id)
         )
-        r = respond(text)
+        if not booking.new:
+            # Booked and answered before, maybe reverted since
+            return
 
+        rowid = booking.rowid
         key = 'revert_{}'.format(rowid)
+
         consume_time = time()
 
-        t = Thread(
-            target=_revert_counter,
-            kwargs=dict(
-                consume_time=consume_time,
-                text=text,
-                message_id=r['message_id'],
-                chat_dict=chat_dict,
-                key=key,
-                edit=edit,
-            )
-        )
-        chat_dict[key] = {
-            'thread': t,
-            'message_id': r['message_id'],
-            'text': text,
-            'consume_time': consume_time,
-            'rowid': rowid,
-        }
-        t.start()
+        def sent(future):
+            if future.exception() is None:
+                _open_revert_window(
+                    key, rowid, text, future.result()['message_id'],
+                    consume_time, chat_dict, edit,
+                )
+        respond(text, reply_markup=_revert_markup(key, REVERTTIME)).add_done_callback(sent)
 
     return f
 
@@ -104,7 +146,8 @@ def undo_consumption(callback_data, chat_id, edit, chat_dict, respond):
     del chat_dict[callback_data]
 
     too_late = (time() - revert_data['consume_time'] > REVERTTIME)
-    revert_data['thread'].join()
+    # Waits for a countdown edit that is just running
+    revert_scheduler.cancel(callback_data)
 
     if too_late:
         edit(
@@ -1,4 +1,8 @@
-from typing import List
+from typing import List, Mapping, Tuple
+from types import MappingProxyType
+from os.path import getmtime
+from threading import Lock
+from time import monotonic
 from .config import ITEMCSV
 from .emoji import emojis
 
@@ -27,7 +31,9 @@ class Item:
 
 def get_item_list():
     item_list: List[Item] = []
-    for line in open(ITEMCSV).readlines():
+    with open(ITEMCSV) as f:
+        lines = f.readlines()
+    for line in lines:
         line = line.replace('\n', '')
         if not line:
             continue
@@ -55,10 +61,69 @@ def get_item_list():
     return item_list
 
 
-item_list: List[Item] = get_item_list()
+class Catalog:
+    """Immutable snapshot of the items in ITEMCSV."""
+    __slots__ = ('items', 'by_button_text', 'by_name', 'version')
+
+    def __init__(self, items: List[Item], version: int):
+        self.items: Tuple[Item, ...] = tuple(items)
+        self.by_button_text: Mapping[str, Item] = MappingProxyType(
+            {item.button_text: item for item in items}
+        )
+        self.by_name: Mapping[str, Item] = MappingProxyType(
+            {item.name: item for item in items}
+        )
+        self.version = version
+
+
+# Seconds between two checks of the mtime of ITEMCSV
+CHECK_INTERVAL = 1.0
+
+_mtime = getmtime(ITEMCSV)
+_catalog: Catalog = Catalog(get_item_list(), 1)
+_checked_at = monotonic()
+_reload_lock = Lock()
 
-def reload_item_list():
-    global item_list
-    item_list = get_item_list()
 
+def get_catalog() -> Catalog:
+    """
+    The current catalog, reloaded when ITEMCSV changed. Do not keep it
+    around, call this again for every update.
+    """
+    if monotonic() - _checked_at > CHECK_INTERVAL:
+        _check_for_changes()
+    return _catalog
 
+
+def _check_for_changes():
+    global _checked_at
+    with _reload_lock:
+        if monotonic() - _checked_at <= CHECK_INTERVAL:
+            # Another thread just checked
+            return
+        _checked_at = monotonic()
+        try:
+            mtime = getmtime(ITEMCSV)
+        except OSError as e:
+            print('Item list not readable, keeping the old one:', e)
+            return
+        if mtime != _mtime:
+            _load(mtime)
+
+
+def _load(mtime: float):
+    global _catalog, _mtime
+    # A broken file is only read again once it changes
+    _mtime = mtime
+    try:
+        items = get_item_list()
+    except (OSError, ValueError) as e:
+        print('Item list invalid, keeping the old one:', e)
+        return
+    # Readers see either the old or the new snapshot, never a mix
+    _catalog = Catalog(items, _catalog.version + 1)
+
+
+def reload_item_list():
+    with _reload_lock:
+        _load(getmtime(ITEMCSV))
@@ -1,28 +1,75 @@
+"""
+Chat logs, one JSON object per line and event:
+
+    {"ts": 1700000000.123, "chat": 1234, "event": "message",
+     "user": {...}, "text": "..."}
+
+The current segment of a chat is log/user_<chat_id>.jsonl. It is
+rotated by size and at midnight to user_<chat_id>.<first>-<last>.jsonl
+(first and last timestamp) and gzip compressed in the background.
+Segments older than logretentiondays are deleted.
+
+python3 -m fliegerbier.log --chat 1234 --since 2024-01-01 --event message
+"""
 from datetime import datetime
-from os import makedirs
+from os import makedirs, listdir, remove, rename
+from os.path import exists, getmtime, getsize, join
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from queue import SimpleQueue, Empty
+from threading import Event, Lock, Thread
+from time import time, monotonic
+from typing import Iterator
+import atexit
+import gzip
+import json
+import re
+import shutil
+import traceback
+from .config import (
+    LOGCOLORS,
+    LOGOPENFILES,
+    LOGMAXBYTES,
+    LOGROTATEDAILY,
+    LOGRETENTIONDAYS,
+)
+
+LOGDIR = './log'
 
-makedirs('./log', exist_ok=True)
+makedirs(LOGDIR, exist_ok=True)
+
+_segment_name = re.compile(
+    r'^user_(?P<chat>-?[0-9]+)'
+    r'(\.(?P<first>[0-9]+)-(?P<last>[0-9]+)(_(?P<n>[0-9]+))?)?'
+    r'\.jsonl(?P<gz>\.gz)?$'
+)
 
 
 class Colorized:
+    colortable = {
+        'red': '0;31',
+        'light_red': '1;31',
+        'green': '0;32',
+        'light_green': '1;32',
+        'blue': '0;34',
+        'light_blue': '1;34',
+        'grey': '1;30',
+        'yellow': '1;33'
+    }
+    # Plain text if logcolors = false
+    enabled = LOGCOLORS
+
     def __init__(self, text):
         self.text = str(text)
+
     def __getattr__(self, color):
-        colortable = {
-            'red': '0;31',
-            'light_red': '1;31',
-            'green': '0;32',
-            'light_green': '1;32',
-            'blue': '0;34',
-            'light_blue': '1;34',
-            'grey': '1;30',
-            'yellow': '1;33'
-        }
-        r = '\033[{color}m{text}\033[0m'.format(
-            color=colortable[color],
+        code = Colorized.colortable[color]
+        if not Colorized.enabled:
+            return self.text
+        return '\033[{color}m{text}\033[0m'.format(
+            color=code,
             text=self.text
         )
-        return r
 
 
 def string_yellow_none_grey(x):
@@ -31,22 +78,306 @@ def string_yellow_none_grey(x):
     return Colorized(x).yellow
 
 
-def print_write(string, chat_id):
-    logfile_path = 'log/user_{}.log'.format(
-        chat_id
-    )
-    with open(logfile_path, 'a') as f:
-        f.write(string)
-    print(string, end='', flush=True)
+def _day(timestamp: float):
+    return datetime.fromtimestamp(timestamp).date()
+
+
+class _Segment:
+    """The open current segment of one chat."""
+    def __init__(self, chat_id):
+        self.chat_id = chat_id
+        self.path = join(LOGDIR, 'user_{}.jsonl'.format(chat_id))
+        self.first_ts = None
+        self.last_ts = None
+        if exists(self.path) and getsize(self.path) > 0:
+            # Continue a segment of an earlier run
+            self.last_ts = getmtime(self.path)
+            try:
+                with open(self.path, encoding='utf-8') as f:
+                    self.first_ts = json.loads(f.readline())['ts']
+            except (ValueError, KeyError):
+                self.first_ts = self.last_ts
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def needs_rotation(self, ts: float) -> bool:
+        if self.first_ts is None:
+            return False
+        if LOGMAXBYTES and self.file.tell() >= LOGMAXBYTES:
+            return True
+        return LOGROTATEDAILY and _day(ts) != _day(self.first_ts)
+
+    def rotate(self) -> str:
+        """Closes the segment and returns the new name of its file."""
+        self.file.close()
+        base = join(LOGDIR, 'user_{}.{}-{}'.format(
+            self.chat_id, int(self.first_ts), int(self.last_ts)
+        ))
+        target = base + '.jsonl'
+        n = 1
+        while exists(target) or exists(target + '.gz'):
+            target = '{}_{}.jsonl'.format(base, n)
+            n += 1
+        rename(self.path, target)
+        return target
+
+
+def _compress(path: str):
+    with open(path, 'rb') as f_in, gzip.open(path + '.gz', 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    remove(path)
+
+
+def _delete_expired(now: float):
+    if not LOGRETENTIONDAYS:
+        return
+    oldest = now - LOGRETENTIONDAYS * 86400
+    for name in listdir(LOGDIR):
+        m = _segment_name.match(name)
+        if m and m.group('last') and int(m.group('last')) < oldest:
+            remove(join(LOGDIR, name))
+
+
+class LogWriter:
+    """
+    Writes log records in a background thread, so handlers never wait
+    for the disk. Records are written in batches, the segments of the
+    most active chats stay open. Rotated segments are compressed on a
+    second thread.
+    """
+    max_batch = 500
+
+    def __init__(self, max_open_files: int):
+        self.max_open_files = max_open_files
+        self._queue = SimpleQueue()
+        self._segments = OrderedDict()  # chat_id: _Segment, least recently used first
+        self._thread = None
+        self._start_lock = Lock()
+        self._compressor = ThreadPoolExecutor(1, thread_name_prefix='log-compress')
+        self._swept_at = None
+
+        # Metrics
+        self.written = 0
+        self.batches = 0
+        self.rotations = 0
+        self.errors = 0
+
+    def write(self, record: dict, console: str):
+        if self._thread is None:
+            self._start()
+        self._queue.put((record, console))
+
+    def flush(self, timeout: float = 5.0):
+        """Blocks until every record written so far is on disk."""
+        if self._thread is None:
+            return
+        done = Event()
+        self._queue.put((None, done))
+        done.wait(timeout)
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _segment(self, chat_id) -> _Segment:
+        segment = self._segments.get(chat_id)
+        if segment is not None:
+            self._segments.move_to_end(chat_id)
+            return segment
+        if len(self._segments) >= self.max_open_files:
+            _, oldest = self._segments.popitem(last=False)
+            oldest.file.close()
+        segment = _Segment(chat_id)
+        self._segments[chat_id] = segment
+        return segment
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception:
+                traceback.print_exc()
+
+    def _write_batch(self, batch):
+        try:
+            self._write_records(
+                [(record, line) for record, line in batch if record is not None]
+            )
+        finally:
+            # A flush must not hang on a record that could not be written
+            for record, done in batch:
+                if record is None:
+                    done.set()
+
+    def _write_records(self, batch):
+        console = []
+        touched = set()
+        for record, line in batch:
+            console.append(line)
+            try:
+                segment = self._write_record(record)
+            except Exception as e:
+                # Lose this record, not the rest of the batch
+                self.errors += 1
+                traceback.print_exc()
+                if isinstance(e, OSError):
+                    self._drop_segment(record.get('chat'))
+                continue
+            touched.add(segment)
+
+        for segment in touched:
+            if segment.file.closed:
+                continue
+            try:
+                segment.file.flush()
+            except Exception:
+                self.errors += 1
+                traceback.print_exc()
+                self._drop_segment(segment.chat_id)
+
+        if console:
+            print(''.join(console), end='', flush=True)
+            self.written += len(console)
+            self.batches += 1
+
+        if self._swept_at is None or monotonic() - self._swept_at > 3600:
+            self._swept_at = monotonic()
+            self._submit(_delete_expired, time())
 
+    def _write_record(self, record: dict) -> _Segment:
+        segment = self._segment(record['chat'])
+        if segment.needs_rotation(record['ts']):
+            self._rotate(segment)
+            segment = self._segment(record['chat'])
+        segment.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        if segment.first_ts is None:
+            segment.first_ts = record['ts']
+        segment.last_ts = record['ts']
+        return segment
+
+    def _drop_segment(self, chat_id):
+        # Opened again by the next record of the chat
+        segment = self._segments.pop(chat_id, None)
+        if segment is None:
+            return
+        try:
+            segment.file.close()
+        except Exception:
+            traceback.print_exc()
+
+    def _rotate(self, segment: _Segment):
+        del self._segments[segment.chat_id]
+        path = segment.rotate()
+        self.rotations += 1
+        self._submit(_compress, path)
+
+    def _submit(self, f, *args):
+        try:
+            self._compressor.submit(self._background, f, *args)
+        except RuntimeError:
+            # The executor is already shut down when atexit flushes,
+            # the segment then stays uncompressed
+            pass
+
+    @staticmethod
+    def _background(f, *args):
+        try:
+            f(*args)
+        except Exception:
+            traceback.print_exc()
+
+
+log_writer = LogWriter(LOGOPENFILES)
+
+
+def read_log(
+    chat_id: int = None,
+    since: float = None,
+    until: float = None,
+    events=None,
+) -> Iterator[dict]:
+    """
+    Records filtered by chat, time range [since, until) and event
+    types, per chat in time order. Segments outside the time range are
+    skipped by their name, without opening them.
+    """
+    segments = []
+    for name in listdir(LOGDIR):
+        m = _segment_name.match(name)
+        if m is None:
+            continue
+        if chat_id is not None and int(m.group('chat')) != chat_id:
+            continue
+        if m.group('first') is not None:
+            first, last = int(m.group('first')), int(m.group('last'))
+            if until is not None and first >= until:
+                continue
+            if since is not None and last + 1 <= since:
+                continue
+            order = (first, int(m.group('n') or 0))
+        else:
+            # The current segment comes after the rotated ones
+            order = (float('inf'), 0)
+        segments.append((int(m.group('chat')), order, name, m.group('gz')))
+
+    for _, _, name, gz in sorted(segments):
+        opener = gzip.open if gz else open
+        with opener(join(LOGDIR, name), 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # Cut off by a crash
+                    continue
+                if since is not None and record['ts'] < since:
+                    continue
+                if until is not None and record['ts'] >= until:
+                    break
+                if events is not None and record['event'] not in events:
+                    continue
+                yield record
+
+
+def _user_dict(user) -> dict:
+    return {
+        'id': getattr(user, 'id', None),
+        'first_name': user.first_name,
+        'username': user.username,
+        'last_name': user.last_name,
+    }
+
+
+def _now():
+    ts = time()
+    return round(ts, 3), Colorized(datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')).blue
 
 
 def log_incoming_message(user, message):
+    ts, now = _now()
+    record = {
+        'ts': ts,
+        'chat': message.chat.id,
+        'event': 'message',
+        'user': _user_dict(user),
+    }
     msg = Colorized('[Unknown message type]').red
     if getattr(message, 'text', None):
         msg = Colorized(message.text).green
+        record['text'] = message.text
     elif getattr(message, 'sticker', None):
         msg = '{} {}'.format(Colorized('[sticker]').red, message.sticker.emoji)
+        record['sticker'] = message.sticker.emoji
     else:
         print('TODO', message)
 
@@ -55,31 +386,39 @@ def log_incoming_message(user, message):
         fname=string_yellow_none_grey(user.first_name),
         uname=string_yellow_none_grey(user.username),
         lname=string_yellow_none_grey(user.last_name),
-        datetime=Colorized(datetime.now().strftime('%Y-%M-%d %H:%M:%S')).blue,
+        datetime=now,
         msg=msg,
     )
-    print_write(s, message.chat.id)
+    log_writer.write(record, s)
 
 
 def log_incoming_voice(user, stt, message):
+    ts, now = _now()
     voice = Colorized('[Voice]').red
     text = Colorized('[Not detected]').red
     if stt.text:
         text = Colorized(stt.text).green
-    
+
     s = '[{datetime}] [{fname:<7} @{uname:<7} {lname:<5}] {voice} {txt}\n'
     s = s.format(
         fname=string_yellow_none_grey(user.first_name),
         uname=string_yellow_none_grey(user.username),
         lname=string_yellow_none_grey(user.last_name),
-        datetime=Colorized(datetime.now().strftime('%Y-%M-%d %H:%M:%S')).blue,
+        datetime=now,
         voice=voice,
         txt=text,
     )
-    print_write(s, message.chat.id)
+    log_writer.write({
+        'ts': ts,
+        'chat': message.chat.id,
+        'event': 'voice',
+        'user': _user_dict(user),
+        'text': stt.text,
+    }, s)
 
 
 def log_incoming_callback(user, callback_query):
+    ts, now = _now()
     msg = (
         Colorized('<= ').yellow +
         Colorized(callback_query.data).blue
@@ -90,26 +429,103 @@ def log_incoming_callback(user, callback_query):
         fname=string_yellow_none_grey(user.first_name),
         uname=string_yellow_none_grey(user.username),
         lname=string_yellow_none_grey(user.last_name),
-        datetime=Colorized(datetime.now().strftime('%Y-%M-%d %H:%M:%S')).blue,
+        datetime=now,
+        msg=msg,
+    )
+    log_writer.write({
+        'ts': ts,
+        'chat': callback_query.message.chat.id,
+        'event': 'callback',
+        'user': _user_dict(user),
+        'data': callback_query.data,
+    }, s)
+
+
+# Update fields besides message and callback_query, in Update's order
+_other_update_types = (
+    'edited_message',
+    'channel_post',
+    'edited_channel_post',
+    'inline_query',
+    'chosen_inline_result',
+    'shipping_query',
+    'pre_checkout_query',
+    'poll',
+    'poll_answer',
+    'my_chat_member',
+    'chat_member',
+    'chat_join_request',
+)
+
+
+def log_incoming_other(user, update):
+    """Updates the handlers do not know, e.g. edited messages."""
+    ts, now = _now()
+    kind = next(
+        (t for t in _other_update_types if getattr(update, t, None) is not None),
+        'unknown',
+    )
+    chat = update.effective_chat
+    msg = Colorized('[{}]'.format(kind)).red
+
+    s = '[{datetime}] [{fname:<7} @{uname:<7} {lname:<5}] {msg}\n'
+    s = s.format(
+        fname=string_yellow_none_grey(getattr(user, 'first_name', None)),
+        uname=string_yellow_none_grey(getattr(user, 'username', None)),
+        lname=string_yellow_none_grey(getattr(user, 'last_name', None)),
+        datetime=now,
         msg=msg,
     )
-    print_write(s, callback_query.message.chat.id)
+    log_writer.write({
+        'ts': ts,
+        # Polls and inline queries have no chat, file them under the user
+        'chat': chat.id if chat is not None else getattr(user, 'id', 0),
+        'event': 'update',
+        'user': _user_dict(user) if user is not None else None,
+        'type': kind,
+    }, s)
 
 
 def log_response(message, user):
+    ts, now = _now()
+    record = {
+        'ts': ts,
+        'chat': message.chat.id,
+        'event': 'response',
+    }
     text = Colorized('[Unknown message type]').grey
     if getattr(message, 'text', None):
         text = Colorized(message.text).light_green.replace(
             '\n', '\n\t\t'
         )
+        record['text'] = message.text
     elif getattr(message, 'description', None):
         text = Colorized(message.description).light_green
+        record['text'] = message.description
     else:
         print('TODO', message)
 
     s = '[{datetime}] [{arrow}] {msg}\n'.format(
-        datetime=Colorized(datetime.now().strftime('%Y-%M-%d %H:%M:%S')).blue,
+        datetime=now,
         arrow=Colorized('   =>   ').yellow,
         msg=text,
     )
-    print_write(s, message.chat.id)
+    log_writer.write(record, s)
+
+
+def _parse_time(value: str) -> float:
+    return datetime.fromisoformat(value).timestamp()
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser(description='Filter the chat logs')
+    parser.add_argument('--chat', type=int)
+    parser.add_argument('--since', type=_parse_time, help='e.g. 2024-01-31 or 2024-01-31T18:00')
+    parser.add_argument('--until', type=_parse_time)
+    parser.add_argument('--event', action='append', choices=['message', 'voice', 'callback', 'update', 'response'])
+    args = parser.parse_args()
+
+    for record in read_log(args.chat, args.since, args.until, args.event):
+        print(json.dumps(record, ensure_ascii=False))
@@ -0,0 +1,320 @@
+"""
+Metrics in the Prometheus text format on http://<metricslisten>:<metricsport>/metrics,
+off with metricsport = 0.
+
+Counters and histograms are updated in place, which costs a lock and
+a bisect per observation. Queue lengths and the like are gauges that
+are only read when the endpoint is scraped.
+"""
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from time import perf_counter
+from typing import Callable, Dict, Tuple
+from .config import METRICSLISTEN, METRICSPORT
+
+ENABLED = METRICSPORT > 0
+
+# Seconds, from a cached query to a slow Bot API call
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Tuple[str, ...], values: Tuple, extra: str = '') -> str:
+    pairs = ['{}="{}"'.format(n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value: float) -> str:
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self._lock = Lock()
+
+    def render(self) -> str:
+        return '# HELP {0} {1}\n# TYPE {0} {2}\n{3}'.format(
+            self.name, self.help, self.type, self._samples()
+        )
+
+    def _samples(self) -> str:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def _samples(self) -> str:
+        with self._lock:
+            values = list(self._values.items())
+        return ''.join(
+            '{}{} {}\n'.format(self.name, _labels(self.label_names, key), _number(value))
+            for key, value in values
+        )
+
+
+class Gauge(_Metric):
+    """Read from a function at scrape time, one sample per returned label tuple."""
+    type = 'gauge'
+
+    def __init__(self, name, help, labels=(), read: Callable[[], Dict[Tuple, float]] = None):
+        super().__init__(name, help, labels)
+        self._read = read
+
+    def _samples(self) -> str:
+        return ''.join(
+            '{}{} {}\n'.format(self.name, _labels(self.label_names, key), _number(value))
+            for key, value in self._read().items()
+        )
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels: [count per bucket (last one +Inf), sum]
+        self._values: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        i = bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _samples(self) -> str:
+        with self._lock:
+            values = [(key, list(counts), sum_) for key, (counts, sum_) in self._values.items()]
+        lines = []
+        for key, counts, sum_ in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="{}"'.format('+Inf' if bound == float('inf') else _number(bound))
+                lines.append('{}_bucket{} {}\n'.format(
+                    self.name, _labels(self.label_names, key, le), cumulative
+                ))
+            lines.append('{}_sum{} {}\n'.format(self.name, _labels(self.label_names, key), _number(sum_)))
+            lines.append('{}_count{} {}\n'.format(self.name, _labels(self.label_names, key), cumulative))
+        return ''.join(lines)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start, *self.labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return ''.join(m.render() for m in self._metrics)
+
+
+registry = Registry()
+
+
+class TimedLock:
+    """threading.Lock that records how long threads wait for it."""
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = Lock()
+
+    def acquire(self, blocking: bool = True, timeout: float = -1) -> bool:
+        start = perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        lock_wait.observe(perf_counter() - start, self.name)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Updated all over the code
+handler_latency = registry.register(Histogram(
+    'fliegerbier_handler_seconds',
+    'Run time of handlers decorated by patch_telegram_action',
+    ('handler',),
+))
+handler_errors = registry.register(Counter(
+    'fliegerbier_handler_errors_total',
+    'Handlers that raised',
+    ('handler',),
+))
+handler_busy = registry.register(Counter(
+    'fliegerbier_handler_busy_seconds_total',
+    'Time spent in handlers per update, rate() / fliegerbier_workers is the utilization',
+))
+db_query = registry.register(Histogram(
+    'fliegerbier_db_query_seconds',
+    'Duration of SQL statements',
+    ('statement',),
+))
+lock_wait = registry.register(Histogram(
+    'fliegerbier_lock_wait_seconds',
+    'Time spent waiting for locks shared by the workers',
+    ('lock',),
+))
+botapi_latency = registry.register(Histogram(
+    'fliegerbier_botapi_seconds',
+    'Duration of Bot API calls',
+    ('method',),
+))
+botapi_queue_wait = registry.register(Histogram(
+    'fliegerbier_botapi_queue_seconds',
+    'Time Bot API calls wait in the outbox',
+))
+botapi_errors = registry.register(Counter(
+    'fliegerbier_botapi_errors_total',
+    'Failed Bot API calls, including retried ones',
+    ('method', 'error'),
+))
+
+_in_progress = 0
+_in_progress_lock = Lock()
+
+
+def handler_started():
+    global _in_progress
+    with _in_progress_lock:
+        _in_progress += 1
+
+
+def handler_finished(seconds: float):
+    global _in_progress
+    with _in_progress_lock:
+        _in_progress -= 1
+    handler_busy.inc(amount=seconds)
+
+
+def _install_sql(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('metrics_start', []).append(perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['metrics_start'].pop()
+        db_query.observe(perf_counter() - start, statement.split(None, 1)[0].upper())
+
+    @event.listens_for(engine, 'handle_error')
+    def error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('metrics_start'):
+            conn.info['metrics_start'].pop()
+
+
+def _install_gauges(workers: int):
+    from .outbox import outbox
+    from .database import write_buffer
+    from .enter_item_consumption import revert_scheduler
+    from .log import log_writer
+
+    registry.register(Gauge(
+        'fliegerbier_workers', 'Threads that can run handlers',
+        read=lambda: {(): workers},
+    ))
+    registry.register(Gauge(
+        'fliegerbier_handlers_in_progress', 'Handlers running right now',
+        read=lambda: {(): _in_progress},
+    ))
+    registry.register(Gauge(
+        'fliegerbier_revert_countdowns', 'Revert countdowns waiting on the scheduler',
+        read=lambda: {(): revert_scheduler.pending()},
+    ))
+    registry.register(Gauge(
+        'fliegerbier_queue_length', 'Items waiting in internal queues',
+        ('queue',),
+        read=lambda: {
+            ('outbox',): outbox.stats()['depth'],
+            ('outbox_in_flight',): outbox.stats()['in_flight'],
+            ('write_buffer',): write_buffer.stats()['queued'],
+            ('log',): log_writer.depth(),
+        },
+    ))
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def install(engine, workers: int):
+    """Hook into the engine and serve the endpoint, if enabled."""
+    if not ENABLED:
+        return
+    _install_sql(engine)
+    _install_gauges(workers)
+
+    server = ThreadingHTTPServer((METRICSLISTEN, METRICSPORT), _MetricsHandler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    print('Metrics on http://{}:{}/metrics'.format(METRICSLISTEN, METRICSPORT))
@@ -0,0 +1,181 @@
+from time import time
+from typing import List
+import sqlalchemy
+from sqlalchemy.schema import CreateIndex, CreateTable
+from .database import (
+    _db,
+    metadata,
+    consumptions,
+    consumption_monthly_totals,
+    reverted_consumptions,
+    _rebuild_monthly_totals,
+    ix_consumptions_akaflieg_id_timestamp,
+    ix_consumptions_timestamp_akaflieg_id,
+    ux_consumptions_idempotency_key,
+)
+
+
+# python -m fliegerbier.migrations runs this module a second time after
+# the package imported it, the table is then already in metadata.
+schema_versions = sqlalchemy.Table(
+    'schema_versions',
+    metadata,
+    sqlalchemy.Column('version', sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column('name', sqlalchemy.String(200)),
+    sqlalchemy.Column('applied_at', sqlalchemy.Integer),
+    extend_existing=True,
+)
+
+
+def _gram_alcohol_as_double(con):
+    """Change consumptions.gram_alcohol to double precision (SQLite keeps fractions anyway)"""
+    if con.dialect.name == 'postgresql':
+        con.execute('ALTER TABLE consumptions ALTER COLUMN gram_alcohol TYPE DOUBLE PRECISION')
+    elif con.dialect.name == 'mysql':
+        con.execute('ALTER TABLE consumptions MODIFY gram_alcohol DOUBLE')
+
+
+class Migration:
+    """
+    One forward step of the schema.
+    Steps are DDL elements or callables taking the connection,
+    the docstring of a callable is shown in dry runs.
+    """
+    def __init__(self, version: int, name: str, steps: list):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+    def __repr__(self) -> str:
+        return '<Migration {} {}>'.format(self.version, self.name)
+
+
+# Append only, never change a migration that has been released.
+# New tables and indexes must also be declared in database.py,
+# fresh databases are created from the declarations there.
+migrations: List[Migration] = [
+    Migration(1, 'index consumptions by akaflieg_id and timestamp', [
+        CreateIndex(ix_consumptions_akaflieg_id_timestamp),
+    ]),
+    Migration(2, 'index consumptions by timestamp and akaflieg_id', [
+        CreateIndex(ix_consumptions_timestamp_akaflieg_id),
+    ]),
+    Migration(3, 'idempotency key for consumptions', [
+        sqlalchemy.DDL(
+            'ALTER TABLE consumptions ADD COLUMN idempotency_key VARCHAR(64)'
+        ),
+        CreateIndex(ux_consumptions_idempotency_key),
+    ]),
+    Migration(4, 'monthly consumption totals', [
+        CreateTable(consumption_monthly_totals),
+        _rebuild_monthly_totals,
+    ]),
+    Migration(5, 'monthly consumption totals keyed by price in cents', [
+        sqlalchemy.DDL('DROP TABLE consumption_monthly_totals'),
+        CreateTable(consumption_monthly_totals),
+        _rebuild_monthly_totals,
+    ]),
+    Migration(6, 'idempotency keys of reverted consumptions', [
+        CreateTable(reverted_consumptions),
+    ]),
+    Migration(7, 'gram_alcohol as double precision', [
+        _gram_alcohol_as_double,
+    ]),
+]
+
+
+def _describe(step, dialect) -> str:
+    if callable(step) and not isinstance(step, sqlalchemy.schema.DDLElement):
+        return '-- ' + (step.__doc__ or step.__name__).strip()
+    return str(step.compile(dialect=dialect)).strip() + ';'
+
+
+def _applied_versions(con) -> set:
+    query = sqlalchemy.select([schema_versions.c.version])
+    return {r[0] for r in con.execute(query)}
+
+
+def _stamp(con, migration: Migration):
+    con.execute(schema_versions.insert().values(
+        version=migration.version,
+        name=migration.name,
+        applied_at=int(time()),
+    ))
+
+
+def current_version(engine=_db) -> int:
+    with engine.connect() as con:
+        if not engine.dialect.has_table(con, schema_versions.name):
+            return 0
+        return max(_applied_versions(con), default=0)
+
+
+def migrate(engine=_db, dry_run: bool = False, out=print) -> List[Migration]:
+    """
+    Bring the database schema up to date.
+    Returns the migrations that were (or in a dry run would be) applied.
+    """
+    dialect = engine.dialect
+    applied: List[Migration] = []
+
+    with engine.connect() as con:
+        has_versions = dialect.has_table(con, schema_versions.name)
+        is_fresh = not dialect.has_table(con, consumptions.name)
+
+        if is_fresh:
+            # Empty database, create the current schema and
+            # mark every migration as applied.
+            out('-- Creating schema version {}'.format(migrations[-1].version))
+            for table in metadata.sorted_tables:
+                out(_describe(CreateTable(table), dialect))
+                for index in table.indexes:
+                    out(_describe(CreateIndex(index), dialect))
+            if dry_run:
+                return list(migrations)
+            with con.begin():
+                metadata.create_all(con)
+                for migration in migrations:
+                    _stamp(con, migration)
+            return list(migrations)
+
+        if not has_versions:
+            # Database from before the migrations, this is version 0
+            out(_describe(CreateTable(schema_versions), dialect))
+            if dry_run:
+                done = set()
+            else:
+                schema_versions.create(con)
+                done = _applied_versions(con)
+        else:
+            done = _applied_versions(con)
+
+        for migration in migrations:
+            if migration.version in done:
+                continue
+            out('-- Migration {}: {}'.format(migration.version, migration.name))
+            for step in migration.steps:
+                out(_describe(step, dialect))
+            applied.append(migration)
+            if dry_run:
+                continue
+
+            with con.begin():
+                for step in migration.steps:
+                    if isinstance(step, sqlalchemy.schema.DDLElement):
+                        con.execute(step)
+                    else:
+                        step(con)
+                _stamp(con, migration)
+
+    return applied
+
+
+if __name__ == '__main__':
+    from sys import argv
+
+    dry_run = '--dry-run' in argv
+    todo = migrate(dry_run=dry_run)
+    if not todo:
+        print('Schema is up to date (version {}).'.format(current_version()))
+    elif dry_run:
+        print('{} migration(s) pending.'.format(len(todo)))
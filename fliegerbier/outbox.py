@@ -0,0 +1,332 @@
+from collections import deque
+from concurrent.futures import Future
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+import telegram
+from .config import GLOBALRATE, CHATRATE, GROUPRATE, OUTBOXWORKERS
+from . import metrics
+from . import tracing
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = monotonic()
+        self.paused_until = 0.0
+
+    def _fill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until a token can be taken."""
+        self._fill(now)
+        wait = 0.0
+        if self.tokens < 1:
+            wait = (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now: float):
+        self._fill(now)
+        self.tokens -= 1
+
+    def idle(self, now: float) -> bool:
+        """Full and not paused, so no different from a new bucket."""
+        self._fill(now)
+        return self.tokens >= self.capacity and self.paused_until <= now
+
+    def pause(self, until: float):
+        self.paused_until = max(self.paused_until, until)
+
+
+def _file_positions(kwargs: dict) -> list:
+    """(file, position) of the files among the arguments, e.g. a document."""
+    return [
+        (value, value.tell()) for value in kwargs.values()
+        if hasattr(value, 'seekable') and value.seekable()
+    ]
+
+
+class _Job:
+    __slots__ = (
+        'chat_id', 'method', 'kwargs', 'positions', 'merge_key', 'retry',
+        'futures', 'enqueued', 'attempts', 'trace_parent',
+    )
+
+    def __init__(self, chat_id, method, kwargs, merge_key, retry):
+        self.chat_id = chat_id
+        self.method = method
+        self.set_kwargs(kwargs)
+        self.merge_key = merge_key
+        self.retry = retry
+        self.futures = []
+        self.enqueued = monotonic()
+        self.attempts = 0
+        # Span of the handler that queued the call, the call is traced
+        # as its child even though it runs on an outbox thread
+        self.trace_parent = tracing.current() if tracing.ENABLED else None
+
+    def set_kwargs(self, kwargs: dict):
+        self.kwargs = kwargs
+        # A failed attempt may have read the files already
+        self.positions = _file_positions(kwargs)
+
+    def rewind(self):
+        for f, position in self.positions:
+            f.seek(position)
+
+
+class Outbox:
+    """
+    Queue for all outgoing Bot API calls.
+    Calls are paced by a global and a per chat token bucket, calls of
+    one chat are executed in order. A call with the merge_key of a
+    call that is still queued replaces its arguments, so superseded
+    edits of a message are never sent. RetryAfter pauses the chat and
+    requeues the call.
+    Calls that do not go to a chat, like answers to callback queries,
+    are submitted with target_chat None. They only count against the
+    global bucket and do not wait for each other.
+    """
+    max_attempts = 5
+    # Seconds between two sweeps for per chat buckets that are idle
+    sweep_interval = 60
+
+    def __init__(
+        self,
+        global_rate: float,
+        chat_rate: float,
+        group_rate: float,
+        workers: int,
+    ):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.workers = workers
+
+        self._cond = Condition()
+        self._queues = {}  # chat_id: deque of jobs
+        self._merge = {}  # merge_key: queued job
+        self._buckets = {}  # chat_id: TokenBucket
+        self._busy = set()  # chats with a call in flight
+        self._global = TokenBucket(global_rate, global_rate)
+        self._unpaced = count()
+        self._next_sweep = monotonic() + self.sweep_interval
+        self._threads = []
+
+        # Metrics
+        self.depth = 0
+        self.sent = 0
+        self.merged = 0
+        self.retries = 0
+        self.errors = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, target_chat: int, method, merge_key=None, retry=False, **kwargs) -> Future:
+        """
+        Queue method(**kwargs), e.g. bot.send_message, paced for target_chat.
+        retry allows to repeat the call after network errors,
+        only use it for idempotent calls like edits and deletes.
+        """
+        future = Future()
+        with self._cond:
+            # A queue of its own for every call without a chat
+            chat_id = target_chat if target_chat is not None else ('unpaced', next(self._unpaced))
+            job = self._merge.get(merge_key) if merge_key is not None else None
+            if job is not None:
+                job.set_kwargs(kwargs)
+                job.futures.append(future)
+                self.merged += 1
+                return future
+
+            job = _Job(chat_id, method, kwargs, merge_key, retry)
+            job.futures.append(future)
+            self._queues.setdefault(chat_id, deque()).append(job)
+            if merge_key is not None:
+                self._merge[merge_key] = job
+            self.depth += 1
+            self._cond.notify()
+
+            if not self._threads:
+                for i in range(self.workers):
+                    t = Thread(target=self._run, name='outbox-{}'.format(i), daemon=True)
+                    self._threads.append(t)
+                    t.start()
+        return future
+
+    def stats(self) -> dict:
+        done = self.sent + self.errors
+        return {
+            'depth': self.depth,
+            'in_flight': len(self._busy),
+            'sent': self.sent,
+            'merged': self.merged,
+            'retries': self.retries,
+            'errors': self.errors,
+            'latency_avg': self.latency_sum / done if done else 0.0,
+            'latency_max': self.latency_max,
+        }
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        """The bucket of a chat, None for calls without a chat."""
+        if isinstance(chat_id, tuple):
+            return None
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if chat_id < 0:
+                # Groups
+                bucket = TokenBucket(self.group_rate, 3)
+            else:
+                bucket = TokenBucket(self.chat_rate, 3)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _sweep(self, now: float):
+        """Drop the buckets of chats that have been quiet for a while."""
+        self._next_sweep = now + self.sweep_interval
+        for chat_id, bucket in list(self._buckets.items()):
+            if chat_id not in self._queues and chat_id not in self._busy and bucket.idle(now):
+                del self._buckets[chat_id]
+
+    def _pick(self, now: float):
+        """Returns the oldest job that may be sent now, or the time to wait."""
+        if now >= self._next_sweep:
+            self._sweep(now)
+        best = None
+        wait = None
+        global_delay = self._global.delay(now)
+        for chat_id, queue in self._queues.items():
+            if chat_id in self._busy:
+                continue
+            bucket = self._bucket(chat_id)
+            delay = global_delay if bucket is None else max(global_delay, bucket.delay(now))
+            if delay > 0:
+                wait = delay if wait is None else min(wait, delay)
+                continue
+            if best is None or queue[0].enqueued < best.enqueued:
+                best = queue[0]
+        return best, wait
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = monotonic()
+                    job, wait = self._pick(now)
+                    if job is not None:
+                        break
+                    self._cond.wait(wait)
+
+                queue = self._queues[job.chat_id]
+                queue.popleft()
+                if not queue:
+                    del self._queues[job.chat_id]
+                if job.merge_key is not None:
+                    del self._merge[job.merge_key]
+                self.depth -= 1
+                self._busy.add(job.chat_id)
+                self._global.take(now)
+                bucket = self._bucket(job.chat_id)
+                if bucket is not None:
+                    bucket.take(now)
+
+            if metrics.ENABLED:
+                metrics.botapi_queue_wait.observe(now - job.enqueued)
+            started = monotonic()
+            try:
+                job.rewind()
+                if job.trace_parent is not None:
+                    with tracing.span('botapi ' + self._method_name(job), parent=job.trace_parent):
+                        result = job.method(**job.kwargs)
+                else:
+                    result = job.method(**job.kwargs)
+            except telegram.error.RetryAfter as e:
+                self._observe(job, started, e)
+                if job.attempts < self.max_attempts:
+                    self._requeue(job, e.retry_after)
+                else:
+                    self._finish(job, error=e)
+            except telegram.error.NetworkError as e:
+                self._observe(job, started, e)
+                # TimedOut and connection problems. BadRequest derives
+                # from NetworkError too but repeating it is pointless.
+                if job.retry and not isinstance(e, telegram.error.BadRequest) \
+                        and job.attempts < self.max_attempts:
+                    self._requeue(job, 2 ** job.attempts)
+                else:
+                    self._finish(job, error=e)
+            except Exception as e:
+                self._observe(job, started, e)
+                self._finish(job, error=e)
+            else:
+                self._observe(job, started)
+                self._finish(job, result=result)
+
+    @staticmethod
+    def _method_name(job: _Job) -> str:
+        return getattr(job.method, '__name__', str(job.method))
+
+    @staticmethod
+    def _observe(job: _Job, started: float, error: Exception = None):
+        if not metrics.ENABLED:
+            return
+        method = Outbox._method_name(job)
+        metrics.botapi_latency.observe(monotonic() - started, method)
+        if error is not None:
+            metrics.botapi_errors.inc(method, type(error).__name__)
+
+    def _requeue(self, job: _Job, delay: float):
+        with self._cond:
+            job.attempts += 1
+            self.retries += 1
+            self._busy.discard(job.chat_id)
+            # Calls without a chat are paused with all others
+            bucket = self._bucket(job.chat_id) or self._global
+            bucket.pause(monotonic() + delay)
+
+            newer = self._merge.get(job.merge_key) if job.merge_key is not None else None
+            if newer is not None:
+                # Superseded while in flight, the newer job answers for both
+                newer.futures.extend(job.futures)
+                self._cond.notify_all()
+                return
+
+            self._queues.setdefault(job.chat_id, deque()).appendleft(job)
+            if job.merge_key is not None:
+                self._merge[job.merge_key] = job
+            self.depth += 1
+            self._cond.notify_all()
+
+    def _finish(self, job: _Job, result=None, error=None):
+        latency = monotonic() - job.enqueued
+        with self._cond:
+            self._busy.discard(job.chat_id)
+            if error is None:
+                self.sent += 1
+            else:
+                self.errors += 1
+            self.latency_sum += latency
+            self.latency_max = max(self.latency_max, latency)
+            self._cond.notify_all()
+
+        if error is not None and 'not modified' not in str(error):
+            print('Bot API call {} for chat {} failed: {}'.format(
+                getattr(job.method, '__name__', job.method), job.chat_id, error
+            ))
+        for future in job.futures:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+
+outbox = Outbox(
+    global_rate=GLOBALRATE,
+    chat_rate=CHATRATE,
+    group_rate=GROUPRATE,
+    workers=OUTBOXWORKERS,
+)
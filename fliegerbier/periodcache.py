@@ -0,0 +1,76 @@
+from threading import Lock
+from typing import Callable, Dict, Optional, Set, Tuple
+
+
+class PeriodCache:
+    """
+    Results per (chat_id, start_ts, end_ts) for periods that have
+    ended. They only change when a consumption inside the period is
+    inserted, deleted or moved to another akaflieg_id, which calls
+    invalidate() with the akaflieg_id. Keying by chat_id lets a cache
+    hit skip loading the users row.
+    """
+    def __init__(self):
+        # chat_id -> (start_ts, end_ts) -> (version, result)
+        self._entries: Dict[int, Dict[Tuple[int, int], Tuple[object, object]]] = {}
+        # akaflieg_id -> chat_ids whose entries were computed for it
+        self._chat_ids: Dict[int, Set[int]] = {}
+        # Counts invalidations, a computation racing with one must not
+        # store its result.
+        self._generation = 0
+        self._lock = Lock()
+
+    def get(
+        self,
+        chat_id: int,
+        start_ts: int,
+        end_ts: int,
+        compute: Callable[[], object],
+        akaflieg_id: Callable[[], Optional[int]],
+        version=None,
+    ):
+        """
+        The cached result, or compute(). akaflieg_id() is only called
+        after a miss, results of users without one are not stored.
+        version is whatever else the result depends on, e.g. the item
+        catalog. A result computed for another version is computed again.
+        """
+        with self._lock:
+            periods = self._entries.get(chat_id, {})
+            entry = periods.get((start_ts, end_ts))
+            if entry is not None and entry[0] == version:
+                return entry[1]
+            generation = self._generation
+
+        value = compute()
+        owner = akaflieg_id()
+        if owner is None:
+            return value
+
+        with self._lock:
+            if self._generation == generation:
+                self._entries.setdefault(chat_id, {})[(start_ts, end_ts)] = (version, value)
+                self._chat_ids.setdefault(int(owner), set()).add(chat_id)
+        return value
+
+    def invalidate(self, akaflieg_id: int, timestamp: int = None):
+        """Drop the periods containing timestamp, or all of the user."""
+        with self._lock:
+            self._generation += 1
+            if timestamp is None:
+                chat_ids = self._chat_ids.pop(akaflieg_id, ())
+            else:
+                chat_ids = self._chat_ids.get(akaflieg_id, ())
+            for chat_id in chat_ids:
+                periods = self._entries.get(chat_id)
+                if not periods:
+                    continue
+                if timestamp is None:
+                    del self._entries[chat_id]
+                    continue
+                for start_ts, end_ts in list(periods):
+                    if start_ts <= timestamp < end_ts:
+                        del periods[(start_ts, end_ts)]
+
+
+period_cache = PeriodCache()
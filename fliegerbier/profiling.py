@@ -0,0 +1,109 @@
+"""
+cProfile of the handlers for a while, started by /profile.
+
+While a session is active, the outermost patch_telegram_action wrapper
+of every update runs the handler under its own cProfile.Profile and
+merges the result into the session. When the session is not active,
+the wrappers only check the module level flag active.
+"""
+from cProfile import Profile
+from io import BytesIO, StringIO
+from pstats import Stats
+from threading import local, Lock
+from time import time
+from typing import Callable
+import marshal
+from .scheduler import Scheduler
+
+# Read by patch_telegram_action on every call, keep it a plain global
+active = False
+
+_profile_scheduler = Scheduler('profile')
+_local = local()
+_lock = Lock()
+_session = None
+
+
+class _Session:
+    __slots__ = ('until', 'stats', 'calls', 'skipped', 'finished')
+
+    def __init__(self, until: float, finished: Callable[['_Session'], None]):
+        self.until = until
+        self.stats = Stats()
+        self.calls = 0
+        # Calls that could not be profiled because another
+        # profiler was running, e.g. a debugger
+        self.skipped = 0
+        self.finished = finished
+
+    def report(self, limit: int = 30) -> str:
+        out = StringIO()
+        stats = Stats(stream=out)
+        stats.add(self.stats)
+        stats.strip_dirs().sort_stats('cumulative').print_stats(limit)
+        return out.getvalue()
+
+    def dump(self) -> BytesIO:
+        """The merged stats in the format of pstats.Stats.dump_stats."""
+        return BytesIO(marshal.dumps(self.stats.stats))
+
+
+def remaining() -> float:
+    """Seconds until the active session ends, None without one."""
+    session = _session
+    if session is None:
+        return None
+    return max(0.0, session.until - time())
+
+
+def start(seconds: float, finished: Callable[[_Session], None]) -> bool:
+    """
+    Profile all handlers for seconds, then call finished(session)
+    on the scheduler thread. False if a session is already running.
+    """
+    global active, _session
+    with _lock:
+        if _session is not None:
+            return False
+        _session = _Session(time() + seconds, finished)
+        active = True
+    _profile_scheduler.schedule('profile', _session.until, _stop)
+    return True
+
+
+def _stop():
+    global active, _session
+    with _lock:
+        session = _session
+        active = False
+        _session = None
+    session.finished(session)
+
+
+def run(f, *args):
+    """f(*args), profiled unless a wrapper further out already is."""
+    if getattr(_local, 'running', False):
+        return f(*args)
+
+    profile = Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Another profiler is active in this thread or process
+        with _lock:
+            if _session is not None:
+                _session.skipped += 1
+        return f(*args)
+
+    _local.running = True
+    try:
+        return f(*args)
+    finally:
+        profile.disable()
+        _local.running = False
+        stats = Stats(profile)
+        with _lock:
+            # The session may have ended while the handler ran
+            if _session is not None:
+                _session.stats.add(stats)
+                _session.calls += 1
@@ -1,56 +1,69 @@
 from .decorators import patch_telegram_action, requires_authorization
 from .database import Consumer
 from .emoji import emojis
+from . import tracing
+from .bloodalcohol import (
+    blood_alcohol,
+    BloodAlcoholCurve,
+    FEMALE_HIGH_DECAY,
+    FEMALE_LOW_DECAY,
+    MALE_HIGH_DECAY,
+    MALE_LOW_DECAY,
+)
 from time import time
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 
 
-FEMALE_HIGH_DECAY = 0.1  # promille per hour
-FEMALE_LOW_DECAY = 0.085  # promille per hour
-MALE_HIGH_DECAY = 0.2  # promille per hour
-MALE_LOW_DECAY = 0.1  # promille per hour
-FEMALE_WATER = 0.6  # percent water female
-MALE_WATER = 0.7  # percent water male
-ALC_EFFECTIVENESS = 0.9  # how much gets absorbed
+_bars = '▁▂▃▄▅▆▇█'
 
+CHART_HOURS = 6  # before and after now
+CHART_POINTS = 25
 
-def _get_promille_message(c: Consumer):
-    consum_history = c.get_consumption_history(
-        from_timestamp=int(time() - 3600 * 24)
-    )
 
-    decays = [FEMALE_HIGH_DECAY, FEMALE_LOW_DECAY, MALE_HIGH_DECAY, MALE_LOW_DECAY]
-    last_promille = [0.0, 0.0, 0.0, 0.0]
-    last_timestamp = 0
+def _sparkline(values, top):
+    return ''.join(
+        _bars[min(len(_bars) - 1, int(v / top * len(_bars)))] for v in values
+    )
 
-    for consumption in consum_history:
-        if not consumption.gram_alcohol:
-            continue
-        gram_alcohol = consumption.gram_alcohol * ALC_EFFECTIVENESS
 
-        instant_promille_female = gram_alcohol / c.weight / FEMALE_WATER
-        instant_promille_male = gram_alcohol / c.weight / MALE_WATER
+@tracing.traced('render promille chart')
+def _get_chart(curve: BloodAlcoholCurve, now: float):
+    t0 = now - CHART_HOURS * 3600
+    t1 = now + CHART_HOURS * 3600
+    male = curve.sample(t0, t1, CHART_POINTS, 3)
+    female = curve.sample(t0, t1, CHART_POINTS, 1)
 
-        hours_since_last_drink = (consumption.timestamp - last_timestamp) / 3600
-        for i in range(4):
-            last_promille[i] = max(0.0, last_promille[i] - decays[i] * hours_since_last_drink)
+    top = max(male + female)
+    if top == 0.0:
+        return ''
+    return (
+        '\n\nVerlauf von -{hours}h bis +{hours}h, höchstens {top:.3}{promille}:\n'
+        '{male} {male_line}\n'
+        '{female} {female_line}'
+        .format(
+            hours=CHART_HOURS,
+            top=top,
+            promille='‰',
+            male=emojis.man,
+            female=emojis.woman,
+            male_line=_sparkline(male, top),
+            female_line=_sparkline(female, top),
+        )
+    )
 
-        last_promille[0] += instant_promille_female
-        last_promille[1] += instant_promille_female
-        last_promille[2] += instant_promille_male
-        last_promille[3] += instant_promille_male
-        last_timestamp = consumption.timestamp
 
-    # Now
-    hours_since_last_drink = (time() - last_timestamp) / 3600
-    for i in range(4):
-        last_promille[i] = max(0.0, last_promille[i] - decays[i] * hours_since_last_drink)
+@tracing.traced('render promille')
+def _get_promille_message(c: Consumer):
+    now = time()
+    last_promille = blood_alcohol.levels(c, now)
+    curve = blood_alcohol.curve(c, now)
 
     male_max = last_promille[3]
     female_max = last_promille[1]
 
-    male_hours = male_max / MALE_LOW_DECAY
-    female_hours = female_max / FEMALE_LOW_DECAY
+    # Slowest decay of each sex, like the levels in bold
+    male_hours = curve.time_until_zero(now, 3) / 3600
+    female_hours = curve.time_until_zero(now, 1) / 3600
 
     return (
         'Dein angenommenes Körpergewicht ist {weight}kg.\n'
@@ -84,6 +97,7 @@ def _get_promille_message(c: Consumer):
             female_high_decay=FEMALE_HIGH_DECAY,
             female_low_decay=FEMALE_LOW_DECAY
         )
+        + _get_chart(curve, now)
     )
 
 _plus_minus_markup = InlineKeyboardMarkup([
@@ -91,7 +105,8 @@ _plus_minus_markup = InlineKeyboardMarkup([
     InlineKeyboardButton('-1kg', callback_data='promille_minus')]
 ])
 
-_what_to_escape = '.-!()'
+# MarkdownV2 reserves all of these, * is left out for the bold levels
+_what_to_escape = '_[]()~`>#+-=|{}.!'
 
 @requires_authorization
 @patch_telegram_action
@@ -0,0 +1,96 @@
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition, Lock, Thread
+from time import time
+import traceback
+
+
+class _Entry:
+    __slots__ = ('key', 'when', 'callback', 'cancelled', 'lock')
+
+    def __init__(self, key, when: float, callback):
+        self.key = key
+        self.when = when
+        self.callback = callback
+        self.cancelled = False
+        # Held while the callback runs, so cancel() can wait for it
+        self.lock = Lock()
+
+
+class Scheduler:
+    """
+    Runs keyed callbacks at given times on one thread.
+    A callback may return the time of its next run to be rescheduled,
+    or None to finish. Cancelled entries are only marked and
+    skipped when they come up, so cancel() is O(1).
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._heap = []
+        self._entries = {}
+        self._seq = count()  # tie breaker for equal times
+        self._cond = Condition()
+        self._thread = None
+
+    def schedule(self, key, when: float, callback):
+        entry = _Entry(key, when, callback)
+        with self._cond:
+            old = self._entries.get(key)
+            if old is not None:
+                old.cancelled = True
+            self._entries[key] = entry
+            heappush(self._heap, (when, next(self._seq), entry))
+            self._cond.notify()
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def cancel(self, key) -> bool:
+        """
+        Cancel an entry, returns False if there was none.
+        When this returns, its callback is not running and never will again.
+        """
+        with self._cond:
+            entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        with entry.lock:
+            entry.cancelled = True
+        return True
+
+    def pending(self) -> int:
+        return len(self._entries)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    timeout = self._heap[0][0] - time()
+                    if timeout > 0:
+                        self._cond.wait(timeout)
+                        continue
+                    _, _, entry = heappop(self._heap)
+                    if not entry.cancelled:
+                        break
+
+            with entry.lock:
+                if entry.cancelled:
+                    continue
+                try:
+                    next_run = entry.callback()
+                except Exception:
+                    traceback.print_exc()
+                    next_run = None
+
+                with self._cond:
+                    if next_run is None:
+                        entry.cancelled = True
+                        if self._entries.get(entry.key) is entry:
+                            del self._entries[entry.key]
+                    else:
+                        entry.when = next_run
+                        heappush(self._heap, (next_run, next(self._seq), entry))
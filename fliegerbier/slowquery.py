@@ -0,0 +1,168 @@
+"""
+Log of slow SQL statements in log/slow_queries.log, on with
+slowquerysecs > 0.
+
+Statements are grouped by a fingerprint, the statement with its
+literals and parameters replaced by ?. The first slow execution of a
+fingerprint is logged with the statement, its parameters and the
+query plan, which is fetched with EXPLAIN (QUERY PLAN) on a separate
+connection. Later ones only get a line with the running totals.
+Plans and writes happen on a background thread.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from hashlib import sha1
+from os import makedirs
+from os.path import join
+from re import compile
+from threading import Lock
+from time import perf_counter
+from typing import Dict
+from .config import SLOWQUERYSECS
+
+ENABLED = SLOWQUERYSECS > 0
+
+LOGDIR = './log'
+LOGFILE = join(LOGDIR, 'slow_queries.log')
+PARAMS_LENGTH = 300  # characters of the parameters that are logged
+
+# Only these can be explained without side effects
+_EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+_normalizers = [
+    (compile(r"'(?:[^']|'')*'"), '?'),
+    (compile(r'%\(\w+\)s|%s|:\w+'), '?'),
+    (compile(r'\b\d+(?:\.\d+)?\b'), '?'),
+    (compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)'), '(?+)'),
+    (compile(r'\s+'), ' '),
+]
+
+
+def fingerprint(statement: str) -> str:
+    """The statement without its values, e.g. IN lists of any length match."""
+    for pattern, replacement in _normalizers:
+        statement = pattern.sub(replacement, statement)
+    return statement.strip()
+
+
+class _Stats:
+    __slots__ = ('id', 'count', 'total', 'max')
+
+    def __init__(self, id: str):
+        self.id = id
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+
+class SlowQueryLog:
+    def __init__(self, engine, threshold: float, current_handler):
+        self.engine = engine
+        self.threshold = threshold
+        self.current_handler = current_handler
+        self._stats: Dict[str, _Stats] = {}
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='slowquery')
+        makedirs(LOGDIR, exist_ok=True)
+
+    def observe(self, statement: str, parameters, seconds: float):
+        if seconds < self.threshold:
+            return
+        handler = self.current_handler() or 'background'
+        fp = fingerprint(statement)
+        with self._lock:
+            stats = self._stats.get(fp)
+            first = stats is None
+            if first:
+                stats = self._stats[fp] = _Stats(sha1(fp.encode()).hexdigest()[:12])
+            stats.count += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            line = '{} {:.3f}s fp={} handler={} count={} avg={:.3f}s max={:.3f}s'.format(
+                datetime.now().strftime('%Y-%m-%d %H:%M:%S'), seconds, stats.id, handler,
+                stats.count, stats.total / stats.count, stats.max,
+            )
+
+        params = repr(parameters)[:PARAMS_LENGTH]
+        if first:
+            self._executor.submit(self._log_first, line, statement, parameters, params)
+        else:
+            self._executor.submit(self._write, '{}\n  params: {}\n'.format(line, params))
+
+    def summary(self):
+        """(fingerprint id, statement, count, total, max), the slowest in total first."""
+        with self._lock:
+            rows = [(s.id, fp, s.count, s.total, s.max) for fp, s in self._stats.items()]
+        return sorted(rows, key=lambda r: r[3], reverse=True)
+
+    def _log_first(self, line: str, statement: str, parameters, params: str):
+        try:
+            plan = self._explain(statement, parameters)
+        except Exception as e:
+            plan = 'EXPLAIN failed: {}: {}'.format(type(e).__name__, e)
+        self._write(
+            '{}\n  statement: {}\n  params: {}\n  plan:\n{}\n'.format(
+                line,
+                ' '.join(statement.split()),
+                params,
+                '\n'.join('    ' + l for l in plan.splitlines()),
+            )
+        )
+
+    def _explain(self, statement: str, parameters) -> str:
+        if statement.lstrip().split(None, 1)[0].upper() not in _EXPLAINABLE:
+            return '(no plan for this kind of statement)'
+        if isinstance(parameters, list):
+            # executemany, the plan is the same for every row
+            parameters = parameters[0] if parameters else ()
+        sqlite = self.engine.dialect.name == 'sqlite'
+        prefix = 'EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN '
+
+        # A pooled DBAPI connection, it does not fire the engine events
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(prefix + statement, parameters)
+            rows = cursor.fetchall()
+            cursor.close()
+        finally:
+            connection.close()
+
+        if sqlite:
+            # (id, parent, notused, detail)
+            return '\n'.join(row[-1] for row in rows)
+        return '\n'.join(' | '.join(str(v) for v in row) for row in rows)
+
+    @staticmethod
+    def _write(text: str):
+        with open(LOGFILE, 'a', encoding='utf-8') as f:
+            f.write(text)
+
+
+slow_query_log: SlowQueryLog = None
+
+
+def install(engine):
+    """Time every statement on engine, if enabled."""
+    global slow_query_log
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+    from .decorators import current_handler
+
+    slow_query_log = SlowQueryLog(engine, SLOWQUERYSECS, current_handler)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('slowquery_start', []).append(perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        start = conn.info['slowquery_start'].pop()
+        slow_query_log.observe(statement, parameters, perf_counter() - start)
+
+    @event.listens_for(engine, 'handle_error')
+    def error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('slowquery_start'):
+            conn.info['slowquery_start'].pop()
@@ -1,23 +1,31 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from typing import List
+from typing import List, Dict, Tuple, NamedTuple, Mapping
+from types import MappingProxyType
+from time import time
 from .decorators import patch_telegram_action, requires_authorization
 from .database import Consumer, ConsumptionEntry
-from .items import item_list, Item
+from .items import get_catalog, Item
 from .datecalculation import get_month
 from re import compile
+from gzip import GzipFile
+from tempfile import SpooledTemporaryFile
+from .config import CSVGZIP
+from .periodcache import period_cache
+from . import tracing
+
+
+CSV_SPOOL_SIZE = 1024 * 1024  # bytes
 
 
 def _item_emoji(item_name: str, ) -> str:
-    for it in item_list:
-        if it.name == item_name:
-            return it.emoji
+    item = get_catalog().by_name.get(item_name)
+    if item is not None:
+        return item.emoji
 
     return '🌀'  # Emoji for unknown item
 
 
-def statistics_to_message(stats: List[ConsumptionEntry]) -> str:
-    msg = ''
-    sum_ = 0
+def _count_drinks(stats: List[ConsumptionEntry]) -> Dict[Tuple[str, float], int]:
     drinks_counter_sum = {
         #(Bier, 1.0): 6
     }
@@ -25,6 +33,17 @@ def statistics_to_message(stats: List[ConsumptionEntry]) -> str:
     for consumption in stats:
         key = (consumption.item_name, consumption.price_at_time)
         drinks_counter_sum[key] = drinks_counter_sum.get(key, 0) + 1
+    return drinks_counter_sum
+
+
+def statistics_to_message(stats: List[ConsumptionEntry]) -> str:
+    return _totals_to_message(_count_drinks(stats))
+
+
+@tracing.traced('render statistics')
+def _totals_to_message(drinks_counter_sum: Dict[Tuple[str, float], int]) -> str:
+    msg = ''
+    sum_ = 0
 
     for key in sorted(drinks_counter_sum.keys()):
         item_name, item_price_at_time = key
@@ -46,6 +65,33 @@ def statistics_to_message(stats: List[ConsumptionEntry]) -> str:
     return msg
 
 
+class PeriodStatistics(NamedTuple):
+    totals: Mapping[Tuple[str, float], int]
+    message: str
+
+
+def get_period_statistics(c: Consumer, from_timestamp: int, to_timestamp: int) -> PeriodStatistics:
+    """Totals and rendered message, cached once the period has ended."""
+    def compute():
+        stats = c.get_consumption_history(
+            from_timestamp=from_timestamp,
+            to_timestamp=to_timestamp,
+        )
+        totals = _count_drinks(stats)
+        # Shared by all readers of the cache
+        return PeriodStatistics(MappingProxyType(totals), _totals_to_message(totals))
+
+    if to_timestamp > time():
+        return compute()
+    # The message shows emojis of the catalog, render it again after a reload
+    # A hit neither loads the users row nor queries the consumptions
+    return period_cache.get(
+        c.chat_id, from_timestamp, to_timestamp, compute,
+        akaflieg_id=lambda: c.snapshot and c.snapshot.akaflieg_id,
+        version=get_catalog().version,
+    )
+
+
 def get_markup(around_month: int = 0):
     prev_month = get_month(around_month + 1)
     prev_text = '« {} {}'.format(
@@ -103,11 +149,9 @@ def update_user_statistics(edit, chat_id, original_message_id, callback_data, co
         desired_month = get_month(desired_month_n)
 
         msg = '{} {}\n\n'.format(desired_month.year, desired_month.month_name)
-        stats = c.get_consumption_history(
-            from_timestamp=desired_month.start_ts,
-            to_timestamp=desired_month.end_ts,
-        )
-        msg += statistics_to_message(stats)
+        msg += get_period_statistics(
+            c, desired_month.start_ts, desired_month.end_ts
+        ).message
 
         edit(message_id=original_message_id, new_text=msg, reply_markup=get_markup(around_month=desired_month_n))
 
@@ -130,39 +174,52 @@ def update_user_statistics(edit, chat_id, original_message_id, callback_data, co
     )
 
 
-@patch_telegram_action
-def get_user_csv(chat_id, commit_callback, respond):
-    from io import BytesIO
-    commit_callback()
-    c = Consumer(chat_id)
-
-    history = c.get_consumption_history()
-    
-    bio = BytesIO()
-    bio.write('Datum und Uhrzeit;Getränk;Preis des Getränks\n'.encode('utf-8'))
+@tracing.traced('render csv')
+def _write_csv(out, history):
+    out.write('Datum und Uhrzeit;Getränk;Preis des Getränks\n'.encode('utf-8'))
 
     sum_ = 0
+    lines = []
     for entry in history:
         sum_ += entry.price_at_time
-        bio.write(
+        lines.append(
             '{};{};{}€\n'
             .format(
                 entry.datetime,
                 entry.item_name,
                 entry.price_at_time
-            ).encode('utf-8')
+            )
         )
+        if len(lines) >= 500:
+            out.write(''.join(lines).encode('utf-8'))
+            lines = []
+    out.write(''.join(lines).encode('utf-8'))
 
-    bio.write(
+    out.write(
         'In der Summe;;{}€'.format(sum_).encode('utf-8')
     )
 
-    bio.name = 'Gesamtliste.csv'
-    bio.seek(0)
 
-    respond(
-        'Gesamtliste.csv',
-        file=bio
-    )
+@patch_telegram_action
+def get_user_csv(chat_id, commit_callback, respond):
+    commit_callback()
+    c = Consumer(chat_id)
 
-    
+    filename = 'Gesamtliste.csv'
+    # Stays in memory for short histories, goes to disk for long ones
+    with SpooledTemporaryFile(max_size=CSV_SPOOL_SIZE) as f:
+        history = c.iter_consumption_history()
+        if CSVGZIP:
+            with GzipFile(filename=filename, mode='wb', fileobj=f) as gz:
+                _write_csv(gz, history)
+            filename += '.gz'
+        else:
+            _write_csv(f, history)
+        f.seek(0)
+
+        # Waits until the file is sent
+        respond(
+            filename,
+            file=f,
+            filename=filename,
+        )
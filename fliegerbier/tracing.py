@@ -0,0 +1,202 @@
+"""
+Sampled traces of single updates, tracesample = 0.1 in config.ini
+traces every tenth update. 0 turns tracing off.
+
+A trace is a tree of spans: the patch_telegram_action wrappers of an
+update, the SQL statements, the Bot API calls (also the ones the
+outbox sends later on its own threads) and rendering steps. Finished
+traces are kept in a ring buffer for /traces and, with tracefile,
+appended to a JSON-lines file.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from random import random
+from threading import local, Lock
+from time import perf_counter, time
+from typing import List
+from uuid import uuid4
+import json
+from .config import TRACESAMPLE, TRACEFILE, TRACEBUFFER
+
+ENABLED = TRACESAMPLE > 0
+
+
+class Span:
+    __slots__ = ('name', 'start', 'end', 'attributes', 'children')
+
+    def __init__(self, name: str, attributes: dict = None):
+        self.name = name
+        self.start = perf_counter()
+        self.end = None
+        self.attributes = attributes
+        self.children: List['Span'] = []
+
+    @property
+    def duration(self) -> float:
+        end = self.end if self.end is not None else perf_counter()
+        return end - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        d = {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+        }
+        if self.attributes:
+            d['attributes'] = self.attributes
+        if self.children:
+            d['children'] = [c.to_dict(origin) for c in self.children]
+        return d
+
+
+class Trace:
+    __slots__ = ('id', 'started_at', 'root')
+
+    def __init__(self, name: str):
+        self.id = uuid4().hex[:16]
+        self.started_at = time()
+        self.root = Span(name)
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.id,
+            'started_at': self.started_at,
+            'duration_ms': round(self.root.duration * 1000, 3),
+            'root': self.root.to_dict(self.root.start),
+        }
+
+
+_current = local()
+_finished = deque(maxlen=TRACEBUFFER)
+_finished_lock = Lock()
+_exporter = ThreadPoolExecutor(1, thread_name_prefix='trace-export') if TRACEFILE else None
+
+
+def current() -> Span:
+    """The innermost open span of this thread, None outside a trace."""
+    return getattr(_current, 'span', None)
+
+
+def begin(name: str) -> Trace:
+    """Start a trace for this thread, if the update is sampled."""
+    if random() >= TRACESAMPLE:
+        return None
+    trace = Trace(name)
+    _current.span = trace.root
+    return trace
+
+
+def end(trace: Trace):
+    trace.root.end = perf_counter()
+    _current.span = None
+    with _finished_lock:
+        _finished.append(trace)
+    if _exporter is not None:
+        _exporter.submit(_export, trace)
+
+
+def _export(trace: Trace):
+    with open(TRACEFILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(trace.to_dict(), ensure_ascii=False) + '\n')
+
+
+class _SpanContext:
+    __slots__ = ('parent', 'span', 'previous')
+
+    def __init__(self, parent: Span, name: str, attributes: dict):
+        self.parent = parent
+        self.span = Span(name, attributes)
+
+    def __enter__(self):
+        self.previous = current()
+        self.parent.children.append(self.span)
+        _current.span = self.span
+        return self.span
+
+    def __exit__(self, *exc):
+        self.span.end = perf_counter()
+        _current.span = self.previous
+
+
+class _NoSpan:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_span = _NoSpan()
+
+
+def span(name: str, parent: Span = None, **attributes):
+    """
+    Child span of parent, or of the current span of this thread.
+    Does nothing outside a sampled trace.
+    """
+    if parent is None:
+        parent = current()
+        if parent is None:
+            return _no_span
+    return _SpanContext(parent, name, attributes or None)
+
+
+def traced(name: str):
+    """Decorator for a span around a function, e.g. rendering."""
+    def decorator(f):
+        if not ENABLED:
+            return f
+
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        wrapper.__name__ = f.__name__
+        wrapper.__qualname__ = f.__qualname__
+        return wrapper
+    return decorator
+
+
+def slowest(n: int, since: float) -> List[Trace]:
+    with _finished_lock:
+        traces = [t for t in _finished if t.started_at >= since]
+    return sorted(traces, key=lambda t: t.root.duration, reverse=True)[:n]
+
+
+def format_trace(trace: Trace, max_spans: int = 25) -> str:
+    lines = []
+
+    def walk(s: Span, depth: int):
+        if len(lines) >= max_spans:
+            return
+        label = s.name
+        if s.attributes:
+            label += ' ' + ' '.join(str(v)[:60] for v in s.attributes.values())
+        lines.append('{}{:.1f}ms {}'.format('  ' * depth, s.duration * 1000, label))
+        for child in s.children:
+            walk(child, depth + 1)
+
+    walk(trace.root, 0)
+    return '\n'.join(lines)
+
+
+def install(engine):
+    """A span per SQL statement, if tracing is enabled."""
+    if not ENABLED:
+        return
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(conn, cursor, statement, parameters, context, executemany):
+        s = span('sql', statement=' '.join(statement.split())[:200])
+        s.__enter__()
+        conn.info.setdefault('trace_spans', []).append(s)
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after(conn, cursor, statement, parameters, context, executemany):
+        conn.info['trace_spans'].pop().__exit__()
+
+    @event.listens_for(engine, 'handle_error')
+    def error(exception_context):
+        conn = exception_context.connection
+        if conn is not None and conn.info.get('trace_spans'):
+            conn.info['trace_spans'].pop().__exit__()
@@ -0,0 +1,76 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import loads
+from threading import BoundedSemaphore
+from telegram import Update
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, status: int):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path != self.server.path:
+            self._reply(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = loads(self.rfile.read(length))
+            # Valid JSON, but not an update, e.g. [] or "x"
+            if not isinstance(body, dict):
+                raise ValueError('not an object')
+            update = Update.de_json(body, self.server.dispatcher.bot)
+            if update is None:
+                raise ValueError('empty update')
+        except (ValueError, TypeError, AttributeError, KeyError):
+            self._reply(400)
+            return
+
+        # Telegram delivers the update again later
+        if self.server.dispatcher.update_queue.qsize() >= self.server.queue_size:
+            self._reply(503)
+            return
+
+        # The dispatcher thread runs the handlers, like after getUpdates
+        self.server.dispatcher.update_queue.put(update)
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        # Every update is logged by the handlers already
+        pass
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    Receives updates from Telegram and puts them into the dispatcher's
+    update queue. At most max_connections requests are read at once,
+    further connections wait in the listen backlog until a slot is free.
+    While queue_size updates are waiting, new ones are refused with 503
+    and Telegram retries them.
+    """
+    daemon_threads = True
+
+    def __init__(self, dispatcher, listen: str, port: int, secret: str, max_connections: int, queue_size: int):
+        self.dispatcher = dispatcher
+        self.queue_size = queue_size
+        # Only Telegram knows the secret path
+        self.path = '/' + secret
+        self._slots = BoundedSemaphore(max_connections)
+        super().__init__((listen, port), _WebhookHandler)
+
+    def process_request(self, request, client_address):
+        # Blocks the accept loop while all slots are busy
+        self._slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
@@ -0,0 +1,20 @@
+# fliegerbier reads config.ini and the item list from the working
+# directory on import, give the tests a throwaway one.
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_directory = tempfile.mkdtemp(prefix='fliegerbier-test-')
+with open(os.path.join(_directory, 'config.ini'), 'w') as f:
+    f.write(
+        '[config]\n'
+        'bottoken = 123:abc\n'
+        'database = sqlite:///./test.sqlite3\n'
+        'adminchat = -1\n'
+        'itemcsv = items.csv\n'
+    )
+with open(os.path.join(_directory, 'items.csv'), 'w') as f:
+    f.write('Bier ; 1.0 ; 🍺 ; 16.5\n')
+os.chdir(_directory)
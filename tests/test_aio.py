@@ -0,0 +1,61 @@
+import sqlite3
+from unittest import mock
+
+import pytest
+
+from fliegerbier import aio
+from fliegerbier.database import Booking, Database
+from fliegerbier.items import Item
+from fliegerbier.migrations import migrate
+
+BIER = Item('Bier', 1.0, alcohol=16.5)
+
+
+@pytest.fixture(scope='module')
+def loop():
+    migrate(out=lambda line: None)
+    aio.start()
+
+
+def run(coro):
+    return aio.submit(coro).result(timeout=10)
+
+
+def test_duplicate_idempotency_key_returns_first_row(loop):
+    first = run(aio.enter_consumption(1, BIER, 1600000000, idempotency_key='tg_1_1'))
+    again = run(aio.enter_consumption(1, BIER, 1600000000, idempotency_key='tg_1_1'))
+    assert first.new and not again.new
+    assert first.rowid == again.rowid
+
+
+def test_reverted_key_is_not_booked_again(loop):
+    first = run(aio.enter_consumption(1, BIER, 1600000000, idempotency_key='tg_1_3'))
+    Database().remove_consumption(first.rowid)
+    assert run(aio.enter_consumption(1, BIER, 1600000000, idempotency_key='tg_1_3')) == (None, False)
+
+
+def test_other_errors_are_raised(loop):
+    async def broken(*args, **kwargs):
+        raise sqlite3.OperationalError('database is locked')
+
+    with mock.patch.object(aio._database, 'execute', broken):
+        with pytest.raises(sqlite3.OperationalError):
+            run(aio.enter_consumption(1, BIER, 1600000000, idempotency_key='tg_1_2'))
+
+
+def test_unique_violation():
+    assert aio._is_unique_violation(
+        sqlite3.IntegrityError('UNIQUE constraint failed: consumptions.idempotency_key')
+    )
+    assert not aio._is_unique_violation(
+        sqlite3.IntegrityError('NOT NULL constraint failed: consumptions.id')
+    )
+    assert not aio._is_unique_violation(ConnectionError())
+
+
+def test_write_buffer_is_used(loop):
+    with mock.patch.object(aio, 'WRITEBUFFER', True), \
+            mock.patch('fliegerbier.database.WRITEBUFFER', True), \
+            mock.patch('fliegerbier.database.write_buffer.submit', return_value=Booking(42, True)) as submit:
+        assert run(aio.enter_consumption(1, BIER, 1600000000)) == (42, True)
+    assert submit.call_count == 1
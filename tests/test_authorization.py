@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+
+from fliegerbier import database
+from fliegerbier.config import AUTHCACHETTL
+from fliegerbier.migrations import migrate
+
+USER = SimpleNamespace(username='otto', first_name='Otto', last_name=None)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def db():
+    migrate(out=lambda line: None)
+
+
+def lookup(chat_id, now):
+    with mock.patch.object(database, 'time', return_value=now), database._authorization_lock:
+        return database._lookup_authorization(chat_id, USER)
+
+
+def test_expired_entries_are_evicted():
+    database.invalidate_authorization()
+    for chat_id in range(8000, 8010):
+        lookup(chat_id, 1000.0)
+    lookup(8010, 1000.0 + AUTHCACHETTL / 2)
+    assert len(database._authorization_cache) == 11
+
+    lookup(8011, 1001.0 + AUTHCACHETTL)
+    assert list(database._authorization_cache) == [8010, 8011]
+
+
+def test_lookup_again_moves_to_the_end():
+    database.invalidate_authorization()
+    lookup(8100, 1000.0)
+    lookup(8101, 1000.0 + AUTHCACHETTL / 2)
+    lookup(8100, 1000.0 + AUTHCACHETTL / 2 + 1)
+    lookup(8102, 1001.0 + AUTHCACHETTL)
+    # 8100 was refreshed after 8101 and must not shadow its expiry
+    assert list(database._authorization_cache) == [8101, 8100, 8102]
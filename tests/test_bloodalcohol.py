@@ -0,0 +1,225 @@
+from random import Random
+from typing import NamedTuple
+
+import pytest
+
+from fliegerbier.bloodalcohol import (
+    BloodAlcoholCache,
+    FEMALE_HIGH_DECAY,
+    FEMALE_LOW_DECAY,
+    MALE_HIGH_DECAY,
+    MALE_LOW_DECAY,
+    FEMALE_WATER,
+    MALE_WATER,
+    ALC_EFFECTIVENESS,
+    WINDOW,
+)
+
+START = 1600000000
+
+
+class Entry(NamedTuple):
+    rowid: int
+    timestamp: int
+    gram_alcohol: float
+
+
+class FakeConsumer:
+    """The parts of database.Consumer the cache uses, counting replays."""
+    def __init__(self, akaflieg_id=1, weight=70):
+        self.akaflieg_id = akaflieg_id
+        self.weight = weight
+        self.entries = []
+        self.replays = 0
+
+    def get_consumption_history(self, from_timestamp=0, to_timestamp=None):
+        self.replays += 1
+        return sorted(
+            (e for e in self.entries if e.timestamp >= from_timestamp
+             and (to_timestamp is None or e.timestamp < to_timestamp)),
+            key=lambda e: (e.timestamp, e.rowid),
+        )
+
+
+def old_loop(consumer: FakeConsumer, now: float):
+    """The promille calculation before the cache, with time() as now."""
+    consum_history = consumer.get_consumption_history(
+        from_timestamp=int(now - 3600 * 24)
+    )
+
+    decays = [FEMALE_HIGH_DECAY, FEMALE_LOW_DECAY, MALE_HIGH_DECAY, MALE_LOW_DECAY]
+    last_promille = [0.0, 0.0, 0.0, 0.0]
+    last_timestamp = 0
+
+    for consumption in consum_history:
+        if not consumption.gram_alcohol:
+            continue
+        gram_alcohol = consumption.gram_alcohol * ALC_EFFECTIVENESS
+
+        instant_promille_female = gram_alcohol / consumer.weight / FEMALE_WATER
+        instant_promille_male = gram_alcohol / consumer.weight / MALE_WATER
+
+        hours_since_last_drink = (consumption.timestamp - last_timestamp) / 3600
+        for i in range(4):
+            last_promille[i] = max(0.0, last_promille[i] - decays[i] * hours_since_last_drink)
+
+        last_promille[0] += instant_promille_female
+        last_promille[1] += instant_promille_female
+        last_promille[2] += instant_promille_male
+        last_promille[3] += instant_promille_male
+        last_timestamp = consumption.timestamp
+
+    hours_since_last_drink = (now - last_timestamp) / 3600
+    for i in range(4):
+        last_promille[i] = max(0.0, last_promille[i] - decays[i] * hours_since_last_drink)
+    return last_promille
+
+
+class World:
+    """Books drinks like database.Consumer.consume/unconsume do."""
+    def __init__(self, consumer: FakeConsumer):
+        self.consumer = consumer
+        self.cache = BloodAlcoholCache()
+        self.next_rowid = 1
+
+    def drink(self, timestamp: int, gram_alcohol: float):
+        entry = Entry(self.next_rowid, timestamp, gram_alcohol)
+        self.next_rowid += 1
+        self.consumer.entries.append(entry)
+        self.cache.record(self.consumer.akaflieg_id, entry.rowid, timestamp, gram_alcohol)
+        return entry
+
+    def revert(self, entry: Entry):
+        self.consumer.entries.remove(entry)
+        self.cache.forget(self.consumer.akaflieg_id, entry.rowid)
+
+    def check(self, now: float):
+        cached = self.cache.levels(self.consumer, now)
+        replays = self.consumer.replays
+        expected = old_loop(self.consumer, now)
+        self.consumer.replays = replays
+        assert cached == expected
+        return cached
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_random_history_matches_old_loop(seed):
+    rng = Random(seed)
+    world = World(FakeConsumer(weight=rng.randint(50, 110)))
+    now = START
+
+    for _ in range(300):
+        action = rng.random()
+        if action < 0.45:
+            now += rng.choice([0, 1, 60, 900, 3600])
+            world.drink(now, rng.choice([0.0, 8.0, 16.5, 30.0]))
+        elif action < 0.55 and world.consumer.entries:
+            # Usually the latest drink, sometimes an older one
+            entries = sorted(world.consumer.entries, key=lambda e: (e.timestamp, e.rowid))
+            world.revert(entries[-1] if rng.random() < 0.8 else rng.choice(entries[-5:]))
+        elif action < 0.62:
+            world.consumer.weight = max(40, world.consumer.weight + rng.choice([-1, 1]))
+        elif action < 0.67:
+            # Everything leaves the window
+            now += WINDOW + rng.randint(0, 7200)
+        else:
+            now += rng.randint(0, 4 * 3600)
+        world.check(now + rng.random())
+
+
+def test_incremental_updates_do_not_replay():
+    world = World(FakeConsumer())
+    world.drink(START, 16.5)
+    world.check(START + 10)
+    assert world.consumer.replays == 1
+
+    world.drink(START + 600, 16.5)
+    latest = world.drink(START + 1200, 30.0)
+    world.check(START + 1300)
+    world.revert(latest)
+    world.check(START + 1400)
+    assert world.consumer.replays == 1
+
+
+def test_weight_change_with_drinks_in_window_replays():
+    world = World(FakeConsumer())
+    world.drink(START, 16.5)
+    world.check(START + 10)
+    world.consumer.weight += 1
+    world.check(START + 20)
+    assert world.consumer.replays == 2
+
+
+def test_out_of_order_drink_replays():
+    world = World(FakeConsumer())
+    world.drink(START + 600, 16.5)
+    world.check(START + 700)
+    world.drink(START, 16.5)
+    world.check(START + 800)
+    assert world.consumer.replays == 2
+
+
+def test_revert_of_older_drink_replays():
+    world = World(FakeConsumer())
+    first = world.drink(START, 16.5)
+    world.drink(START + 600, 16.5)
+    world.check(START + 700)
+    world.revert(first)
+    world.check(START + 800)
+    assert world.consumer.replays == 2
+
+
+def test_episode_older_than_window_replays():
+    # Enough to still be drunk when the first drinks leave the window
+    world = World(FakeConsumer(weight=50))
+    for k in range(12):
+        world.drink(START + k * 1800, 40.0)
+    world.check(START + 6 * 3600)
+    assert world.consumer.replays == 1
+    world.check(START + WINDOW + 3600)
+    assert world.consumer.replays == 2
+
+
+def test_earlier_query_replays():
+    world = World(FakeConsumer())
+    world.drink(START, 16.5)
+    world.drink(START + WINDOW + 3600, 16.5)
+    world.check(START + WINDOW + 7200)
+    # The replay for the later window dropped the first drink
+    world.check(START + 1800)
+    # Before the latest drink
+    world.check(START + WINDOW)
+    assert world.consumer.replays == 3
+
+
+def test_earlier_query_sees_drinks_the_later_window_dropped():
+    world = World(FakeConsumer(weight=50))
+    for k in range(12):
+        world.drink(START + k * 1800, 40.0)
+    # Replays from START + 1, without the first drink
+    later = world.check(START + WINDOW + 1)
+    earlier = world.check(START + WINDOW - 60)
+    assert earlier != later
+
+
+def test_curve_matches_levels():
+    world = World(FakeConsumer())
+    for k in range(6):
+        world.drink(START + k * 1200, 16.5)
+    now = START + 3 * 3600
+    curve = world.cache.curve(world.consumer, now)
+    levels = world.check(now)
+    assert [curve.level_at(now, model) for model in range(4)] == levels
+
+
+def test_time_until_zero_matches_levels():
+    from fliegerbier.bloodalcohol import DECAYS
+    world = World(FakeConsumer())
+    for k in range(4):
+        world.drink(START + k * 900, 16.5)
+    now = START + 5000
+    levels = world.check(now)
+    curve = world.cache.curve(world.consumer, now)
+    for model in range(4):
+        assert curve.time_until_zero(now, model) / 3600 == pytest.approx(levels[model] / DECAYS[model])
+    assert curve.time_until_zero(now + 24 * 3600, 1) == 0.0
@@ -0,0 +1,49 @@
+from random import Random
+
+import pytest
+
+from fliegerbier.bloodalcohol import BloodAlcoholState, WINDOW
+from fliegerbier.bloodalcohol_bulk import levels_from_rows
+
+START = 1600000000
+
+
+def random_rows(rng: Random):
+    """Histories like get_alcohol_consumptions returns, very uneven in length."""
+    rows = []
+    for akaflieg_id in sorted(rng.sample(range(1, 1000), rng.randint(1, 25))):
+        weight = rng.randint(50, 110)
+        timestamp = START
+        n_drinks = rng.choice([1, 2, 3, rng.randint(1, 80)])
+        for _ in range(n_drinks):
+            timestamp += rng.choice([0, 1, 60, 900, 3600, rng.randint(0, 6 * 3600)])
+            rows.append((akaflieg_id, 'Pilot {}'.format(akaflieg_id), weight, timestamp, rng.choice([8, 16, 30])))
+    return rows
+
+
+def scalar_levels(rows, now):
+    """Per user through BloodAlcoholState, the path of the promille command."""
+    states = {}
+    for rowid, (akaflieg_id, _, weight, timestamp, gram_alcohol) in enumerate(rows):
+        state = states.setdefault(akaflieg_id, BloodAlcoholState(weight))
+        assert state.add(rowid, timestamp, gram_alcohol)
+    return {akaflieg_id: state.levels_at(now) for akaflieg_id, state in states.items()}
+
+
+@pytest.mark.parametrize('seed', range(30))
+def test_bulk_matches_scalar(seed):
+    rng = Random(seed)
+    rows = random_rows(rng)
+    now = max(r[3] for r in rows) + rng.randint(0, WINDOW)
+
+    bulk = levels_from_rows(rows, now)
+    expected = scalar_levels(rows, now)
+
+    assert sorted(expected) == list(bulk.akaflieg_ids)
+    for i, akaflieg_id in enumerate(bulk.akaflieg_ids):
+        assert bulk.full_names[i] == 'Pilot {}'.format(akaflieg_id)
+        assert list(bulk.levels[i]) == pytest.approx(expected[akaflieg_id], rel=1e-12, abs=1e-12)
+
+
+def test_no_rows():
+    assert levels_from_rows([], START).levels.shape == (0, 4)
@@ -0,0 +1,58 @@
+from unittest import mock
+
+import pytest
+from sqlalchemy import func, select
+
+from fliegerbier.database import Database, _db, consumptions, reverted_consumptions, TOMBSTONE_AGE
+from fliegerbier.items import Item
+from fliegerbier.migrations import migrate
+
+MATE = Item('Mate', 0.4)
+AKAFLIEG_ID = 6060
+TIMESTAMP = 1600000000
+
+
+@pytest.fixture(scope='module')
+def db():
+    migrate(out=lambda line: None)
+    return Database()
+
+
+def booked(key):
+    with _db.connect() as con:
+        return con.execute(
+            select([func.count()]).where(consumptions.c.idempotency_key == key)
+        ).scalar()
+
+
+@pytest.fixture(params=[False, True], ids=['direct', 'write buffer'])
+def write_buffer(request):
+    with mock.patch('fliegerbier.database.WRITEBUFFER', request.param):
+        yield request.param
+
+
+def test_redelivery_is_not_new(db, write_buffer):
+    key = 'idem_1_{}'.format(int(write_buffer))
+    first = db.enter_consumption(AKAFLIEG_ID, MATE, TIMESTAMP, key)
+    again = db.enter_consumption(AKAFLIEG_ID, MATE, TIMESTAMP, key)
+    assert first.new and not again.new
+    assert again.rowid == first.rowid
+    assert booked(key) == 1
+
+
+def test_redelivery_after_revert_books_nothing(db, write_buffer):
+    key = 'idem_2_{}'.format(int(write_buffer))
+    first = db.enter_consumption(AKAFLIEG_ID, MATE, TIMESTAMP, key)
+    db.remove_consumption(first.rowid)
+    assert db.enter_consumption(AKAFLIEG_ID, MATE, TIMESTAMP, key) == (None, False)
+    assert booked(key) == 0
+
+
+def test_old_tombstones_are_pruned(db):
+    with _db.connect() as con:
+        con.execute(reverted_consumptions.insert().values(idempotency_key='idem_3_1', reverted_at=0))
+    db.remove_consumption(db.enter_consumption(AKAFLIEG_ID, MATE, TIMESTAMP, 'idem_3_2').rowid)
+    with _db.connect() as con:
+        keys = {r[0] for r in con.execute(select([reverted_consumptions.c.idempotency_key]))}
+    assert 'idem_3_2' in keys and 'idem_3_1' not in keys
+    assert TOMBSTONE_AGE > 24 * 3600
@@ -0,0 +1,70 @@
+import json
+from os.path import join
+from time import monotonic
+
+from telegram import Update
+
+from fliegerbier.log import LOGDIR, LogWriter, log_incoming_other, log_writer
+
+
+def lines(chat_id):
+    with open(join(LOGDIR, 'user_{}.jsonl'.format(chat_id)), encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_bad_record_does_not_lose_the_batch(capsys):
+    writer = LogWriter(max_open_files=4)
+    writer.write({'ts': 1.0, 'chat': 7001, 'text': 'vorher'}, 'vorher\n')
+    # Not JSON serializable
+    writer.write({'ts': 2.0, 'chat': 7001, 'text': {'kaputt'}}, 'kaputt\n')
+    writer.write({'ts': 3.0, 'event': 'ohne chat'}, 'ohne chat\n')
+    writer.write({'ts': 4.0, 'chat': 7001, 'text': 'nachher'}, 'nachher\n')
+
+    started = monotonic()
+    writer.flush(timeout=5)
+    assert monotonic() - started < 2
+
+    assert [r['text'] for r in lines(7001)] == ['vorher', 'nachher']
+    assert writer.errors == 2
+    assert 'nachher' in capsys.readouterr().out
+
+
+def test_flush_returns_when_the_batch_fails():
+    writer = LogWriter(max_open_files=4)
+
+    def broken(batch):
+        raise OSError('disk full')
+    writer._write_records = broken
+    writer.write({'ts': 1.0, 'chat': 7002, 'text': 'x'}, 'x\n')
+
+    started = monotonic()
+    writer.flush(timeout=5)
+    assert monotonic() - started < 2
+    del writer._write_records
+
+
+def test_other_updates_are_logged():
+    edited = Update.de_json({
+        'update_id': 1,
+        'edited_message': {
+            'message_id': 3, 'date': 1589068800, 'edit_date': 1589068900,
+            'chat': {'id': 7003, 'type': 'private'},
+            'from': {'id': 7003, 'is_bot': False, 'first_name': 'Otto'},
+            'text': 'korrigiert',
+        },
+    }, None)
+    answer = Update.de_json({
+        'update_id': 2,
+        'poll_answer': {
+            'poll_id': 'p', 'option_ids': [0],
+            'user': {'id': 7004, 'is_bot': False, 'first_name': 'Anna'},
+        },
+    }, None)
+    log_incoming_other(edited.effective_user, edited)
+    log_incoming_other(answer.effective_user, answer)
+    log_writer.flush()
+
+    [record] = lines(7003)
+    assert (record['event'], record['type'], record['user']['id']) == ('update', 'edited_message', 7003)
+    # No chat, filed under the user
+    assert lines(7004)[0]['type'] == 'poll_answer'
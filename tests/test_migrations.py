@@ -0,0 +1,117 @@
+import os
+import subprocess
+import sys
+
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import mysql, postgresql
+
+from fliegerbier.database import consumptions
+from fliegerbier.migrations import migrate, migrations, current_version
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The schema before the first migration
+BASELINE = [
+    'CREATE TABLE consumptions ('
+    ' id INTEGER NOT NULL PRIMARY KEY,'
+    ' akaflieg_id INTEGER,'
+    ' timestamp INTEGER,'
+    ' item_name VARCHAR,'
+    ' item_price_at_this_time FLOAT,'
+    ' gram_alcohol INTEGER)',
+    'CREATE TABLE users ('
+    ' chat_id INTEGER NOT NULL PRIMARY KEY,'
+    ' nickname VARCHAR,'
+    ' akaflieg_id INTEGER UNIQUE,'
+    ' full_name VARCHAR,'
+    ' telegram_names VARCHAR,'
+    ' weight INTEGER)',
+]
+
+
+def baseline_engine(path):
+    engine = sqlalchemy.create_engine('sqlite:///' + str(path))
+    with engine.connect() as con:
+        for statement in BASELINE:
+            con.execute(statement)
+        con.execute(
+            'INSERT INTO consumptions (akaflieg_id, timestamp, item_name, '
+            'item_price_at_this_time, gram_alcohol) VALUES '
+            "(1, 1600000000, 'Bier', 1.0, 16), (1, 1600000100, 'Bier', 1.0, 16)"
+        )
+    return engine
+
+
+def test_dry_run_changes_nothing(tmp_path):
+    engine = baseline_engine(tmp_path / 'db.sqlite3')
+    out = []
+    todo = migrate(engine, dry_run=True, out=out.append)
+    assert todo == migrations
+    assert any('CREATE TABLE schema_versions' in line for line in out)
+    assert current_version(engine) == 0
+    assert not engine.dialect.has_table(engine.connect(), 'consumption_monthly_totals')
+
+
+def test_migrate_baseline(tmp_path):
+    engine = baseline_engine(tmp_path / 'db.sqlite3')
+    assert migrate(engine, out=lambda line: None) == migrations
+    assert current_version(engine) == migrations[-1].version
+    assert migrate(engine, out=lambda line: None) == []
+
+    with engine.connect() as con:
+        indexes = {i['name'] for i in sqlalchemy.inspect(con).get_indexes('consumptions')}
+        assert 'ix_consumptions_akaflieg_id_timestamp' in indexes
+        assert 'ux_consumptions_idempotency_key' in indexes
+        totals = con.execute(
+            'SELECT akaflieg_id, item_name, count FROM consumption_monthly_totals'
+        ).fetchall()
+    assert totals == [(1, 'Bier', 2)]
+
+
+def test_migrate_fresh(tmp_path):
+    engine = sqlalchemy.create_engine('sqlite:///' + str(tmp_path / 'db.sqlite3'))
+    assert migrate(engine, out=lambda line: None) == migrations
+    assert current_version(engine) == migrations[-1].version
+    assert migrate(engine, out=lambda line: None) == []
+
+
+def test_command_line_dry_run(tmp_path):
+    baseline_engine(tmp_path / 'db.sqlite3')
+    (tmp_path / 'config.ini').write_text(
+        '[config]\n'
+        'bottoken = 123:abc\n'
+        'database = sqlite:///./db.sqlite3\n'
+        'adminchat = -1\n'
+        'itemcsv = items.csv\n'
+    )
+    (tmp_path / 'items.csv').write_text('Bier ; 1.0 ; 🍺 ; 16.5\n', encoding='utf-8')
+
+    result = subprocess.run(
+        [sys.executable, '-m', 'fliegerbier.migrations', '--dry-run'],
+        cwd=str(tmp_path),
+        env=dict(os.environ, PYTHONPATH=REPO),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    assert result.returncode == 0, result.stderr
+    assert '{} migration(s) pending.'.format(len(migrations)) in result.stdout
+
+
+def test_gram_alcohol_keeps_fractions(tmp_path):
+    engine = baseline_engine(tmp_path / 'db.sqlite3')
+    migrate(engine, out=lambda line: None)
+    with engine.connect() as con:
+        con.execute(
+            'INSERT INTO consumptions (akaflieg_id, timestamp, item_name, '
+            "item_price_at_this_time, gram_alcohol) VALUES (1, 1600000200, 'Bier', 1.0, 16.5)"
+        )
+        assert con.execute('SELECT gram_alcohol FROM consumptions WHERE timestamp = 1600000200').scalar() == 16.5
+
+
+@pytest.mark.parametrize('dialect', [postgresql.dialect(), mysql.dialect()])
+def test_gram_alcohol_is_double_precision(dialect):
+    column_type = consumptions.c.gram_alcohol.type.compile(dialect=dialect)
+    # MySQL makes FLOAT(53) a DOUBLE
+    assert column_type == 'FLOAT(53)'
@@ -0,0 +1,41 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy.dialects import mysql, postgresql
+
+from fliegerbier.database import Database, _db, _monthly_total_upsert
+from fliegerbier.items import Item
+from fliegerbier.migrations import migrate
+
+AKAFLIEG_ID = 4711
+TIMESTAMP = int(datetime(2020, 5, 10).timestamp())
+
+
+@pytest.fixture(scope='module')
+def db():
+    migrate(out=lambda line: None)
+    return Database()
+
+
+def test_repeated_purchases_share_one_rollup_row(db):
+    mate = Item('Mate', 0.4)
+    rowids = [db.enter_consumption(AKAFLIEG_ID, mate, TIMESTAMP + k).rowid for k in range(3)]
+    assert db.get_monthly_totals(2020, 5)[AKAFLIEG_ID]['Mate'] == {'count': 3, 'sum': 1.2}
+
+    db.remove_consumption(rowids[0])
+    assert db.get_monthly_totals(2020, 5)[AKAFLIEG_ID]['Mate'] == {'count': 2, 'sum': 0.8}
+    assert db.reconcile_monthly_totals() == []
+
+
+@pytest.mark.parametrize('dialect, clause', [
+    (postgresql.dialect(), 'ON CONFLICT'),
+    (mysql.dialect(), 'ON DUPLICATE KEY UPDATE'),
+])
+def test_upsert(dialect, clause):
+    values = dict(akaflieg_id=1, year=2020, month=5, item_name='Mate', price_cents=40)
+    statement = _monthly_total_upsert(dialect.name, values, 1)
+    assert clause in str(statement.compile(dialect=dialect))
+
+
+def test_no_upsert_for_sqlite():
+    assert _monthly_total_upsert(_db.dialect.name, {}, 1) is None
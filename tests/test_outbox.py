@@ -0,0 +1,44 @@
+from io import BytesIO
+
+import pytest
+import telegram
+
+from fliegerbier.outbox import Outbox
+
+
+@pytest.fixture
+def outbox():
+    return Outbox(global_rate=1000, chat_rate=1000, group_rate=1000, workers=2)
+
+
+def test_retry_after_is_capped(outbox):
+    calls = []
+
+    def flooded(**kwargs):
+        calls.append(kwargs)
+        raise telegram.error.RetryAfter(0)
+
+    future = outbox.submit(1, flooded)
+    with pytest.raises(telegram.error.RetryAfter):
+        future.result(timeout=5)
+    assert len(calls) == outbox.max_attempts + 1
+
+
+def test_documents_are_rewound_for_a_retry(outbox):
+    contents = []
+
+    def send_document(document):
+        contents.append(document.read())
+        if len(contents) == 1:
+            raise telegram.error.RetryAfter(0)
+        return 'sent'
+
+    document = BytesIO(b'csv')
+    assert outbox.submit(1, send_document, document=document).result(timeout=5) == 'sent'
+    assert contents == [b'csv', b'csv']
+
+
+def test_calls_without_chat_are_not_paced_per_chat():
+    outbox = Outbox(global_rate=1000, chat_rate=0.001, group_rate=0.001, workers=2)
+    futures = [outbox.submit(None, lambda i: i, i=i) for i in range(5)]
+    assert [f.result(timeout=5) for f in futures] == list(range(5))
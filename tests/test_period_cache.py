@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+
+from fliegerbier.database import Consumer, Database, _db
+from fliegerbier.items import Item
+from fliegerbier.migrations import migrate
+from fliegerbier.statistics import get_period_statistics
+
+CHAT_ID = 5150
+AKAFLIEG_ID = 5151
+START = int(datetime(2019, 3, 1).timestamp())
+END = int(datetime(2019, 4, 1).timestamp())
+
+
+@pytest.fixture(scope='module')
+def consumer():
+    migrate(out=lambda line: None)
+    Database().create_user(CHAT_ID)
+    Consumer(CHAT_ID).akaflieg_id = AKAFLIEG_ID
+    return CHAT_ID
+
+
+@pytest.fixture
+def statements():
+    executed = []
+
+    def count(conn, cursor, statement, *args):
+        executed.append(statement)
+
+    event.listen(_db, 'before_cursor_execute', count)
+    yield executed
+    event.remove(_db, 'before_cursor_execute', count)
+
+
+def test_hit_touches_no_database(consumer, statements):
+    mate = Item('Mate', 0.4)
+    Database().enter_consumption(AKAFLIEG_ID, mate, START + 60)
+    first = get_period_statistics(Consumer(consumer), START, END)
+    assert first.totals[('Mate', 0.4)] == 1
+
+    statements.clear()
+    assert get_period_statistics(Consumer(consumer), START, END) is first
+    assert statements == []
+
+    # A purchase in the period invalidates it by akaflieg_id
+    Database().enter_consumption(AKAFLIEG_ID, mate, START + 120)
+    assert get_period_statistics(Consumer(consumer), START, END).totals[('Mate', 0.4)] == 2
@@ -0,0 +1,18 @@
+from concurrent.futures import Future
+from unittest import mock
+
+from fliegerbier import decorators
+
+
+def test_respond_does_not_wait_for_the_outbox():
+    queued = Future()
+    context = mock.Mock(chat_data={})
+    with mock.patch.object(decorators.outbox, 'submit', return_value=queued), \
+            mock.patch.object(decorators, 'log_response'):
+        respond = decorators._respond(context, 1, mock.Mock(), [])
+        sent = respond('Hallo')
+        assert not sent.done()
+
+        message = {'message_id': 7}
+        queued.set_result(message)
+    assert sent.result(timeout=1) is message
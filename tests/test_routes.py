@@ -0,0 +1,12 @@
+from fliegerbier.botcompile import _Routes
+from fliegerbier.items import Catalog, Item, get_catalog
+
+
+def test_routes_of_an_older_catalog():
+    # The item is not in the current catalog, e.g. removed by a reload
+    # while the routes were being built
+    mate = Item('Mate', 0.4)
+    assert mate.button_text not in get_catalog().by_button_text
+
+    routes = _Routes(Catalog([mate], version=0))
+    assert mate.button_text in routes.table
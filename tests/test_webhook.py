@@ -0,0 +1,65 @@
+import json
+from queue import Queue
+from threading import Thread
+from types import SimpleNamespace
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import pytest
+
+from fliegerbier.webhook import WebhookServer
+
+SECRET = 'geheim'
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 7,
+        'date': 1589068800,
+        'chat': {'id': 42, 'type': 'private'},
+        'from': {'id': 42, 'is_bot': False, 'first_name': 'Otto'},
+        'text': '/start',
+    },
+}
+
+
+@pytest.fixture
+def server():
+    dispatcher = SimpleNamespace(update_queue=Queue(), bot=None)
+    server = WebhookServer(dispatcher, '127.0.0.1', 0, SECRET, max_connections=4, queue_size=2)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def post(server, body, path=SECRET):
+    url = 'http://127.0.0.1:{}/{}'.format(server.server_address[1], path)
+    request = Request(url, data=body, headers={'Content-Type': 'application/json'})
+    try:
+        with urlopen(request, timeout=5) as response:
+            return response.status
+    except HTTPError as e:
+        return e.code
+
+
+def test_update_is_queued_for_the_dispatcher(server):
+    assert post(server, json.dumps(UPDATE).encode()) == 200
+    update = server.dispatcher.update_queue.get_nowait()
+    assert update.effective_chat.id == 42
+    assert update.message.text == '/start'
+
+
+@pytest.mark.parametrize('body', [b'not json', b'[]', b'"x"', b'{}', b'{"update_id": "x", "message": 1}'])
+def test_bad_body(server, body):
+    assert post(server, body) == 400
+    assert server.dispatcher.update_queue.empty()
+
+
+def test_wrong_path(server):
+    assert post(server, json.dumps(UPDATE).encode(), path='falsch') == 404
+
+
+def test_full_queue_is_refused(server):
+    body = json.dumps(UPDATE).encode()
+    assert [post(server, body) for _ in range(3)] == [200, 200, 503]
+    assert server.dispatcher.update_queue.qsize() == 2